@@ -28,10 +28,11 @@ import calendar
 from datetime import datetime
 from functools import wraps
 
+import gevent
 import requests
 from flask import (
     Blueprint, current_app, request, render_template,
-    redirect,
+    redirect, stream_with_context, abort,
 )
 from werkzeug.local import LocalProxy
 
@@ -45,10 +46,11 @@ from utils import (
     addr_check, extract_data,
     utc_to_local, translate as _,
     get_deal_time, filter_sensitive_fields,
-    console_message, jsonp
+    console_message, jsonp, to_bool, run_blocking,
 )
 
 import worker
+from libs.logtail import read_tail
 from libs.managers import get_site_manager
 
 blueprint = Blueprint('admin', __name__, url_prefix='/admin')
@@ -107,14 +109,22 @@ def generate_uid_url(work):
     return site.instance_url if site else None
 
 
-@blueprint.route('/worker', methods=['GET', 'OPTIONS', ])
-@addr_check
-@render('worker.html')
-def view_worker_management():
+def stream_template(template, **context):
     '''
-    任务管理界面
+    流式渲染模板，页面边渲染边输出
+    context 中可以包含生成器，模板遍历时才逐个求值
     '''
-    workers = []
+    data = get_common_template_data()
+    data.update(context)
+    current_app.update_template_context(data)
+    template = current_app.jinja_env.get_template(template)
+    return current_app.response_class(
+        stream_with_context(template.generate(data))
+    )
+
+
+def iter_worker_rows():
+    '''逐个读取任务并整理出任务管理界面所需的数据'''
     for _w in worker.list_workers():
         _kvs = filter_sensitive_fields(_w['detail']).items()
         _w['detail']['params'] = '<pre>'
@@ -133,19 +143,18 @@ def view_worker_management():
 
         # 自动同步
         if _w['detail'].get('auto', ''):
-            _i = {
-                'object_type': 'folder',
-                'local_path': _w['detail']['path'][0],
-                'uid': _w['detail']['uid'][0],
-            }
-            fs = get_file_store(
-                _w['detail']['oc_server'],
-                _w['detail']['account'],
-                _w['detail']['instance']
-            )
             _w['detail']['local_url'] = ''
-        workers.append(_w)
-    return {'workers': workers}
+        yield _w
+
+
+@blueprint.route('/worker', methods=['GET', 'OPTIONS', ])
+@addr_check
+def view_worker_management():
+    '''
+    任务管理界面
+    任务逐个读取、逐行输出，任务很多时也不会一次性占用大量内存
+    '''
+    return stream_template('worker.html', workers=iter_worker_rows())
 
 
 @blueprint.route('/worker_detail', methods=['GET', 'OPTIONS', ])
@@ -175,6 +184,13 @@ def view_public_key():
     return render_template('public_key.html', key=key, **get_common_template_data())
 
 
+def get_log_file(name):
+    '''根据日志名称得到日志文件路径，名称不合法时返回 None'''
+    if not name or os.path.basename(name) != name:
+        return None
+    return os.path.join(LOG_DATA, '.'.join([name, 'log']))
+
+
 @blueprint.route('/viewlog', methods=('GET', ))
 @addr_check
 def view_view_log():
@@ -184,28 +200,114 @@ def view_view_log():
     - name: 日志文件的名称，不带后缀，例如 worker_1 / webserver；
     注意:
     - 此接口返回一个 HTML 页面，其中包含日志内容；
-    - 如果日志文件很大，只返回后 2MB 内容；
+    - 如果日志文件很大，只返回后 2MB 内容；不足 2MB 时用滚动和归档的旧日志补足；
+    - 页面通过 /admin/log/tail 持续追加新的日志内容；
     '''
     name = extract_data('name', request=request)
-    log_file = os.path.join(LOG_DATA, '.'.join([name, 'log']))
+    log_file = get_log_file(name)
+    if log_file is None:
+        abort(400)
     data = {
+        'name': name,
         'content': None,
         'path': log_file,
     }
     size_limit = 2 ** 20  # 2 Megaabytes
     if os.path.isfile(log_file):
-        with open(log_file, 'r', encoding='utf-8', errors='replace') as rf:
-            # Read last `size_limit` bytes
-            start = 0
-            rf.seek(0, 2)
-            size = rf.tell()
-            if size > size_limit:
-                start = size - size_limit
-            rf.seek(start)
-            data['content'] = rf.read(size_limit)
+        data.update(read_tail(log_file, limit=size_limit, history=True))
     return render_template('log.html', data=data, **get_common_template_data())
 
 
+@blueprint.route('/log/tail', methods=('GET', ))
+@addr_check
+@jsonp
+def api_log_tail():
+    '''
+    增量读取日志
+    请求参数:
+    - name: 日志文件的名称，不带后缀，例如 worker_1 / webserver；
+    - offset / generation: 上次返回的 offset 和 generation，不指定则返回最后 2MB；
+    - follow: 为真时以 Server-Sent Events 持续推送新内容；
+    返回 content、offset、generation，以及是否发生了滚动 rotated、重新开始 reset
+    '''
+    name, offset, generation, follow = extract_data(
+        ('name', 'offset', 'generation', 'follow', ), request=request
+    )
+    log_file = get_log_file(name)
+    if log_file is None:
+        abort(400)
+    # 断线重连时浏览器会带上最后收到的事件 ID: <offset>:<generation>
+    last_event_id = request.headers.get('Last-Event-ID', None)
+    if last_event_id and ':' in last_event_id:
+        offset, generation = last_event_id.split(':', 1)
+    try:
+        offset = int(offset) if offset not in (None, '') else None
+        generation = int(generation) if generation not in (None, '') else None
+    except ValueError:
+        abort(400)
+
+    if not to_bool(follow):
+        return json.dumps(read_tail(log_file, offset, generation))
+
+    def generate(offset, generation):
+        yield 'retry: 3000\n\n'
+        idle = 0
+        while True:
+            result = read_tail(log_file, offset, generation)
+            offset, generation = result['offset'], result['generation']
+            if result['content'] or result['reset']:
+                idle = 0
+                yield 'id: {}:{}\ndata: {}\n\n'.format(
+                    offset, generation, json.dumps(result)
+                )
+            else:
+                idle += 1
+                if idle % 15 == 0:
+                    # 保持连接
+                    yield ': keepalive\n\n'
+                gevent.sleep(1)
+
+    response = current_app.response_class(
+        generate(offset, generation), mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@blueprint.route('/log/search', methods=('GET', ))
+@addr_check
+@jsonp
+def api_log_search():
+    '''
+    搜索任务日志
+    请求参数:
+    - q: 查询字符串；
+    - since: 只返回这个时间（Unix 时间戳）之后的日志行；
+    - name: 只搜索这个日志，例如 worker_12；
+    - context: 返回匹配行前后的行数，默认 2；
+    - limit: 最多返回的匹配行数，默认 100；
+    '''
+    q, since, name, context, limit = extract_data(
+        ('q', 'since', 'name', 'context', 'limit', ), request=request
+    )
+    if not q:
+        abort(400)
+    try:
+        since = float(since) if since else None
+        context = min(int(context or 2), 20)
+        limit = min(int(limit or 100), 1000)
+    except ValueError:
+        abort(400)
+    start = time.time()
+    results = current_app.LOG_INDEX.search(
+        q, since=since, name=name or None, context=context, limit=limit
+    )
+    return json.dumps({
+        'results': results,
+        'took': int((time.time() - start) * 1000),
+    })
+
+
 @blueprint.route('/config', methods=['GET', 'POST', 'OPTIONS'])
 @addr_check
 def view_manage_config():
@@ -266,7 +368,7 @@ def view_connection_management():
 
         if action == 'reload':
             # 更新主进程 site_manager 并刷新站点连接页面
-            site_manager.reload_sites()
+            run_blocking(site_manager.reload_sites)
             return json.dumps({
                 'success': True, 'msg': 'Successful reload'
             })
@@ -354,7 +456,9 @@ def api_site_connections():
         })
     elif action == "create":
         # 3.1 建立连接
-        site = site_manager.add_site(
+        # 会访问站点验证 token，获取站点信息
+        site = run_blocking(
+            site_manager.add_site,
             oc_url=oc_server,
             account=account,
             instance=instance,
@@ -421,7 +525,9 @@ def view_locks_management():
         if action == 'force_release'\
                 and lock_name in current_app.LOCKS\
                 and str(current_app.LOCKS[lock_name]['worker_id']) == str(worker_id):
-            current_app.LOCKS.pop(lock_name)
+            current_app.LOCK_STATS.record_release(
+                lock_name, current_app.LOCKS.pop(lock_name)
+            )
             logger.debug(u'强制解锁了 #%s 的锁 %s', worker_id, lock_name)
             return json.dumps({'success': True, 'msg': 'Unlocked',})
         else:
@@ -430,10 +536,23 @@ def view_locks_management():
     return render_template(
         'locks.html',
         locks=current_app.LOCKS,
+        stats=current_app.LOCK_STATS.get_stats(current_app.LOCKS),
         **get_common_template_data()
     )
 
 
+@blueprint.route('/locks/stats', methods=['POST', 'GET', 'OPTIONS', ])
+@addr_check
+@jsonp
+def api_lock_stats():
+    '''
+    返回所有锁的争用统计：加锁/失败次数、持有和等待时间直方图、当前等待队列
+    '''
+    return json.dumps(
+        current_app.LOCK_STATS.get_stats(current_app.LOCKS)
+    )
+
+
 @blueprint.route('/help', methods=['GET', 'OPTIONS'])
 @addr_check
 def view_help():
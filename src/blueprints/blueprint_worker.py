@@ -16,6 +16,7 @@
  */
 """
 import cgi
+import hashlib
 import json
 from datetime import datetime
 from Queue import Queue
@@ -23,13 +24,15 @@ from threading import Thread
 
 from flask import (
     Blueprint, current_app, request, abort, render_template, g as flask_g,
+    stream_with_context,
 )
 from werkzeug.local import LocalProxy
 
 from utils import (
     addr_check, extract_data, extract_data_list,
     jsonp, translate as _, console_message, is_internal_call,
-    filter_sensitive_fields, get_human_ltime, to_bool, get_wo_client
+    filter_sensitive_fields, get_human_ltime, to_bool, get_wo_client,
+    blocking, get_result_store,
 )
 import ui_client
 import worker
@@ -39,6 +42,10 @@ blueprint = Blueprint('worker', __name__, url_prefix='/worker')
 logger = LocalProxy(lambda: current_app.logger)
 trayIcon = LocalProxy(lambda: current_app.trayIcon)
 LOCKS = LocalProxy(lambda: current_app.LOCKS)
+LOCK_STATS = LocalProxy(lambda: current_app.LOCK_STATS)
+WORKER_EVENTS = LocalProxy(lambda: current_app.WORKER_EVENTS)
+# 长轮询和事件流的最长等待时间（秒）
+MAX_WAIT_TIMEOUT = 60
 UpdateItemsQueue = Queue()
 UpdateProgressThread = None
 
@@ -52,8 +59,10 @@ def show_msg(title, body, type='none'):
     '''显示一个托盘图标消息，或者在静默模式下向终端打印这条消息'''
     console_message(unicode(title), unicode(body))
 
-def unlock_editing_file(wid):
-    db = worker.get_worker_db(wid)
+@blocking
+def unlock_editing_file(wid, db=None):
+    if db is None:
+        db = worker.get_worker_db(wid)
     if not db or db.get("name", "") != "edit":
         # 任务不存在或不是外部编辑任务，不做任何事
         return
@@ -79,10 +88,86 @@ def unlock_editing_file(wid):
 def api_worker_list():
     '''
     列出所有的任务的信息
+    可选参数:
+    - name / state / site: 按任务名、状态、站点（instance 或 instance_url）过滤
+    - since / until: 按任务开始时间（Unix 时间戳）过滤
+    - fields: JSON 列表，只返回 detail 中的这些字段
+    - limit / cursor: 分页，cursor 取上一页返回的 next_cursor
+    响应带有 ETag，If-None-Match 匹配时返回 304
     '''
-    return json.dumps({
-        'workers': [work for work in worker.list_workers()]
-    })
+    name, state, site, since, until, fields, limit, cursor, callback = \
+        extract_data(
+            (
+                'name', 'state', 'site', 'since', 'until',
+                'fields', 'limit', 'cursor', 'callback',
+            ),
+            request=request
+        )
+    try:
+        since = float(since) if since else None
+        until = float(until) if until else None
+        limit = int(limit) if limit else None
+        # 在开始输出响应之前检查，否则出错时只能返回不完整的 200 响应
+        cursor = int(cursor) if cursor else None
+        fields = json.loads(fields) if fields else None
+    except ValueError:
+        abort(400)
+    if limit is not None and limit <= 0:
+        abort(400)
+    if fields is not None and not is_field_list(fields):
+        abort(400)
+
+    # JSONP 请求无法处理 304，不使用 ETag
+    version = worker.get_store_version()
+    etag = None
+    if version is not None and not callback:
+        etag = hashlib.sha1('{}|{}|{}'.format(
+            version, request.query_string, request.get_data()
+        )).hexdigest()
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+    workers = worker.iter_workers(
+        name=name, state=state, site=site, since=since, until=until,
+        fields=fields, cursor=cursor,
+    )
+    response = current_app.response_class(
+        stream_with_context(generate_worker_list(workers, limit)),
+        mimetype='application/json'
+    )
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def is_field_list(fields):
+    '''fields 参数是否为字段名的列表'''
+    return isinstance(fields, list)\
+        and all(isinstance(field, basestring) for field in fields)
+
+
+def generate_worker_list(workers, limit=None):
+    '''
+    逐个编码任务，流式输出任务列表的 JSON，内存占用与任务数量无关
+    limit: 最多输出的任务数，指定时在结尾附带 next_cursor
+    '''
+    yield '{"workers": ['
+    count = 0
+    next_cursor = None
+    last_id = None
+    for work in workers:
+        if limit is not None and count >= limit:
+            next_cursor = last_id
+            break
+        yield (',' if count else '') + json.dumps(work)
+        count += 1
+        last_id = work['worker_id']
+    if limit is None:
+        yield ']}'
+    else:
+        yield '], "next_cursor": {}}}'.format(json.dumps(next_cursor))
 
 
 @blueprint.route('/state', methods=['POST', 'GET', 'OPTIONS', ])
@@ -95,11 +180,15 @@ def api_worker_state():
     wid, fields = extract_data(('worker_id', 'fields',), request=request)
     if wid not in worker.list_worker_ids():
         abort(404)
-    wstate = worker.get_worker(wid)
+    if fields is not None:
+        fields = json.loads(fields)
+    # 单独保存的较大的任务结果，只在明确指定 fields 包含 _result 时读取
+    wstate = worker.get_worker(
+        wid, load_result=fields is not None and '_result' in fields
+    )
     detail = wstate.get('detail', {})
     result = {}
     if fields is not None:
-        fields = json.loads(fields)
         for k in fields:
             result[k] = detail.get(k, None)
     else:
@@ -108,6 +197,46 @@ def api_worker_state():
     return json.dumps(wstate)
 
 
+@blueprint.route('/result', methods=['GET', ])
+@addr_check
+def api_worker_result():
+    '''
+    下载任务结果（JSON），较大的结果从结果文件中流式读取
+    客户端支持 gzip 时直接发送压缩的结果文件
+    '''
+    wid = extract_data('worker_id', request=request)
+    if wid not in worker.list_worker_ids():
+        abort(404)
+    db = worker.get_worker_db(wid)
+    if db.get('_result_ref', None) is None:
+        if db.get('_result', None) is None:
+            abort(404)
+        return current_app.response_class(
+            db['_result'], mimetype='application/json'
+        )
+
+    ref = db['_result_ref']
+    gzipped = 'gzip' in request.accept_encodings
+    try:
+        chunks = get_result_store().iter_raw(wid, decompress=not gzipped)
+    except IOError:
+        logger.exception(u'读取任务 #%s 的结果文件出错', wid)
+        abort(404)
+    response = current_app.response_class(
+        chunks, mimetype='application/json', direct_passthrough=True
+    )
+    # 压缩与不压缩的响应内容不同，缓存时要区分
+    response.headers['Vary'] = 'Accept-Encoding'
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Length'] = str(ref['compressed_size'])
+        response.set_etag(ref['sha1'] + '-gz')
+    else:
+        response.headers['Content-Length'] = str(ref['size'])
+        response.set_etag(ref['sha1'])
+    return response
+
+
 @blueprint.route('/cancel', methods=['POST', 'GET', 'OPTIONS', ])
 @addr_check
 @jsonp
@@ -148,6 +277,134 @@ def api_worker_pause():
     })
 
 
+@blueprint.route('/batch', methods=['POST', 'OPTIONS', ])
+@addr_check
+@jsonp
+def api_worker_batch():
+    '''
+    批量操作任务，一次请求完成多个 start / pause / cancel / state 操作
+    参数 operations 为 JSON 列表，每一项是以下形式之一:
+    - {"action": "pause", "worker_id": "12"}
+    - {"action": "pause", "filter": {"instance": "default", "state": "running"}}
+    pause 可以带 turn_off_message，state 可以带 fields（同 /worker/state）
+    所有操作共用一次读取的任务数据，暂停和删除的任务的锁最后一次性清理。
+    返回每一项操作的结果列表，顺序与 operations 一致
+    '''
+    operations = extract_data('operations', request=request)
+    try:
+        operations = json.loads(operations)
+        assert isinstance(operations, list)
+    except Exception:
+        return json.dumps({
+            'success': False,
+            'msg': 'Invalid parameter: operations',
+        })
+
+    # 所有任务的数据只读取一次
+    dbs = dict(
+        (wid, worker.get_worker_db(wid)) for wid in worker.list_worker_ids()
+    )
+    stopped_ids = []
+    results = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            results.append({
+                'index': index, 'success': False, 'msg': 'Invalid operation',
+            })
+            continue
+        action = operation.get('action', None)
+        if action not in ('start', 'pause', 'cancel', 'state', ):
+            results.append({
+                'index': index, 'success': False,
+                'msg': 'Unknown action: {}'.format(action),
+            })
+            continue
+        # 参数类型不对时只是这个操作失败，不影响其他操作
+        conditions = operation.get('filter', None)
+        fields = operation.get('fields', None)
+        if conditions is not None and not isinstance(conditions, dict)\
+                or fields is not None and not is_field_list(fields):
+            results.append({
+                'index': index, 'success': False, 'msg': 'Invalid operation',
+            })
+            continue
+
+        if conditions is not None:
+            wids = sorted(
+                (
+                    wid for wid, db in dbs.items()
+                    if db is not None and worker.match_conditions(db, conditions)
+                ),
+                key=int
+            )
+        elif operation.get('worker_id', None) is not None:
+            wids = [str(operation['worker_id'])]
+        else:
+            results.append({
+                'index': index, 'success': False,
+                'msg': _('Task ID not specified'),
+            })
+            continue
+
+        items = []
+        for wid in wids:
+            db = dbs.get(wid, None)
+            if not db:
+                items.append({
+                    'worker_id': wid, 'success': False,
+                    'msg': _('No such task'),
+                })
+                continue
+            try:
+                if action == 'start':
+                    result = worker.start_worker(wid)
+                elif action == 'pause':
+                    result = worker.pause_worker(
+                        wid, to_bool(operation.get('turn_off_message', False)),
+                        worker_db=db, release_locks=False
+                    )
+                    stopped_ids.append(wid)
+                elif action == 'cancel':
+                    unlock_editing_file(wid, db=db)
+                    result = worker.terminate_worker(wid, release_locks=False)
+                    dbs.pop(wid)
+                    stopped_ids.append(wid)
+                else:
+                    result = worker.get_worker(
+                        wid, worker_storage=db,
+                        load_result=fields is not None and '_result' in fields
+                    )
+                    detail = result.get('detail', {})
+                    if fields is not None:
+                        detail = dict((k, detail.get(k, None)) for k in fields)
+                    result['detail'] = filter_sensitive_fields(detail)
+            except Exception as e:
+                logger.exception(u'批量操作任务 #%s 出错: %s', wid, action)
+                items.append({
+                    'worker_id': wid, 'success': False, 'msg': unicode(e),
+                })
+            else:
+                items.append({
+                    'worker_id': wid, 'success': True, 'result': result,
+                })
+        results.append({
+            'index': index,
+            'action': action,
+            'success': all(item['success'] for item in items),
+            'workers': items,
+        })
+
+    # 一次遍历锁表，清理所有被暂停或删除的任务的锁
+    released = worker.release_workers_locks(stopped_ids) if stopped_ids else []
+    if any(r.get('action') == 'cancel' and r['workers'] for r in results):
+        show_msg(unicode(_('Sitebot')), unicode(_('Task deleted')), 'info')
+    return json.dumps({
+        'success': all(r['success'] for r in results),
+        'results': results,
+        'released_locks': released,
+    })
+
+
 @blueprint.route('/restart', methods=['POST', 'OPTIONS', ])
 @addr_check
 @jsonp
@@ -237,6 +494,92 @@ def api_worker_start():
     })
 
 
+@blueprint.route('/notify', methods=['POST', ])
+@addr_check
+def api_worker_notify():
+    '''
+    任务子进程通知主进程任务状态发生了变化，只允许内部调用
+    '''
+    if not is_internal_call(request):
+        abort(403)
+    worker_id, state, script, reason = extract_data(
+        ('worker_id', 'state', 'script', 'reason', ), request=request
+    )
+    if not all([worker_id, state, ]):
+        return json.dumps({'success': False, 'msg': 'Missing parameter',})
+    extra = dict(
+        (k, v) for k, v in (('script', script), ('reason', reason)) if v
+    )
+    event = WORKER_EVENTS.publish(worker_id, state, **extra)
+    return json.dumps({'success': True, 'seq': event.get('seq', None),})
+
+
+@blueprint.route('/wait', methods=['POST', 'GET', 'OPTIONS', ])
+@addr_check
+@jsonp
+def api_worker_wait():
+    '''
+    长轮询等待任务状态变化
+    请求参数:
+    - worker_id: 只等待这个任务的事件，不指定则等待所有任务的事件；
+    - since: 上次收到的最大事件序号，不指定则返回缓存中的所有事件；
+    - timeout: 最长等待秒数，默认 30 秒；
+    返回序号大于 since 的事件列表，以及当前最大序号 last_seq
+    '''
+    worker_id, since, timeout = extract_data(
+        ('worker_id', 'since', 'timeout', ), request=request
+    )
+    try:
+        since = int(since or 0)
+        timeout = min(float(timeout or 30), MAX_WAIT_TIMEOUT)
+    except ValueError:
+        abort(400)
+    events = WORKER_EVENTS.wait(since, worker_id=worker_id, timeout=timeout)
+    return json.dumps({
+        'events': events,
+        'last_seq': WORKER_EVENTS.last_seq,
+    })
+
+
+@blueprint.route('/events', methods=['GET', ])
+@addr_check
+def api_worker_events():
+    '''
+    以 Server-Sent Events 推送任务状态变化
+    请求参数:
+    - worker_id: 只推送这个任务的事件；
+    - since: 从这个序号之后开始推送，断线重连时浏览器会带上 Last-Event-ID 头；
+    '''
+    worker_id, since = extract_data(('worker_id', 'since', ), request=request)
+    since = request.headers.get('Last-Event-ID', since)
+    try:
+        since = int(since or WORKER_EVENTS.last_seq)
+    except ValueError:
+        abort(400)
+    feed = current_app.WORKER_EVENTS
+
+    def generate(seq):
+        yield 'retry: 3000\n\n'
+        while True:
+            events = feed.wait(seq, worker_id=worker_id, timeout=15)
+            if not events:
+                # 保持连接
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                seq = event['seq']
+                yield 'id: {}\nevent: state\ndata: {}\n\n'.format(
+                    seq, json.dumps(event)
+                )
+
+    response = current_app.response_class(
+        generate(since), mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
 @blueprint.route('/lock/acquire', methods=['POST', ])
 @addr_check
 @jsonp
@@ -258,10 +601,12 @@ def api_lock_acquire():
                 'description': description or '',
                 'since': datetime.now(),
             }
+            LOCK_STATS.record_attempt(lock_name, worker_id, True)
             locked = {'success': True, 'msg': 'OK',}
         else:
             # 已经有人锁了
             if lock['worker_id'] != worker_id:
+                LOCK_STATS.record_attempt(lock_name, worker_id, False)
                 locked = {
                     'success': False,
                     'msg': 'Locked by #{}'.format(lock['worker_id']),
@@ -284,12 +629,13 @@ def api_lock_release():
     if is_internal_call(request) and not lock_name:  # 内部清理一个任务所有的锁
         for lock_name in LOCKS.keys():
             if LOCKS[lock_name]['worker_id'] == worker_id:
-                LOCKS.pop(lock_name)
+                LOCK_STATS.record_release(lock_name, LOCKS.pop(lock_name))
                 logger.debug(u'自动清理了 #%s 的锁 %s', worker_id, lock_name)
+        LOCK_STATS.forget_worker(worker_id)
         return json.dumps({'success': True, 'msg': 'OK',})
 
     if not all([worker_id, lock_name, ]):
-        released = {'success': False, msg: 'Missing parameter',}
+        released = {'success': False, 'msg': 'Missing parameter',}
     else:
         lock = LOCKS.get(lock_name, None)
         # 不存在的锁也还是允许解吧，反正没影响
@@ -306,6 +652,6 @@ def api_lock_release():
                 }
             else:
                 # 解锁
-                LOCKS.pop(lock_name)
+                LOCK_STATS.record_release(lock_name, LOCKS.pop(lock_name))
                 released = {'success': True, 'msg': 'OK',}
     return json.dumps(released)
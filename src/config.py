@@ -54,6 +54,69 @@ finally:
     CONFIG.setdefault('http_port', 4999)
     CONFIG.setdefault('https_port', 4997)
 
+# 异步日志设置
+# async_logging: 是否由后台线程写日志
+# log_queue_size: 日志队列长度上限
+# log_overflow_policy: 队列满时的处理策略，drop_debug / drop_new / block
+ASYNC_LOGGING = CONFIG.get('async_logging', True)
+LOG_QUEUE_SIZE = CONFIG.get('log_queue_size', 10000)
+LOG_OVERFLOW_POLICY = CONFIG.get('log_overflow_policy', 'drop_debug')
+# log_format: 文件日志格式，text / json（每行一个 JSON 对象，带任务上下文和关联 ID）
+LOG_FORMAT = CONFIG.get('log_format', 'text')
+# 日志归档设置（滚动出来的旧日志压缩后保留）
+# log_archive_segments: 每个日志最多保留的归档数
+# log_archive_bytes: 每个日志的归档最多占用的空间
+# log_archive_total_bytes: 所有日志的归档最多占用的空间
+LOG_ARCHIVE_SEGMENTS = CONFIG.get('log_archive_segments', 5)
+LOG_ARCHIVE_BYTES = CONFIG.get('log_archive_bytes', 5 * 2 ** 20)
+LOG_ARCHIVE_TOTAL_BYTES = CONFIG.get('log_archive_total_bytes', 200 * 2 ** 20)
+
+# 请求处理中阻塞操作（网络请求、同步脚本等）使用的线程数
+BLOCKING_POOL_SIZE = CONFIG.get('blocking_pool_size', 10)
+# 请求超过这个时间（秒）仍未完成时，在 slow_requests.log 中记录调用栈，0 为不记录
+SLOW_REQUEST_THRESHOLD = CONFIG.get('slow_request_threshold', 5)
+# 联机脚本的本地缓存
+# script_cache_ttl: 缓存的脚本多久（秒）之后需要重新下载，软件包版本变化时立即重新下载
+# script_cache_bytes: 缓存最多占用的空间
+SCRIPT_CACHE_TTL = CONFIG.get('script_cache_ttl', 5 * 60)
+SCRIPT_CACHE_BYTES = CONFIG.get('script_cache_bytes', 50 * 2 ** 20)
+# 联机脚本翻译文件（load_i18n）的本地缓存，翻译很少变化，有效期比脚本长
+I18N_CACHE_TTL = CONFIG.get('i18n_cache_ttl', 24 * 60 * 60)
+I18N_CACHE_BYTES = CONFIG.get('i18n_cache_bytes', 10 * 2 ** 20)
+# 下载翻译文件失败（改用默认语言或没有翻译）时，结果只缓存这么久（秒），避免临时错误影响太久
+I18N_CACHE_FAILURE_TTL = CONFIG.get('i18n_cache_failure_ttl', 5 * 60)
+# 同一个进程中复用 edo_client 客户端（及其 HTTP 连接）的时间（秒）
+CLIENT_CACHE_TTL = CONFIG.get('client_cache_ttl', 60 * 60)
+# 站点 token 信息（get_token_info）的缓存时间（秒）
+TOKEN_INFO_TTL = CONFIG.get('token_info_ttl', 5 * 60)
+# 同步调用脚本（/call_script_sync）
+# sync_pool_size: 预先启动的执行器数量，同时最多运行这么多同步脚本；0 为按任务方式运行（创建任务记录）
+# sync_script_timeout: 默认的超时时间（秒），请求中可以用 timeout 参数指定，
+#   这也是调用者等待结果的时间，超时后请求返回失败，脚本在执行器中继续运行直到结束
+# sync_script_max_timeout: 请求中 timeout 参数的上限（秒），避免长时间占用请求
+# sync_script_audit: 是否在 sync_audit.log 中记录每次调用
+SYNC_POOL_SIZE = CONFIG.get('sync_pool_size', 4)
+SYNC_SCRIPT_TIMEOUT = CONFIG.get('sync_script_timeout', 60)
+SYNC_SCRIPT_MAX_TIMEOUT = CONFIG.get('sync_script_max_timeout', 10 * 60)
+SYNC_SCRIPT_AUDIT = CONFIG.get('sync_script_audit', False)
+# 任务结果回调（callback_url / return_script 等）失败后的重试
+# callback_retry_delay: 第一次重试前等待的秒数，之后每次加倍，最多 callback_retry_max_delay 秒
+# callback_max_attempts: 最多尝试的次数，超过后放弃（保留在 callbacks/failed 目录中）
+CALLBACK_RETRY_DELAY = CONFIG.get('callback_retry_delay', 10)
+CALLBACK_RETRY_MAX_DELAY = CONFIG.get('callback_retry_max_delay', 60 * 60)
+CALLBACK_MAX_ATTEMPTS = CONFIG.get('callback_max_attempts', 10)
+# 任务结果（JSON）超过这个大小时单独压缩保存到 APP_DATA/results，不保存在任务记录中
+RESULT_INLINE_BYTES = CONFIG.get('result_inline_bytes', 64 * 2 ** 10)
+# 联机脚本 get_host 的 SSH 连接复用
+# ssh_idle_timeout: 空闲的连接保持多久（秒），0 为不复用
+# ssh_keepalive: 连接的 keepalive 间隔（秒）
+# ssh_proxy: 连接是否保持在主进程中，任务子进程通过本地代理使用（否则每个任务进程各自连接）
+SSH_IDLE_TIMEOUT = CONFIG.get('ssh_idle_timeout', 5 * 60)
+SSH_KEEPALIVE = CONFIG.get('ssh_keepalive', 30)
+SSH_PROXY = CONFIG.get('ssh_proxy', True)
+# 脚本编译结果（code object）的缓存最多占用的空间
+CODE_CACHE_BYTES = CONFIG.get('code_cache_bytes', 20 * 2 ** 20)
+
 HTTP_PORT = CONFIG['http_port']
 HTTPS_PORT = CONFIG['https_port']
 # 现在修改访问端口后，不支持使用局域网加速下载
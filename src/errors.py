@@ -163,3 +163,20 @@ class LogicError(Exception):
         )
 
     __str__ = __repr__
+
+
+class SyncCallTimeout(Exception):
+    '''
+    同步调用脚本超时（脚本仍在执行器中继续运行，直到结束）
+    '''
+
+    def __init__(self, script_name, timeout):
+        self.script_name = script_name
+        self.timeout = timeout
+
+    def __repr__(self):
+        return u'<SyncCallTimeout {} after {} seconds>'.format(
+            self.script_name, self.timeout
+        )
+
+    __str__ = __repr__
@@ -22,7 +22,6 @@ import os
 import sys
 import json
 import logging
-import logging.handlers
 import time
 import traceback
 
@@ -31,9 +30,22 @@ import gevent.wsgi
 
 import worker
 from utils import (
-    translate, addr_check, jsonp, extract_data, extract_data_list
+    translate, addr_check, jsonp, extract_data, extract_data_list,
+    wrap_async_handler, get_log_formatter, add_context_filter, run_blocking,
+    is_internal_call, get_log_stats, get_logger, get_script_cache,
+    get_callback_spool, get_ssh_broker,
 )
 import config
+from errors import SyncCallTimeout
+from libs.lockstats import LockStats
+from libs.events import EventFeed
+from libs.logindex import LogIndex
+from libs.callbacks import CallbackDispatcher
+from libs.logarchive import ArchivingRotatingFileHandler
+from libs.offload import BlockingPool, ExecutorPool
+from libs.requestmetrics import RequestMetrics, ENDPOINT_KEY
+from libs.sshbroker import SSHProxy
+from libs import metrics
 from config import (
     BUILD_NUMBER, VERSION, ALLOW_DOMAIN, HTTP_PORT,
     HTTPS_PORT, BIND_ADDRESS, CURRENT_DIR, LOG_DATA, APP_DATA
@@ -84,24 +96,39 @@ for module_name in ['blueprint_admin', 'blueprint_worker']:
 
 # Set logger
 fapp.debug = DEBUG = True
-fhandler = logging.handlers.RotatingFileHandler(
+fhandler = ArchivingRotatingFileHandler(
     os.path.join(LOG_DATA, 'webserver.log'),
     maxBytes=100*1024,
-    backupCount=1
 )
 # 修改一下日志格式，方便调试
-fhandler.setFormatter(logging.Formatter(
-    '%(asctime)s (L%(lineno)d) %(threadName)s %(levelname)s %(message)s'
-))
+fhandler.setFormatter(get_log_formatter())
 flask_debug_level = logging.DEBUG if fapp.debug else logging.WARN
 fhandler.setLevel(flask_debug_level)
 # 确保仅添加一个文件记录处理器
-if not any([type(h) == type(fhandler) for h in fapp.logger.handlers]):
-    fapp.logger.addHandler(fhandler)
+if not any([
+    type(getattr(h, 'target', h)) == type(fhandler)
+    for h in fapp.logger.handlers
+]):
+    fapp.logger.addHandler(wrap_async_handler(fhandler))
+add_context_filter(fapp.logger)
 
 logger = fapp.logger
 http_greenlet = https_greenlet = None
 
+# 请求统计和慢请求日志，长轮询、事件流接口不算慢请求
+request_metrics = RequestMetrics(
+    fapp.wsgi_app,
+    slow_threshold=config.SLOW_REQUEST_THRESHOLD,
+    slow_ignore=(
+        'worker.api_worker_wait', 'worker.api_worker_events',
+        'admin.api_log_tail',
+    ),
+    slow_logger=get_logger(
+        'slow_requests', filename='slow_requests.log', to_console=False
+    ),
+)
+fapp.wsgi_app = request_metrics
+
 # Flask 国际化
 babel = Babel(fapp)
 
@@ -156,6 +183,18 @@ def crossdomain():
 @fapp.before_request
 def request_hook():
     flask_g.headless = True
+    flask_g.request_start = time.time()
+    request.environ[ENDPOINT_KEY] = request.endpoint
+
+
+@fapp.teardown_request
+def record_internal_api_latency(exc=None):
+    '''统计任务子进程调用内部接口的耗时'''
+    start = getattr(flask_g, 'request_start', None)
+    if start is not None and is_internal_call(request):
+        metrics.INTERNAL_API_LATENCY.observe(
+            time.time() - start, (request.endpoint or '', )
+        )
 
 @fapp.after_request
 def set_cookies(response):
@@ -198,6 +237,88 @@ def api_about():
     return json.dumps(info)
 
 
+# 输出指标时收集的数据，见 libs.metrics
+# 任务数量的统计需要读取所有任务，缓存几秒钟，同一次输出的多个指标也只读取一次
+WORKER_COUNTS_TTL = 5
+_worker_counts = (0, {})
+
+
+def get_worker_counts():
+    '''按 (任务名, 状态) 统计的任务数量'''
+    global _worker_counts
+    now = time.time()
+    if now - _worker_counts[0] > WORKER_COUNTS_TTL:
+        counts = {}
+        for item in worker.iter_workers(fields=()):
+            key = (item['name'], item['state'], )
+            counts[key] = counts.get(key, 0) + 1
+        _worker_counts = (now, counts)
+    return _worker_counts[1]
+
+
+def collect_workers():
+    return get_worker_counts().items()
+
+
+def collect_queue_depth():
+    '''等待启动的任务、等待写入的日志、等待线程池执行的阻塞操作'''
+    prepare = sum(
+        count for (_name, state), count in get_worker_counts().items()
+        if state == 'prepare'
+    )
+    depth = [(('worker_prepare', ), prepare)]
+    log_stats = get_log_stats()
+    if log_stats is not None:
+        depth.append((('log', ), log_stats['queued']))
+    depth.append((('blocking', ), fapp.BLOCKING_POOL.stats()['busy']))
+    if config.SYNC_POOL_SIZE:
+        depth.append((('sync', ), fapp.SYNC_POOL.stats()['busy']))
+    depth.append((('callback', ), get_callback_spool().stats()['queued']))
+    return depth
+
+
+def collect_callback_oldest_age():
+    return [((), get_callback_spool().stats()['oldest_age'])]
+
+
+def collect_callbacks_failed():
+    return [((), get_callback_spool().stats()['failed'])]
+
+
+def collect_mqtt_connected():
+    from libs.managers import get_site_manager
+    for site in get_site_manager().list_sites():
+        # 只读取已有的消息线程的状态，不创建线程
+        yield (site.instance, ), int(site.get_message_state() == 'online')
+
+
+def collect_script_cache():
+    stats = get_script_cache().stats()
+    return [((result, ), stats[result]) for result in ('hits', 'misses', )]
+
+
+def collect_script_cache_hit_ratio():
+    stats = get_script_cache().stats()
+    lookups = stats['hits'] + stats['misses']
+    return [((), float(stats['hits']) / lookups if lookups else 0.0)]
+
+
+def collect_process_rss():
+    import psutil
+    return [((), psutil.Process(os.getpid()).memory_info().rss)]
+
+
+@fapp.route('/metrics', methods=['GET', ])
+@addr_check
+def api_metrics():
+    '''
+    Prometheus 格式的运行指标，见 libs.metrics
+    '''
+    # 收集指标要读取任务数据等，不在事件循环中进行
+    body = run_blocking(metrics.REGISTRY.render)
+    return body, 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
 @fapp.route('/quit', methods=['POST', 'GET', 'OPTIONS', ])
 @addr_check
 def api_quit():
@@ -256,8 +377,29 @@ def api_call_script_sync():
         for key, value in zip(keywords, values):
             parameters.update({key: value})
         parameters.update({'__sync': True})
-        from worker import start_sync_worker
-        result = start_sync_worker('online_script', **parameters)
+        # 同步脚本可能运行很久，期间服务器需要继续处理其他请求（例如脚本自己申请锁）
+        if config.SYNC_POOL_SIZE:
+            # 在预先启动的执行器中运行，不创建任务记录
+            try:
+                timeout = float(extract_data('timeout', request=request) or 0)
+            except ValueError:
+                timeout = 0
+            try:
+                result = worker.call_sync_worker(
+                    'online_script', timeout=timeout, **parameters
+                )
+            except SyncCallTimeout as e:
+                return json.dumps({
+                    'success': False,
+                    'msg': u'Script timed out after {} seconds'.format(
+                        e.timeout
+                    ),
+                })
+        else:
+            from worker import start_sync_worker
+            result = run_blocking(
+                start_sync_worker, 'online_script', **parameters
+            )
     try:
         return json.dumps({
             'success': True,
@@ -290,6 +432,43 @@ def start_server():
         certfile=os.path.join(APP_DATA, 'certifi', 'sitebot.crt'),
     )
     fapp.LOCKS = {}
+    # 必须在运行事件循环的线程中创建
+    fapp.BLOCKING_POOL = BlockingPool(config.BLOCKING_POOL_SIZE)
+    if config.SYNC_POOL_SIZE:
+        fapp.SYNC_POOL = ExecutorPool(config.SYNC_POOL_SIZE, prefix='sync')
+    fapp.LOCK_STATS = LockStats()
+    fapp.WORKER_EVENTS = EventFeed(sleep=gevent.sleep)
+    fapp.WORKER_EVENTS.subscribe(metrics.WorkerStateTracker(
+        metrics.WORKER_START_LATENCY, metrics.WORKER_RUNTIME,
+        metrics.WORKER_RETRIES,
+    ))
+    metrics.WORKERS.collect = collect_workers
+    metrics.QUEUE_DEPTH.collect = collect_queue_depth
+    metrics.MQTT_CONNECTED.collect = collect_mqtt_connected
+    metrics.PROCESS_RSS.collect = collect_process_rss
+    metrics.SCRIPT_CACHE.collect = collect_script_cache
+    metrics.SCRIPT_CACHE_HIT_RATIO.collect = collect_script_cache_hit_ratio
+    metrics.CALLBACK_OLDEST_AGE.collect = collect_callback_oldest_age
+    metrics.CALLBACKS_FAILED.collect = collect_callbacks_failed
+    fapp.LOG_INDEX = LogIndex(os.path.join(APP_DATA, 'logindex'), LOG_DATA)
+    fapp.LOG_INDEX.start()
+    request_metrics.start_watchdog()
+    # 发送任务子进程留下的回调（包括上次退出前没有发送成功的）
+    fapp.CALLBACK_DISPATCHER = CallbackDispatcher(
+        get_callback_spool(),
+        retry_delay=config.CALLBACK_RETRY_DELAY,
+        max_delay=config.CALLBACK_RETRY_MAX_DELAY,
+        max_attempts=config.CALLBACK_MAX_ATTEMPTS,
+    )
+    fapp.CALLBACK_DISPATCHER.start()
+    # 关闭空闲的 SSH 连接
+    get_ssh_broker().start()
+    # SSH 连接保持在主进程中，任务子进程通过本地代理使用，必须在启动任务之前
+    if config.SSH_IDLE_TIMEOUT and config.SSH_PROXY:
+        try:
+            SSHProxy(get_ssh_broker()).start()
+        except Exception:
+            fapp.logger.warn(u'启动 SSH 代理失败', exc_info=True)
 
     global http_greenlet, https_greenlet
     http_greenlet = gevent.spawn(http_server.serve_forever)
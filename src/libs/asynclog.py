@@ -0,0 +1,265 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+异步日志
+Python 2 没有 logging.handlers.QueueHandler / QueueListener，这里实现一个简化版本:
+- QueueHandler 包装实际的处理器（文件、终端），记录日志时只把记录放进队列，不做任何 IO；
+- 每个进程一个写线程（LogWriter），成批取出记录交给实际的处理器写入（包括日志滚动），
+  一批写完后每个处理器只 flush 一次；
+- 队列有长度上限，满了以后按策略丢弃，并分级别计数；
+注意:
+- 任务子进程是 fork 出来的，不会继承写线程，入队时发现进程变了就重建队列和写线程；
+- 进程退出前应当调用 flush()，否则队列中还没有写入的记录会丢失（atexit 会调用一次）；
+'''
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# 队列满时的处理策略
+# drop_debug: 优先丢弃队列中级别最低（DEBUG）的记录，没有可丢弃的就丢弃新记录
+# drop_new: 丢弃新记录
+# block: 等待写线程写入（最多 BLOCK_TIMEOUT 秒），不要在 gevent 服务器中使用
+OVERFLOW_POLICIES = ('drop_debug', 'drop_new', 'block', )
+BLOCK_TIMEOUT = 5
+# 单批最多写入的记录数
+BATCH_SIZE = 256
+
+_CALL = object()
+
+
+def _noop():
+    pass
+
+
+class LogWriter(object):
+    '''一个进程内所有 QueueHandler 共用的队列和写线程'''
+
+    def __init__(self, maxsize=10000, policy='drop_debug'):
+        if policy not in OVERFLOW_POLICIES:
+            policy = 'drop_debug'
+        self.maxsize = maxsize
+        self.policy = policy
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        # 写线程正在写入一批记录
+        self._busy = False
+        # 队列中 DEBUG 级别记录的数量，没有时队列满了不需要查找可丢弃的记录
+        self._debug_count = 0
+        self.written = 0
+        self.dropped = {}
+
+    def _ensure_thread(self):
+        if os.getpid() != self._pid:
+            # fork 出来的子进程，父进程的队列和写线程都不可用
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='LogWriter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _drop(self, record):
+        name = logging.getLevelName(record.levelno)
+        self.dropped[name] = self.dropped.get(name, 0) + 1
+
+    def _make_room(self, record):
+        '''队列满时按策略腾出空间，返回 False 表示丢弃新记录'''
+        if self.policy == 'block':
+            deadline = time.time() + BLOCK_TIMEOUT
+            while len(self._queue) >= self.maxsize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+        if self.policy == 'drop_debug' and self._debug_count\
+                and record.levelno > logging.DEBUG:
+            # 丢弃队列中最早的一条 DEBUG 记录
+            for item in self._queue:
+                queued = item[0]
+                if queued is not _CALL and queued.levelno <= logging.DEBUG:
+                    self._queue.remove(item)
+                    self._debug_count -= 1
+                    self._drop(queued)
+                    return True
+        return False
+
+    def put(self, record, handler):
+        '''放入一条记录，不等待写入'''
+        self._ensure_thread()
+        with self._cond:
+            if len(self._queue) >= self.maxsize\
+                    and not self._make_room(record):
+                self._drop(record)
+                return
+            self._queue.append((record, handler))
+            if record.levelno <= logging.DEBUG:
+                self._debug_count += 1
+            self._cond.notify_all()
+
+    def call(self, func, timeout=BLOCK_TIMEOUT):
+        '''
+        在写线程中调用 func，之前入队的记录都会先写完
+        用于关闭处理器、释放文件等需要与写入保持顺序的操作
+        '''
+        self._ensure_thread()
+        done = threading.Event()
+        with self._cond:
+            self._queue.append((_CALL, (func, done)))
+            self._cond.notify_all()
+        done.wait(timeout)
+
+    def close_handler(self, handler, timeout=BLOCK_TIMEOUT):
+        '''写完这个处理器已经入队的记录后关闭它'''
+        self.call(handler.close, timeout=timeout)
+
+    def flush(self, timeout=BLOCK_TIMEOUT):
+        '''等待队列中已有的记录写完'''
+        if os.getpid() != self._pid or self._thread is None:
+            return
+        deadline = time.time() + timeout
+        with self._cond:
+            while (self._queue or self._busy) and time.time() < deadline:
+                self._cond.wait(0.1)
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'written': self.written,
+            'dropped': dict(self.dropped),
+            'policy': self.policy,
+            'maxsize': self.maxsize,
+        }
+
+    def _run(self):
+        queue, cond = self._queue, self._cond
+        while True:
+            with cond:
+                while not queue:
+                    cond.wait(1)
+                batch = []
+                while queue and len(batch) < BATCH_SIZE:
+                    item = queue.popleft()
+                    if item[0] is not _CALL and item[0].levelno <= logging.DEBUG:
+                        self._debug_count -= 1
+                    batch.append(item)
+                self._busy = True
+                # 唤醒等待 block 的线程
+                cond.notify_all()
+            try:
+                self._write(batch)
+            finally:
+                with cond:
+                    self._busy = False
+                    # 唤醒等待 flush 的线程
+                    cond.notify_all()
+
+    def _write(self, batch):
+        handlers = []
+        for record, handler in batch:
+            if record is _CALL:
+                func, done = handler
+                self._flush_handlers(handlers)
+                handlers = []
+                try:
+                    func()
+                except Exception:
+                    pass
+                finally:
+                    done.set()
+                continue
+            if handler not in handlers:
+                handlers.append(handler)
+                # 一批记录写完后再统一 flush
+                handler.flush = _noop
+            try:
+                handler.handle(record)
+                self.written += 1
+            except Exception:
+                handler.handleError(record)
+        self._flush_handlers(handlers)
+
+    def _flush_handlers(self, handlers):
+        for handler in handlers:
+            del handler.flush
+            try:
+                handler.flush()
+            except Exception:
+                pass
+
+
+class QueueHandler(logging.Handler):
+    '''
+    把日志记录放进 LogWriter 的队列，由写线程交给 target 处理
+    target: 实际的处理器，例如 RotatingFileHandler
+    '''
+
+    def __init__(self, target, writer):
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.writer = writer
+
+    def prepare(self, record):
+        '''
+        在当前线程格式化消息和异常，避免参数对象在写入前被修改
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.writer.put(self.prepare(record), self.target)
+        except Exception:
+            self.handleError(record)
+
+    def setLevel(self, level):
+        logging.Handler.setLevel(self, level)
+        self.target.setLevel(level)
+
+    def close(self):
+        self.writer.close_handler(self.target)
+        logging.Handler.close(self)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer(maxsize=10000, policy='drop_debug'):
+    '''获取本进程的 LogWriter'''
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter(maxsize=maxsize, policy=policy)
+            atexit.register(_writer.flush)
+    return _writer
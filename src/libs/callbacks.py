@@ -0,0 +1,256 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+任务结果回调的持久化队列
+任务子进程只把回调写入队列目录，写完即可退出；主进程的后台线程负责发送，失败后按退避时间重试。
+回调的种类:
+- post: POST 表单到回调地址（callback_url / error_callback_url）；
+- xapi: 调用站点的回调脚本（return_script / error_script）；
+注意:
+- 每个回调是队列目录中的一个 workerdb 文件（token 加密保存），文件名以创建时间开头，按名字排序即先后顺序；
+- 写入时先写临时文件再改名，后台线程不会读到写了一半的回调；
+- 网络错误、5xx、回调脚本返回错误时重试，等待时间每次加倍，超过最大次数后移到 failed 目录；
+  4xx 视为不可重试，直接移到 failed 目录；
+- 同一轮中发往同一个目标（回调地址的主机、站点）的回调连续发送，复用同一个连接；
+  回调接口不支持一次提交多个结果，所以仍然逐个发送；
+'''
+
+import logging
+import os
+import shutil
+import threading
+import time
+import urlparse
+import uuid
+
+import requests
+
+from libs import workerdb
+from libs.scriptcache import ensure_dir
+
+log = logging.getLogger(__name__)
+
+# 回调的 HTTP 超时（秒）
+CALLBACK_TIMEOUT = 30
+
+
+class CallbackError(Exception):
+    '''
+    回调失败
+    retry: 是否可以重试
+    '''
+
+    def __init__(self, message, retry=True):
+        super(CallbackError, self).__init__(message)
+        self.retry = retry
+
+
+class CallbackSpool(object):
+    '''回调队列目录，任务子进程写入，主进程读取'''
+
+    def __init__(self, root):
+        self.root = root
+        self.failed_dir = os.path.join(root, 'failed')
+        ensure_dir(self.failed_dir)
+
+    def put(self, kind, **fields):
+        '''加入一个回调，返回回调的 ID'''
+        now = time.time()
+        callback_id = '{:.6f}-{}'.format(now, uuid.uuid4().hex)
+        entry = workerdb.dbopen(os.path.join(self.root, callback_id + '.db'))
+        entry.update(fields)
+        entry.update({
+            'kind': kind,
+            'created': now,
+            'attempts': 0,
+            'next_attempt': now,
+        })
+        entry.sync()
+        return callback_id
+
+    def list(self):
+        '''按加入的先后顺序返回所有等待发送的回调'''
+        entries = []
+        for name in sorted(os.listdir(self.root)):
+            if not name.endswith('.db'):
+                continue
+            try:
+                entries.append(workerdb.dbopen(os.path.join(self.root, name)))
+            except Exception:
+                log.warn(u'读取回调 %s 出错', name, exc_info=True)
+        return entries
+
+    def remove(self, entry):
+        try:
+            os.remove(entry.filename)
+        except OSError:
+            pass
+
+    def fail(self, entry):
+        '''放弃发送，移到 failed 目录中保留'''
+        shutil.move(entry.filename, os.path.join(
+            self.failed_dir, os.path.basename(entry.filename)
+        ))
+
+    def stats(self, now=None):
+        '''等待发送的回调数量、最早的回调已经等待的时间、失败的回调数量'''
+        now = now or time.time()
+        names = [n for n in os.listdir(self.root) if n.endswith('.db')]
+        oldest = min(names) if names else None
+        return {
+            'queued': len(names),
+            'oldest_age': now - float(oldest.split('-', 1)[0]) if oldest else 0,
+            'failed': len([
+                n for n in os.listdir(self.failed_dir) if n.endswith('.db')
+            ]),
+        }
+
+
+def destination(entry):
+    '''回调的发送目标，同一个目标的回调一起发送'''
+    if entry['kind'] == 'post':
+        return ('post', urlparse.urlsplit(entry['url']).netloc)
+    return ('xapi', entry.get('oc_server'), entry.get('account'),
+            entry.get('instance'))
+
+
+def send_post(entry, session):
+    try:
+        resp = session.post(
+            entry['url'], data=entry.get('data') or {},
+            headers=entry.get('headers') or {}, timeout=CALLBACK_TIMEOUT,
+        )
+    except requests.RequestException as e:
+        raise CallbackError(repr(e))
+    if resp.status_code >= 500:
+        raise CallbackError(u'HTTP {}'.format(resp.status_code))
+    if resp.status_code >= 400:
+        raise CallbackError(u'HTTP {}'.format(resp.status_code), retry=False)
+    return u'HTTP {}: {}'.format(resp.status_code, resp.content[:200])
+
+
+def send_xapi(entry, session):
+    from utils import get_site_client
+    wo_client = get_site_client(
+        'workonline', entry['oc_server'], entry['account'],
+        entry['instance'], entry.get('token'),
+    )
+    try:
+        result = wo_client.xapi(entry['script'], **(entry.get('params') or {}))
+    except Exception as e:
+        raise CallbackError(repr(e))
+    if result.get('errcode') != 0:
+        raise CallbackError(result.get('errmsg', '') or repr(result))
+    return result
+
+
+SENDERS = {
+    'post': send_post,
+    'xapi': send_xapi,
+}
+
+
+class CallbackDispatcher(object):
+    '''
+    主进程中发送回调的后台线程
+    retry_delay: 第一次重试前等待的秒数，之后每次加倍，最多 max_delay 秒
+    max_attempts: 最多尝试的次数
+    '''
+
+    def __init__(
+        self, spool, retry_delay=10, max_delay=60 * 60, max_attempts=10,
+        senders=None,
+    ):
+        self.spool = spool
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.senders = senders or SENDERS
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def dispatch(self, now=None):
+        '''发送所有到了发送时间的回调，返回成功发送的数量'''
+        now = now or time.time()
+        groups = {}
+        for entry in self.spool.list():
+            if entry.get('next_attempt', 0) <= now:
+                groups.setdefault(destination(entry), []).append(entry)
+        sent = 0
+        for entries in groups.values():
+            # 同一个目标共用一个 HTTP 连接
+            session = requests.Session()
+            try:
+                for entry in entries:
+                    sent += self._send(entry, session, now)
+            finally:
+                session.close()
+        return sent
+
+    def _send(self, entry, session, now):
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        try:
+            result = self.senders[entry['kind']](entry, session)
+        except CallbackError as e:
+            error, retry = unicode(e), e.retry
+        except Exception as e:
+            error, retry = repr(e), True
+        else:
+            log.info(
+                u'任务 #%s 的回调已发送（第 %s 次尝试）: %s',
+                entry.get('worker_id'), entry['attempts'], result
+            )
+            self.spool.remove(entry)
+            return 1
+
+        entry['last_error'] = error
+        if not retry or entry['attempts'] >= self.max_attempts:
+            log.error(
+                u'任务 #%s 的回调失败 %s 次，放弃发送: %s',
+                entry.get('worker_id'), entry['attempts'], error
+            )
+            entry.sync()
+            self.spool.fail(entry)
+        else:
+            delay = min(
+                self.retry_delay * 2 ** (entry['attempts'] - 1), self.max_delay
+            )
+            entry['next_attempt'] = now + delay
+            entry.sync()
+            log.warn(
+                u'任务 #%s 的回调失败（第 %s 次尝试），%s 秒后重试: %s',
+                entry.get('worker_id'), entry['attempts'], delay, error
+            )
+        return 0
+
+    def start(self, interval=2):
+        '''启动后台发送线程'''
+        def run():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.dispatch()
+                except Exception:
+                    log.warn(u'发送回调出错', exc_info=True)
+
+        self._thread = threading.Thread(target=run, name='CallbackDispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
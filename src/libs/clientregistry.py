@@ -0,0 +1,130 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+edo_client 客户端的进程内复用
+每次创建客户端（edo_client.get_client 还要先查询服务地址）都要重新建立 TLS 连接，
+复用同一个站点、同一个 token 的客户端，可以复用客户端中保持的 HTTP 连接。
+注意:
+- 以 (服务, oc_server, account, instance, token 的 sha1) 为键，token 本身不保存在键中；
+- 客户端超过 ttl 秒后重新创建，最多保留 maxsize 个，最久没有使用的先淘汰；
+- 每个进程一份: fork 出的子进程第一次使用时清空，不会与父进程共用连接；
+- token 信息（get_token_info）和用户信息缓存 token_info_ttl 秒，调用失败的结果不缓存；
+'''
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from libs.metrics import EDO_CLIENTS
+
+
+def token_hash(token):
+    if token is None:
+        return None
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha1(token).hexdigest()
+
+
+class ClientRegistry(object):
+
+    def __init__(self, maxsize=64, ttl=60 * 60, token_info_ttl=5 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.token_info_ttl = token_info_ttl
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # {键: (创建时间, 客户端)}
+        self._clients = OrderedDict()
+        # {键: (过期时间, token 信息)}
+        self._token_info = {}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def get(self, application, oc_server, account, instance, token, factory):
+        '''
+        返回复用的客户端，没有或者已经过期时调用 factory() 创建
+        '''
+        key = (
+            application, oc_server, account, instance, token_hash(token),
+        )
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            item = self._clients.pop(key, None)
+            if item is not None and now - item[0] <= self.ttl:
+                # 移到末尾，表示最近使用过
+                self._clients[key] = item
+                EDO_CLIENTS.inc((application, 'reused', ))
+                return item[1]
+        # 创建客户端可能要请求服务器，不在锁内进行
+        client = factory()
+        EDO_CLIENTS.inc((application, 'new', ))
+        with self._lock:
+            self._clients[key] = (now, client)
+            while len(self._clients) > self.maxsize:
+                self._clients.popitem(last=False)
+        return client
+
+    def get_token_info(
+        self, oc_server, account, instance, token, fetch, kind='token_info'
+    ):
+        '''
+        返回缓存的 token 信息，没有或已经过期时调用 fetch() 获取
+        kind: 信息的种类，同一个 token 的其他信息（例如用户信息）也可以缓存
+        '''
+        key = (kind, oc_server, account, instance, token_hash(token))
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            item = self._token_info.get(key)
+            if item is not None and item[0] > now:
+                return item[1]
+        info = fetch()
+        with self._lock:
+            # 顺便清理已经过期的信息
+            for expired in [
+                k for k, v in self._token_info.items() if v[0] <= now
+            ]:
+                self._token_info.pop(expired)
+            self._token_info[key] = (now + self.token_info_ttl, info)
+        return info
+
+    def forget(self, token):
+        '''token 失效或登出时，移除使用这个 token 的客户端和 token 信息'''
+        digest = token_hash(token)
+        with self._lock:
+            for key in [k for k in self._clients if k[-1] == digest]:
+                self._clients.pop(key)
+            for key in [k for k in self._token_info if k[-1] == digest]:
+                self._token_info.pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'token_info': len(self._token_info),
+            }
@@ -0,0 +1,89 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+脚本编译结果（code object）的磁盘缓存
+脚本每次运行都要重新解析、编译，源码不变时可以直接加载上次编译的结果。
+注意:
+- 以源码、文件名、编译模式和解释器的字节码版本（imp.get_magic()）的 sha1 为文件名，
+  源码变化或者升级解释器后自动使用新的缓存；
+- 用 marshal 保存，与 .pyc 相同，加载时不需要解析和编译；
+- 缓存保存在磁盘上，所有任务子进程共用，总大小超过 max_bytes 时删除最久没有使用的文件；
+'''
+
+import hashlib
+import imp
+import logging
+import marshal
+import os
+import platform
+import types
+
+from libs.scriptcache import atomic_write, ensure_dir, trim_directory
+
+log = logging.getLogger(__name__)
+
+# 解释器实现和字节码版本，不同的解释器生成的 code object 不能通用
+INTERPRETER = '{}-{}'.format(
+    platform.python_implementation(), imp.get_magic().encode('hex')
+)
+
+
+class CodeCache(object):
+
+    def __init__(self, root, max_bytes=20 * 2 ** 20):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        ensure_dir(root)
+
+    def _path(self, source, filename, mode):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        digest = hashlib.sha1('\0'.join([
+            INTERPRETER, filename, mode, source,
+        ])).hexdigest()
+        return os.path.join(self.root, digest + '.code')
+
+    def compile(self, source, filename='<script>', mode='exec'):
+        '''与内置的 compile 相同（不支持 flags 参数），源码没有变化时直接加载缓存'''
+        path = self._path(source, filename, mode)
+        try:
+            with open(path, 'rb') as f:
+                code = marshal.load(f)
+            # 残缺或无关的文件也可能加载出其他类型的对象，不能交给 exec
+            if not isinstance(code, types.CodeType):
+                raise ValueError(path)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            self.hits += 1
+            return code
+
+        self.misses += 1
+        code = compile(source, filename, mode)
+        try:
+            atomic_write(path, marshal.dumps(code))
+            trim_directory(self.root, self.max_bytes)
+        except (IOError, OSError):
+            log.warn(u'保存脚本 %s 的编译结果失败', filename, exc_info=True)
+        return code
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
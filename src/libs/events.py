@@ -0,0 +1,106 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+任务状态变化的事件流
+主进程中只有一个实例，挂在 Flask app 上（current_app.WORKER_EVENTS）
+注意:
+- 每个事件带有递增的序号（seq），客户端断线后可以从上次收到的序号继续；
+- 只在内存中保留最近 `maxlen` 个事件，站点机器人重启后序号从 1 开始；
+- 事件可能由监视线程、消息提醒线程等非 gevent 线程发布，
+  所以等待时按 `interval` 分片检查，而不是依赖跨线程唤醒；
+- INTERNAL_STATES 中的状态（例如重试 retry）只用于统计，只通知订阅者，
+  不进入客户端（/worker/wait、/worker/events）的事件流，也不占用序号；
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# 只用于统计的状态，客户端看不到
+INTERNAL_STATES = ('retry', )
+
+
+class EventFeed(object):
+    '''任务状态变化的事件流'''
+
+    def __init__(self, maxlen=1000, sleep=time.sleep, interval=0.2):
+        '''
+        sleep: 等待时使用的 sleep 函数，在 gevent 服务器中应当传入 gevent.sleep
+        interval: 等待时检查新事件的间隔（秒）
+        '''
+        self.sleep = sleep
+        self.interval = interval
+        self.last_seq = 0
+        self._events = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        '''每个事件发布后调用 callback(event)，用于统计等，callback 不应当阻塞'''
+        self._subscribers.append(callback)
+
+    def publish(self, worker_id, state, **extra):
+        '''发布一个任务状态变化事件，返回这个事件（INTERNAL_STATES 的事件没有 seq）'''
+        event = {
+            'worker_id': str(worker_id),
+            'state': state,
+            'time': time.time(),
+        }
+        event.update(extra)
+        if state not in INTERNAL_STATES:
+            with self._lock:
+                self.last_seq += 1
+                event['seq'] = self.last_seq
+                self._events.append(event)
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception:
+                log.warn(u'处理任务状态事件出错: %s', event, exc_info=True)
+        return event
+
+    def since(self, seq=0, worker_id=None):
+        '''
+        返回序号大于 seq 的事件
+        seq 大于当前最大序号时，说明站点机器人重启过，从头返回
+        '''
+        seq = int(seq or 0)
+        with self._lock:
+            if seq > self.last_seq:
+                seq = 0
+            events = [e for e in self._events if e['seq'] > seq]
+        if worker_id is not None:
+            worker_id = str(worker_id)
+            events = [e for e in events if e['worker_id'] == worker_id]
+        return events
+
+    def wait(self, seq=0, worker_id=None, timeout=30):
+        '''
+        等待序号大于 seq 的事件，超时返回空列表
+        '''
+        deadline = time.time() + timeout
+        while True:
+            events = self.since(seq, worker_id=worker_id)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return events
+            self.sleep(min(self.interval, remaining))
@@ -0,0 +1,179 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+结构化日志（JSON lines）
+- 每行一个 JSON 对象，time 固定在最前面，方便按行首时间排序和建索引；
+- 上下文（任务 ID、脚本名、站点、MQTT 消息 ID、关联 ID）由 ContextFilter 加到日志记录上；
+- 上下文保存在线程局部变量中：主进程中每个处理线程（greenlet 不切换线程）各自设置，
+  任务子进程在入口设置一次；
+- parse_log_line / iter_log_records 同时支持 JSON 和原有的文本格式；
+'''
+
+import json
+import logging
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+
+# 日志记录上的上下文字段
+CONTEXT_FIELDS = (
+    'worker_id', 'script_name', 'site', 'mqtt_msg_id', 'correlation_id',
+)
+# 文件日志的文本格式: '%(asctime)s (L%(lineno)d) %(threadName)s %(levelname)s %(message)s'
+TEXT_LINE_PATTERN = re.compile(
+    r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:,\d+)?) \(L(\d+)\) (\S+) ([A-Z]+) ?(.*)$',
+    re.DOTALL
+)
+
+_local = threading.local()
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+
+def get_log_context():
+    '''当前线程的日志上下文'''
+    context = getattr(_local, 'context', None)
+    if context is None:
+        context = _local.context = {}
+    return context
+
+
+def set_log_context(**kw):
+    '''更新当前线程的日志上下文，值为 None 的字段会被删除'''
+    context = get_log_context()
+    for key, value in kw.items():
+        if value is None:
+            context.pop(key, None)
+        else:
+            context[key] = value
+
+
+@contextmanager
+def log_context(**kw):
+    '''在 with 块内临时设置日志上下文，退出后恢复'''
+    previous = dict(get_log_context())
+    set_log_context(**kw)
+    try:
+        yield get_log_context()
+    finally:
+        _local.context = previous
+
+
+class ContextFilter(logging.Filter):
+    '''
+    把日志上下文加到日志记录上，不过滤任何记录
+    defaults: 这个 logger 固定的上下文，例如任务日志的 worker_id
+    注意: 需要加在 logger 上（而不是处理器上），保证在记录日志的线程中执行
+    '''
+
+    def __init__(self, **defaults):
+        logging.Filter.__init__(self)
+        self.defaults = defaults
+
+    def filter(self, record):
+        context = get_log_context()
+        for key in CONTEXT_FIELDS:
+            if getattr(record, key, None) is None:
+                value = context.get(key, self.defaults.get(key))
+                setattr(record, key, value)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    '''每条日志记录格式化为一行 JSON'''
+
+    def __init__(self, datefmt=None):
+        logging.Formatter.__init__(self, datefmt=datefmt)
+
+    def format(self, record):
+        data = {
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'pid': record.process,
+            'file': record.filename,
+            'line': record.lineno,
+            'msg': record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        # json.dumps 会转义换行，traceback 也只占一行
+        return '{{"time": "{}", {}'.format(
+            self.formatTime(record, self.datefmt),
+            json.dumps(data, separators=(', ', ': '))[1:]
+        )
+
+
+def parse_log_line(line):
+    '''
+    解析一行日志，返回字典（字段同 JSONFormatter），无法解析的行返回 None
+    文本格式的日志没有上下文字段，traceback 等续行也返回 None
+    '''
+    line = line.rstrip('\r\n')
+    if line.startswith('{'):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+    match = TEXT_LINE_PATTERN.match(line)
+    if match is None:
+        return None
+    stamp, lineno, thread, level, msg = match.groups()
+    return {
+        'time': stamp,
+        'line': int(lineno),
+        'thread': thread,
+        'level': level,
+        'msg': msg,
+    }
+
+
+def iter_log_records(lines, **conditions):
+    '''
+    逐条解析日志，文本格式中无法解析的续行（如 traceback）会合并到上一条记录的 msg 中
+    conditions: 只返回这些字段相等的记录，例如 correlation_id='...'
+    '''
+    record = None
+    for line in lines:
+        parsed = parse_log_line(line)
+        if parsed is None:
+            if record is not None:
+                record['msg'] += '\n' + line.rstrip('\r\n')
+            continue
+        if record is not None and _match(record, conditions):
+            yield record
+        record = parsed
+    if record is not None and _match(record, conditions):
+        yield record
+
+
+def _match(record, conditions):
+    for key, value in conditions.items():
+        if record.get(key) != value:
+            return False
+    return True
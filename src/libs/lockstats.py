@@ -0,0 +1,221 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+锁服务的争用统计
+记录每个锁的加锁次数、失败次数、持有时间、等待时间，以及当前的等待队列。
+注意:
+- 所有的时间样本只保留最近 `window` 秒，且每个锁最多保留 `max_samples` 个，内存占用有上限；
+- 加锁接口是非阻塞的，客户端（ui_client.acquire_lock）每秒重试一次，
+  因此等待时间 = 成功加锁的时间 - 第一次加锁失败的时间；
+- 超过 `waiter_ttl` 秒没有再次尝试加锁的等待者，视为已经放弃等待；
+'''
+
+import threading
+import time
+from collections import deque
+
+from libs.metrics import LOCK_HOLD, LOCK_WAIT
+
+# 直方图的桶（以秒计）
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, float('inf'))
+
+
+def percentile(values, p):
+    '''取出已排序列表中的百分位数'''
+    if not values:
+        return None
+    index = int(round((len(values) - 1) * p / 100.0))
+    return values[index]
+
+
+def histogram(values, buckets=BUCKETS):
+    '''按桶统计样本数（累积计数，与 Prometheus 的直方图一致）'''
+    counts = []
+    for bound in buckets:
+        counts.append([
+            '+Inf' if bound == float('inf') else bound,
+            len([v for v in values if v <= bound]),
+        ])
+    return counts
+
+
+class _LockRecord(object):
+    '''一个锁的统计数据'''
+
+    def __init__(self, max_samples):
+        self.acquisitions = 0
+        self.failures = 0
+        self.abandoned = 0
+        self.last_used = time.time()
+        # 滚动窗口内的样本: (时间戳, 值)
+        self.acquire_events = deque(maxlen=max_samples)
+        self.failure_events = deque(maxlen=max_samples)
+        self.hold_times = deque(maxlen=max_samples)
+        self.wait_times = deque(maxlen=max_samples)
+        # 等待队列: {worker_id: {'since', 'last_attempt', 'attempts'}}
+        self.waiters = {}
+
+
+class LockStats(object):
+    '''
+    锁服务的争用统计
+    主进程中只有一个实例，挂在 Flask app 上（current_app.LOCK_STATS）
+    '''
+
+    def __init__(self, window=60 * 60, max_samples=512, max_locks=1024, waiter_ttl=5):
+        self.window = window
+        self.max_samples = max_samples
+        self.max_locks = max_locks
+        self.waiter_ttl = waiter_ttl
+        self._records = {}
+        # 监视线程与请求处理可能同时访问
+        self._lock = threading.Lock()
+
+    def _get_record(self, lock_name, now):
+        record = self._records.get(lock_name, None)
+        if record is None:
+            if len(self._records) >= self.max_locks:
+                self._evict()
+            record = self._records[lock_name] = _LockRecord(self.max_samples)
+        record.last_used = now
+        return record
+
+    def _evict(self):
+        '''清理最久没有使用、且没有等待者的锁的统计'''
+        idle = [
+            (record.last_used, name) for name, record in self._records.items()
+            if not record.waiters
+        ]
+        if idle:
+            self._records.pop(min(idle)[1])
+
+    def _expire(self, record, now):
+        '''清理滚动窗口外的样本和已经放弃的等待者'''
+        for samples in (
+            record.acquire_events, record.failure_events,
+            record.hold_times, record.wait_times,
+        ):
+            while samples and now - samples[0][0] > self.window:
+                samples.popleft()
+        for worker_id, waiter in record.waiters.items():
+            if now - waiter['last_attempt'] > self.waiter_ttl:
+                record.waiters.pop(worker_id)
+                record.abandoned += 1
+
+    def record_attempt(self, lock_name, worker_id, acquired, now=None):
+        '''记录一次加锁尝试'''
+        now = now or time.time()
+        worker_id = str(worker_id)
+        with self._lock:
+            record = self._get_record(lock_name, now)
+            self._expire(record, now)
+            waiter = record.waiters.get(worker_id, None)
+            if acquired:
+                record.acquisitions += 1
+                record.acquire_events.append((now, 1))
+                if waiter is not None:
+                    record.waiters.pop(worker_id)
+                    wait_time = now - waiter['since']
+                else:
+                    wait_time = 0.0
+                record.wait_times.append((now, wait_time))
+                LOCK_WAIT.observe(wait_time)
+            else:
+                record.failures += 1
+                record.failure_events.append((now, 1))
+                if waiter is None:
+                    record.waiters[worker_id] = {
+                        'since': now, 'last_attempt': now, 'attempts': 1,
+                    }
+                else:
+                    waiter['last_attempt'] = now
+                    waiter['attempts'] += 1
+
+    def record_release(self, lock_name, lock, now=None):
+        '''
+        记录一次解锁
+        lock: LOCKS 中保存的锁信息，其中 since 是加锁的时间
+        '''
+        now = now or time.time()
+        since = lock.get('since', None)
+        if since is None:
+            return
+        hold_time = now - time.mktime(since.timetuple()) - since.microsecond / 1e6
+        LOCK_HOLD.observe(max(hold_time, 0.0))
+        with self._lock:
+            record = self._get_record(lock_name, now)
+            record.hold_times.append((now, max(hold_time, 0.0)))
+
+    def forget_worker(self, worker_id):
+        '''任务结束，将其从所有锁的等待队列中移除'''
+        worker_id = str(worker_id)
+        with self._lock:
+            for record in self._records.values():
+                record.waiters.pop(worker_id, None)
+
+    def get_stats(self, locks=None, now=None):
+        '''
+        返回所有锁的统计信息
+        locks: 当前的锁表（current_app.LOCKS），用于补充持有者信息
+        '''
+        now = now or time.time()
+        locks = locks or {}
+        stats = {}
+        with self._lock:
+            for lock_name, record in self._records.items():
+                self._expire(record, now)
+                hold_times = sorted(v for _t, v in record.hold_times)
+                wait_times = sorted(v for _t, v in record.wait_times)
+                holder = locks.get(lock_name, None)
+                stats[lock_name] = {
+                    'holder': holder and str(holder['worker_id']),
+                    'acquisitions': record.acquisitions,
+                    'failures': record.failures,
+                    'abandoned': record.abandoned,
+                    'window': {
+                        'seconds': self.window,
+                        'acquisitions': len(record.acquire_events),
+                        'failures': len(record.failure_events),
+                    },
+                    'waiters': [
+                        {
+                            'worker_id': worker_id,
+                            'waiting': now - waiter['since'],
+                            'attempts': waiter['attempts'],
+                        }
+                        for worker_id, waiter in sorted(
+                            record.waiters.items(), key=lambda i: i[1]['since']
+                        )
+                    ],
+                    'hold_time': {
+                        'count': len(hold_times),
+                        'p50': percentile(hold_times, 50),
+                        'p95': percentile(hold_times, 95),
+                        'max': hold_times[-1] if hold_times else None,
+                        'histogram': histogram(hold_times),
+                    },
+                    'wait_time': {
+                        'count': len(wait_times),
+                        'p50': percentile(wait_times, 50),
+                        'p95': percentile(wait_times, 95),
+                        'max': wait_times[-1] if wait_times else None,
+                        'histogram': histogram(wait_times),
+                    },
+                }
+        return stats
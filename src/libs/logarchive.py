@@ -0,0 +1,289 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+日志归档
+滚动方式与 RotatingFileHandler(backupCount=1) 兼容: xxx.log 写满后重命名为 xxx.log.1；
+在此之前，旧的 xxx.log.1 重命名为 xxx.log.<inode>，由后台线程压缩为 xxx.log.<inode>.gz。
+注意:
+- 归档文件名中的 inode 是压缩前的 inode，增量读取（logtail）和索引（logindex）
+  都用 inode 区分日志，压缩后仍然能按 inode 找到对应的归档；
+- 归档的先后顺序按文件修改时间，压缩后保留原文件的修改时间；
+- 任务子进程退出时可能还有没压缩完的归档，由 clean_archives 补上；
+'''
+
+import gzip
+import logging
+import logging.handlers
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# xxx.log.<inode> 或 xxx.log.<inode>.gz，不包括 xxx.log.1
+ARCHIVE_PATTERN = re.compile(r'^(.+\.log)\.(\d{2,})(\.gz)?$')
+# 没有压缩的归档超过这个时间（秒），才认为是遗留的
+PENDING_GRACE = 60
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def archive_path(log_file, inode, compressed=True):
+    path = '{}.{}'.format(log_file, inode)
+    return path + '.gz' if compressed else path
+
+
+def open_log(path):
+    '''打开日志文件或归档（只读），归档透明解压'''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def log_size(path):
+    '''日志文件（解压后）的大小，文件不存在返回 None'''
+    stat = _stat(path)
+    if stat is None:
+        return None
+    if not path.endswith('.gz'):
+        return stat.st_size
+    # gzip 结尾 4 个字节是原始大小（模 2^32），日志不会这么大
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def find_segment(log_file, inode):
+    '''
+    按 inode 找到日志的某一段: xxx.log、xxx.log.1，或者已经归档的 xxx.log.<inode>[.gz]
+    找不到返回 None
+    '''
+    inode = int(inode)
+    for path in (log_file, '{}.1'.format(log_file)):
+        stat = _stat(path)
+        if stat is not None and stat.st_ino == inode:
+            return path
+    for path in (archive_path(log_file, inode, False), archive_path(log_file, inode)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def list_archives(log_file):
+    '''日志的所有归档（包括还没有压缩的），按时间从旧到新'''
+    dirname, basename = os.path.split(log_file)
+    archives = []
+    try:
+        filenames = os.listdir(dirname)
+    except OSError:
+        return archives
+    for filename in filenames:
+        match = ARCHIVE_PATTERN.match(filename)
+        if match is None or match.group(1) != basename:
+            continue
+        path = os.path.join(dirname, filename)
+        stat = _stat(path)
+        if stat is not None:
+            archives.append((stat.st_mtime, path))
+    return [archive for _mtime, archive in sorted(archives)]
+
+
+def list_segments(log_file):
+    '''日志所有的段，按时间从旧到新: 归档、xxx.log.1、xxx.log'''
+    segments = list_archives(log_file)
+    for path in ('{}.1'.format(log_file), log_file):
+        if os.path.isfile(path):
+            segments.append(path)
+    return segments
+
+
+def compress(path):
+    '''将 xxx.log.<inode> 压缩为 xxx.log.<inode>.gz，并删除原文件'''
+    stat = _stat(path)
+    if stat is None or path.endswith('.gz'):
+        return
+    target = path + '.gz'
+    tempname = target + '.tmp'
+    with open(path, 'rb') as src:
+        with open(tempname, 'wb') as raw:
+            with gzip.GzipFile(
+                os.path.basename(path), 'wb', fileobj=raw, mtime=stat.st_mtime
+            ) as dst:
+                shutil.copyfileobj(src, dst, 2 ** 16)
+    os.utime(tempname, (stat.st_atime, stat.st_mtime))
+    os.rename(tempname, target)
+    os.remove(path)
+
+
+class Archiver(object):
+    '''后台压缩线程，每个进程一个'''
+
+    def __init__(self):
+        self._pid = None
+        self._queue = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def submit(self, path):
+        with self._cond:
+            if self._pid != os.getpid():
+                # fork 出来的子进程，父进程的线程不可用
+                self._pid = os.getpid()
+                self._queue.clear()
+                self._thread = None
+            self._queue.append(path)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='LogArchiver'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait(1)
+                path = self._queue.popleft()
+            try:
+                compress(path)
+            except Exception:
+                log.warn(u'压缩日志 %s 出错', path, exc_info=True)
+
+
+_archiver = Archiver()
+
+
+class ArchivingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    滚动时保留旧的日志段并在后台压缩，其余行为与 RotatingFileHandler(backupCount=1) 相同
+    archiver: 负责压缩的 Archiver，默认使用本进程共用的
+    '''
+
+    def __init__(
+        self, filename, mode='a', maxBytes=0, encoding=None, delay=0,
+        archiver=None
+    ):
+        logging.handlers.RotatingFileHandler.__init__(
+            self, filename, mode=mode, maxBytes=maxBytes, backupCount=1,
+            encoding=encoding, delay=delay
+        )
+        self.archiver = archiver or _archiver
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        rotated = '{}.1'.format(self.baseFilename)
+        stat = _stat(rotated)
+        if stat is not None:
+            pending = archive_path(self.baseFilename, stat.st_ino, False)
+            # inode 被复用时，同名的归档一定更旧
+            for path in (pending, pending + '.gz'):
+                if os.path.exists(path):
+                    os.remove(path)
+            os.rename(rotated, pending)
+            self.archiver.submit(pending)
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, rotated)
+        if not self.delay:
+            self.stream = self._open()
+
+
+def remove_stale_temp(path):
+    '''删除压缩中途进程退出留下的临时文件，正在写入的（最近修改过）不删除'''
+    stat = _stat(path)
+    if stat is None or time.time() - stat.st_ctime < PENDING_GRACE:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def clean_archives(log_dir, max_segments, max_bytes, total_bytes):
+    '''
+    压缩遗留的归档，并删除超出限制的旧归档、压缩中途退出留下的临时文件（xxx.log.<inode>.gz.tmp）
+    max_segments: 每个日志最多保留的归档数
+    max_bytes: 每个日志的归档最多占用的字节数（压缩后）
+    total_bytes: 所有日志的归档最多占用的字节数（压缩后）
+    Return: 删除的归档数
+    '''
+    archives = {}
+    for filename in os.listdir(log_dir):
+        if filename.endswith('.gz.tmp'):
+            if ARCHIVE_PATTERN.match(filename[:-len('.tmp')]) is not None:
+                remove_stale_temp(os.path.join(log_dir, filename))
+            continue
+        match = ARCHIVE_PATTERN.match(filename)
+        if match is None:
+            continue
+        path = os.path.join(log_dir, filename)
+        if match.group(3) is None:
+            stat = _stat(path)
+            # 刚滚动的归档可能正在由后台线程压缩（重命名会更新 ctime）
+            if stat is None or time.time() - stat.st_ctime < PENDING_GRACE:
+                continue
+            try:
+                compress(path)
+            except (IOError, OSError):
+                log.warn(u'压缩日志 %s 出错', path, exc_info=True)
+                continue
+            path += '.gz'
+        stat = _stat(path)
+        if stat is not None:
+            archives.setdefault(match.group(1), []).append(
+                (stat.st_mtime, stat.st_size, path)
+            )
+
+    removed = []
+    kept = []
+    for items in archives.values():
+        items.sort(reverse=True)
+        size = 0
+        for index, item in enumerate(items):
+            size += item[1]
+            if index >= max_segments or size > max_bytes:
+                removed.append(item)
+            else:
+                kept.append(item)
+    # 总量超出限制时，从最旧的归档开始删除
+    size = sum(item[1] for item in kept)
+    for item in sorted(kept):
+        if size <= total_bytes:
+            break
+        size -= item[1]
+        removed.append(item)
+
+    for _mtime, _size, path in removed:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return len(removed)
@@ -0,0 +1,480 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+任务日志的倒排索引
+后台线程定时读取 worker_<id>.log 新写入的内容，分词后写入索引目录中不可变的段文件，
+搜索时只读取相关词的倒排表，再按位置读出日志行，不需要扫描所有日志文件。
+注意:
+- 日志行的位置用 (日志名, 文件 inode, 字节偏移) 表示，日志滚动（重命名为 .log.1）
+  不会改变 inode，所以滚动之前建立的索引仍然有效；旧的日志段归档压缩后，按 inode 仍然可以找到
+  （见 libs.logarchive）；文件被删除后，对应的索引在合并时清理；
+- 每个段的倒排表按 (日志文件, 偏移) 排序，以变长整数差值编码，时间也是差值编码；
+- 连续的英文数字作为一个词，中文按单字分词；搜索时所有词都要出现，再核对原文包含查询字符串；
+- 索引只是加速用的缓存，读取失败时直接丢弃重建；
+'''
+
+import json
+import logging
+import marshal
+import os
+import re
+import threading
+import time
+import zlib
+
+from libs.logarchive import find_segment, open_log
+
+log = logging.getLogger(__name__)
+
+LOG_NAME_PATTERN = re.compile(r'^(worker_(\d+))\.log$')
+TOKEN_PATTERN = re.compile(u'[a-z0-9_]{2,}|[\u4e00-\u9fff]', re.UNICODE)
+# 文本格式的行首时间，或 JSON 格式（libs.jsonlog）的 time 字段
+TIME_PATTERN = re.compile(r'^(?:\{"time": ")?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)')
+STATE_FILE = 'state.json'
+# 单次最多读取的字节数
+READ_SIZE = 2 ** 20
+
+
+def tokenize(text):
+    '''分词，返回去重后的词集合'''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+
+def parse_time(stamp):
+    '''将日志行开头的时间转为 Unix 时间戳'''
+    try:
+        return int(time.mktime(time.strptime(stamp, '%Y-%m-%d %H:%M:%S')))
+    except ValueError:
+        return None
+
+
+def encode_varints(numbers):
+    '''变长整数编码（非负整数）'''
+    data = bytearray()
+    for n in numbers:
+        while n >= 0x80:
+            data.append((n & 0x7f) | 0x80)
+            n >>= 7
+        data.append(n)
+    return bytes(data)
+
+
+def decode_varints(data):
+    numbers = []
+    n = shift = 0
+    for b in bytearray(data):
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            numbers.append(n)
+            n = shift = 0
+    return numbers
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def encode_postings(postings):
+    '''
+    编码一个词的倒排表
+    postings: [(文件序号, 偏移, 时间), ...]，按文件序号、偏移排序
+    同一文件内偏移和时间记录差值，换文件时记录绝对值
+    '''
+    numbers = []
+    last_file = last_offset = last_time = 0
+    for file_index, offset, line_time in postings:
+        numbers.append(file_index - last_file)
+        if file_index != last_file:
+            last_offset = last_time = 0
+        numbers.append(offset - last_offset)
+        numbers.append(_zigzag(line_time - last_time))
+        last_file, last_offset, last_time = file_index, offset, line_time
+    return encode_varints(numbers)
+
+
+def decode_postings(data):
+    numbers = decode_varints(data)
+    postings = []
+    file_index = offset = line_time = 0
+    for i in range(0, len(numbers) - 2, 3):
+        if numbers[i]:
+            file_index += numbers[i]
+            offset = line_time = 0
+        offset += numbers[i + 1]
+        line_time += _unzigzag(numbers[i + 2])
+        postings.append((file_index, offset, line_time))
+    return postings
+
+
+class Segment(object):
+    '''
+    一个不可变的索引段
+    files: [(日志名, inode), ...]
+    postings: {词: 编码后的倒排表}
+    '''
+
+    def __init__(self, path, files, postings):
+        self.path = path
+        self.files = files
+        self.postings = postings
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = marshal.loads(zlib.decompress(f.read()))
+        return cls(path, [tuple(i) for i in data['files']], data['postings'])
+
+    @classmethod
+    def write(cls, path, files, postings):
+        data = {'files': list(files), 'postings': postings}
+        tempname = path + '.tmp'
+        with open(tempname, 'wb') as f:
+            f.write(zlib.compress(marshal.dumps(data)))
+        os.rename(tempname, path)
+        return cls(path, files, postings)
+
+    def lookup(self, token):
+        '''返回 [(日志名, inode, 偏移, 时间), ...]'''
+        data = self.postings.get(token, None)
+        if data is None:
+            return []
+        return [
+            self.files[file_index] + (offset, line_time)
+            for file_index, offset, line_time in decode_postings(data)
+        ]
+
+
+class LogIndex(object):
+    '''
+    任务日志的倒排索引
+    index_dir: 索引目录
+    log_dir: 日志目录
+    max_segments: 段数超过后合并为一个段
+    '''
+
+    def __init__(self, index_dir, log_dir, max_segments=8):
+        self.index_dir = index_dir
+        self.log_dir = log_dir
+        self.max_segments = max_segments
+        self.segments = []
+        # {日志名: {'inode': inode, 'offset': 已索引到的偏移}}
+        self.state = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.index_dir, STATE_FILE), 'r') as f:
+                self.state = json.load(f)
+            for filename in sorted(
+                os.listdir(self.index_dir),
+                key=lambda i: (len(i), i)
+            ):
+                if filename.startswith('seg_') and filename.endswith('.idx'):
+                    self.segments.append(
+                        Segment.load(os.path.join(self.index_dir, filename))
+                    )
+        except Exception:
+            # 索引损坏或版本不兼容，重建
+            log.info(u'日志索引无法读取，将重建', exc_info=True)
+            self._reset()
+
+    def _reset(self):
+        self.state = {}
+        self.segments = []
+        for filename in os.listdir(self.index_dir):
+            try:
+                os.remove(os.path.join(self.index_dir, filename))
+            except OSError:
+                pass
+
+    def _save_state(self):
+        tempname = os.path.join(self.index_dir, STATE_FILE + '.tmp')
+        with open(tempname, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tempname, os.path.join(self.index_dir, STATE_FILE))
+
+    def _next_segment_path(self):
+        numbers = [
+            int(os.path.basename(s.path)[4:-4]) for s in self.segments
+        ]
+        return os.path.join(
+            self.index_dir, 'seg_{}.idx'.format(max(numbers or [0]) + 1)
+        )
+
+    def _index_file(self, path, inode, offset, postings, files, complete=False):
+        '''
+        读取文件 offset 之后完整的行并分词，返回新的偏移
+        complete: 文件不会再被写入（已经滚动），结尾的半行也索引
+        '''
+        key = (os.path.basename(path).split('.log')[0], inode)
+        file_index = files.setdefault(key, len(files))
+        line_time = int(os.path.getmtime(path))
+        last_stamp = None
+        with open_log(path) as f:
+            f.seek(offset)
+            while True:
+                data = f.read(READ_SIZE)
+                end = data.rfind('\n')
+                if end == -1:
+                    if not (complete and data):
+                        break
+                    end = len(data) - 1
+                for line in data[:end + 1].splitlines(True):
+                    # 没有时间的行（如 traceback）沿用上一行的时间
+                    match = TIME_PATTERN.match(line)
+                    if match is not None and match.group(1) != last_stamp:
+                        last_stamp = match.group(1)
+                        line_time = parse_time(last_stamp) or line_time
+                    for token in tokenize(line):
+                        postings.setdefault(token, []).append(
+                            (file_index, offset, line_time)
+                        )
+                    offset += len(line)
+                f.seek(offset)
+        return offset
+
+    def update(self):
+        '''索引所有任务日志新写入的内容，返回新索引的日志数'''
+        postings = {}
+        files = {}
+        state = dict(self.state)
+        names = set()
+        for filename in os.listdir(self.log_dir):
+            match = LOG_NAME_PATTERN.match(filename)
+            if match is None:
+                continue
+            name = match.group(1)
+            names.add(name)
+            path = os.path.join(self.log_dir, filename)
+            try:
+                current = os.stat(path)
+                last = state.get(name, None)
+                if last is not None and last['inode'] != current.st_ino:
+                    # 日志滚动了，先把滚动出去的那一段剩下的部分索引完（可能已经归档）
+                    rotated = find_segment(path, last['inode'])
+                    if rotated is not None:
+                        self._index_file(
+                            rotated, last['inode'],
+                            last['offset'], postings, files, complete=True
+                        )
+                    backup = self._stat('{}.1'.format(path))
+                    if backup is not None and backup.st_ino != last['inode']:
+                        # 滚动了不止一次，.log.1 还没有索引过
+                        self._index_file(
+                            '{}.1'.format(path), backup.st_ino, 0,
+                            postings, files, complete=True
+                        )
+                    last = None
+                elif last is None and name not in self.state:
+                    # 第一次见到这个日志，把之前滚动的内容也索引
+                    rotated = self._stat('{}.1'.format(path))
+                    if rotated is not None:
+                        self._index_file(
+                            '{}.1'.format(path), rotated.st_ino, 0,
+                            postings, files, complete=True
+                        )
+                offset = last['offset'] if last else 0
+                if offset > current.st_size:
+                    offset = 0
+                if offset == current.st_size and last is not None:
+                    continue
+                state[name] = {
+                    'inode': current.st_ino,
+                    'offset': self._index_file(
+                        path, current.st_ino, offset, postings, files
+                    ),
+                }
+            except (IOError, OSError):
+                # 日志在读取过程中被删除
+                log.debug(u'索引日志 %s 出错', filename, exc_info=True)
+        for name in list(state.keys()):
+            if name not in names:
+                state.pop(name)
+
+        if postings:
+            file_list = [k for k, _v in sorted(files.items(), key=lambda i: i[1])]
+            segment = Segment.write(
+                self._next_segment_path(), file_list,
+                dict(
+                    (token, encode_postings(sorted(items)))
+                    for token, items in postings.items()
+                )
+            )
+            with self._lock:
+                self.segments.append(segment)
+        self.state = state
+        self._save_state()
+        if len(self.segments) > self.max_segments:
+            self.merge()
+        return len(files)
+
+    def merge(self):
+        '''合并所有段，同时清理已经删除的日志文件的索引'''
+        with self._lock:
+            segments = list(self.segments)
+        alive = set()
+        for name, inode in set(f for s in segments for f in s.files):
+            if self._find_file(name, inode) is not None:
+                alive.add((name, inode))
+        files = {}
+        postings = {}
+        for segment in segments:
+            for token in segment.postings:
+                for name, inode, offset, line_time in segment.lookup(token):
+                    if (name, inode) not in alive:
+                        continue
+                    file_index = files.setdefault((name, inode), len(files))
+                    postings.setdefault(token, []).append(
+                        (file_index, offset, line_time)
+                    )
+        file_list = [k for k, _v in sorted(files.items(), key=lambda i: i[1])]
+        merged = Segment.write(
+            self._next_segment_path(), file_list,
+            dict(
+                (token, encode_postings(sorted(items)))
+                for token, items in postings.items()
+            )
+        )
+        with self._lock:
+            self.segments = [merged] + [
+                s for s in self.segments if s not in segments
+            ]
+        for segment in segments:
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _find_file(self, name, inode):
+        '''按 inode 找到日志文件（可能已经滚动为 .log.1，或者已经归档）'''
+        return find_segment(
+            os.path.join(self.log_dir, '{}.log'.format(name)), inode
+        )
+
+    def _read_context(self, path, offset, context):
+        '''读取 offset 处的一行及其前后 context 行'''
+        with open_log(path) as f:
+            start = max(offset - 512 * (context + 1), 0)
+            f.seek(start)
+            before = f.read(offset - start).splitlines()
+            if start > 0 and before:
+                # 第一行可能不完整
+                before = before[1:]
+            line = f.readline()
+            after = [f.readline() for _i in range(context)]
+        decode = lambda s: s.rstrip('\r\n').decode('utf-8', 'replace')
+        return (
+            decode(line),
+            [decode(l) for l in before[-context:]] if context else [],
+            [decode(l) for l in after if l],
+        )
+
+    def search(self, query, since=None, name=None, context=2, limit=100):
+        '''
+        搜索日志
+        query: 查询字符串，所有词都出现、且原文包含这个字符串（不区分大小写）的行才匹配
+        since: 只返回这个时间（Unix 时间戳）之后的行
+        name: 只搜索这个日志，例如 worker_12
+        Return: 按时间倒序的匹配行列表
+        '''
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        needle = query.lower()
+        if isinstance(needle, str):
+            needle = needle.decode('utf-8', 'replace')
+        with self._lock:
+            segments = list(self.segments)
+
+        candidates = set()
+        for segment in segments:
+            matched = None
+            # 先取最短的倒排表
+            for token in sorted(tokens, key=lambda t: len(segment.postings.get(t, ''))):
+                found = set(
+                    p for p in segment.lookup(token)
+                    if (name is None or p[0] == name)
+                    and (since is None or p[3] >= since)
+                )
+                matched = found if matched is None else matched & found
+                if not matched:
+                    break
+            candidates.update(matched or ())
+
+        results = []
+        for log_name, inode, offset, line_time in sorted(
+            candidates, key=lambda p: (p[3], p[2]), reverse=True
+        ):
+            path = self._find_file(log_name, inode)
+            if path is None:
+                continue
+            try:
+                line, before, after = self._read_context(path, offset, context)
+            except (IOError, OSError):
+                continue
+            if needle not in line.lower():
+                continue
+            results.append({
+                'name': log_name,
+                'worker_id': LOG_NAME_PATTERN.match(log_name + '.log').group(2),
+                'file': os.path.basename(path),
+                'offset': offset,
+                'time': line_time,
+                'line': line,
+                'before': before,
+                'after': after,
+            })
+            if len(results) >= limit:
+                break
+        return results
+
+    def start(self, interval=5):
+        '''启动后台索引线程'''
+        def run():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.update()
+                except Exception:
+                    log.warn(u'日志索引出错', exc_info=True)
+
+        self._thread = threading.Thread(target=run, name='LogIndexer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,171 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+按字节偏移增量读取日志文件
+日志由 RotatingFileHandler 写入，写满后 xxx.log 被重命名为 xxx.log.1，再新建 xxx.log。
+注意:
+- 用文件的 inode 作为日志的“代”（generation），重命名不会改变 inode，
+  所以客户端持有的代与当前 xxx.log 不同时，说明发生了滚动，先读完 xxx.log.1 的剩余部分；
+- 返回的内容总是以换行结束，正在写入的半行留到下一次读取；
+- 更早的日志段会被归档压缩（见 libs.logarchive），按 inode 仍然可以找到并透明读取；
+'''
+
+import os
+
+from libs.logarchive import find_segment, list_segments, log_size, open_log
+
+# 单次最多读取的字节数
+READ_LIMIT = 2 ** 20
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _read_lines(path, offset, limit, complete):
+    '''
+    从 offset 读取最多 limit 字节，截断到最后一个换行
+    complete: 文件不会再被写入，结尾的半行也返回
+    Return: (内容, 新的偏移)
+    '''
+    with open_log(path) as f:
+        f.seek(offset)
+        data = f.read(limit)
+        at_end = not f.read(1)
+    if not data:
+        return '', offset
+    if not (complete and at_end):
+        end = data.rfind('\n')
+        if end != -1:
+            data = data[:end + 1]
+        elif not len(data) >= limit:
+            # 还没写完的一行，下次再读
+            data = ''
+    return data, offset + len(data)
+
+
+def _read_history(log_file, limit):
+    '''
+    读取 xxx.log 之前的日志段（xxx.log.1 和归档）最后 limit 字节，从完整的一行开始
+    '''
+    chunks = []
+    for path in reversed(list_segments(log_file)[:-1]):
+        if limit <= 0:
+            break
+        try:
+            with open_log(path) as f:
+                data = f.read()
+        except (IOError, OSError):
+            continue
+        if data and not data.endswith('\n'):
+            data += '\n'
+        if len(data) > limit:
+            data = data[-limit:]
+            data = data[data.find('\n') + 1:]
+            limit = 0
+        else:
+            limit -= len(data)
+        chunks.append(data)
+    return ''.join(reversed(chunks))
+
+
+def read_tail(log_file, offset=None, generation=None, limit=READ_LIMIT, history=False):
+    '''
+    读取日志从 offset 开始的新内容
+    offset: 上次返回的偏移，不指定时返回最后 limit 字节（从完整的一行开始）
+    generation: 上次返回的代
+    history: 不指定 offset 且 xxx.log 不足 limit 字节时，用之前的日志段补足
+    Return: {
+        'content': 新的内容（unicode），
+        'offset': 下次读取的偏移，
+        'generation': 下次读取时带上的代，
+        'rotated': 这次读取是否跨越了日志滚动，
+        'reset': 偏移无效，从头开始读取（日志被删除重建等），
+    }
+    '''
+    current = _stat(log_file)
+    result = {
+        'content': u'',
+        'offset': 0,
+        'generation': current.st_ino if current else None,
+        'rotated': False,
+        'reset': False,
+    }
+    if current is None:
+        return result
+
+    content = ''
+    if generation is not None and offset is not None\
+            and int(generation) != current.st_ino:
+        # 发生了滚动，先读完已经滚动的 xxx.log.1（或者已经归档）
+        rotated = find_segment(log_file, generation)
+        rotated_size = log_size(rotated) if rotated else None
+        if rotated_size is not None and int(offset) <= rotated_size:
+            content, new_offset = _read_lines(
+                rotated, int(offset), limit, complete=True
+            )
+            if new_offset < rotated_size:
+                # 还没有读完，下次继续
+                result.update({
+                    'content': content.decode('utf-8', 'replace'),
+                    'offset': new_offset,
+                    'generation': int(generation),
+                })
+                return result
+            result['rotated'] = True
+            backup = _stat('{}.1'.format(log_file))
+            if rotated != '{}.1'.format(log_file) and backup is not None:
+                # 读完的是归档，滚动了不止一次，下次从 xxx.log.1 开头继续
+                result.update({
+                    'content': content.decode('utf-8', 'replace'),
+                    'offset': 0,
+                    'generation': backup.st_ino,
+                })
+                return result
+        else:
+            # 日志被删除重建了，或者归档已经被清理
+            result['reset'] = True
+        offset = 0
+        limit = max(limit - len(content), 0)
+
+    if offset is None:
+        if history and current.st_size < limit:
+            content = _read_history(log_file, limit - current.st_size)
+        offset = max(current.st_size - limit, 0)
+        if offset > 0:
+            # 从完整的一行开始
+            with open(log_file, 'rb') as f:
+                f.seek(offset - 1)
+                if f.read(1) != '\n':
+                    f.readline()
+                offset = f.tell()
+    else:
+        offset = int(offset)
+        if offset > current.st_size:
+            # 日志被截断
+            result['reset'] = True
+            offset = 0
+
+    data, offset = _read_lines(log_file, offset, limit, complete=False)
+    result['content'] = (content + data).decode('utf-8', 'replace')
+    result['offset'] = offset
+    return result
@@ -29,6 +29,7 @@ import edo_client
 from libs import messenger
 from config import APP_DATA
 from ui_client import _request_api
+from utils import get_client_registry
 
 
 """
@@ -119,6 +120,7 @@ class Site(object):
     def set_token_invalid(self):
         """设置 token 无效"""
         self.__token_invalid = True
+        get_client_registry().forget(self.__token)
 
     def is_token_invalid(self):
         """检查 token 是否无效"""
@@ -133,15 +135,14 @@ class Site(object):
         Args:
             token <str> 站点访问的 token
         """
-        oc_client = edo_client.get_client(
-            application='oc',
-            oc_api=self.oc_server,
-            account=self.account,
-            instance=self.instance,
-            token=token
-        )
+        registry = get_client_registry()
+        oc_client = self._get_oc_client(token)
         try:
-            token_info = oc_client.oauth.get_token_info()
+            # 短时间内重复登录（例如重新加载站点连接）不用再次请求
+            token_info = registry.get_token_info(
+                self.oc_server, self.account, self.instance, token,
+                oc_client.oauth.get_token_info
+            )
         except edo_client.ApiError:
             logger.exception(u"Call get_token_info failed")
             self.__token_invalid = True
@@ -150,8 +151,12 @@ class Site(object):
             user = token_info["user"]
             self.pid = "users.{}".format(user)
             org_client = oc_client.get_client('org')
-            objects_info = org_client.org.get_objects_info(
-                account=self.account, objects=["person:{}".format(user)]
+            objects_info = registry.get_token_info(
+                self.oc_server, self.account, self.instance, token,
+                lambda: org_client.org.get_objects_info(
+                    account=self.account, objects=["person:{}".format(user)]
+                ),
+                kind='objects_info'
             )
             if objects_info:
                 self.username = objects_info[0].get('title', self.username)
@@ -164,6 +169,7 @@ class Site(object):
         msg_thread = self.get_message_thread()
         if msg_thread:
             msg_thread.disconnect()
+        get_client_registry().forget(self.__token)
         self.__token = None
 
     def has_token(self):
@@ -204,16 +210,37 @@ class Site(object):
         Return:
             <edo_client> 客户端对象
         """
-        oc_client = edo_client.get_client(
-            application='oc',
-            oc_api=self.oc_server,
-            account=self.account,
-            instance=self.instance,
-            token=self.__token
-        )
         if app_name in ("oc", ):
-            return oc_client
-        return oc_client.get_client(app_name)
+            return self._get_oc_client(self.__token)
+        return get_client_registry().get(
+            app_name, self.oc_server, self.account, self.instance,
+            self.__token,
+            lambda: self._get_oc_client(self.__token).get_client(app_name)
+        )
+
+    def _get_oc_client(self, token):
+        """获取 OC 的客户端，同一个进程中复用"""
+        return get_client_registry().get(
+            'oc', self.oc_server, self.account, self.instance, token,
+            lambda: edo_client.get_client(
+                application='oc',
+                oc_api=self.oc_server,
+                account=self.account,
+                instance=self.instance,
+                token=token
+            )
+        )
+
+    def get_message_state(self):
+        """
+        获取消息管理线程的连接状态，不会创建线程（get_message_thread 会创建）
+        Return:
+            <str> | None，线程不存在或已经退出时为 None
+        """
+        messaging = self.__messaging
+        if messaging is None or not messaging.is_alive():
+            return None
+        return messaging.state
 
     def get_message_thread(self):
         """
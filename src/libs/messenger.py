@@ -35,6 +35,8 @@ from utils import (
 )
 from config import MSG_QOS, MSG_KEEPALIVE, COMMAND_CATEGORY
 from worker import run_online_script
+from libs.jsonlog import get_log_context, log_context, new_correlation_id
+from libs.metrics import MQTT_MESSAGES
 # from worker import get_worker_logger, get_worker_db
 
 RECONNECT_DELAY = 10
@@ -98,12 +100,14 @@ class ZopenMQTTClient(mqtt.Client):
         self.connected = True
 
     def on_message(self, mqttc, userdata, mqtt_msg):
+        MQTT_MESSAGES.inc((userdata['ref'].instance, ))
         try:
             payload = json.loads(mqtt_msg.payload)
-            userdata['ref'].handle_json_message(
-                userdata, payload,
-                topic=mqtt_msg.topic
-            )
+            with log_context(mqtt_msg_id=mqtt_msg.mid):
+                userdata['ref'].handle_json_message(
+                    userdata, payload,
+                    topic=mqtt_msg.topic
+                )
         except:
             userdata['ref'].logger.info(
                 u'在处理消息时发生异常，消息：%s',
@@ -679,6 +683,12 @@ class Messaging(threading.Thread):
             self.logger.warn(u'指令消息不包含任何脚本：%s', msg)
             return
 
+        # 关联 ID: 从收到指令开始，贯穿任务创建、任务子进程和回调的日志
+        # 发送方可以指定，没有则生成一个
+        correlation_id = event_data.pop('correlation_id', None)\
+            or new_correlation_id()
+        mqtt_msg_id = msg.get('id') or get_log_context().get('mqtt_msg_id')
+
         # 创建任务
         from_user = event_data.pop('from', {})
         from_user_id = from_user.get('id', None)
@@ -705,8 +715,15 @@ class Messaging(threading.Thread):
             'report_to_pid': from_user_id,
             'args': json.dumps(event_data.pop('args', [])),
             'kw': json.dumps(event_data.pop('kw', {})),
+            'correlation_id': correlation_id,
+            'mqtt_msg_id': mqtt_msg_id,
         }
-        return run_online_script(**worker_info)
+        with log_context(
+            correlation_id=correlation_id, mqtt_msg_id=mqtt_msg_id,
+            script_name=script_name, site=self.instance,
+        ):
+            self.logger.info(u'收到指令，运行脚本 %s', script_name)
+            return run_online_script(**worker_info)
 
     def handle_notification(self, msg):
         '''处理通知'''
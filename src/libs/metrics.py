@@ -0,0 +1,360 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+运行指标，以 Prometheus 文本格式（text exposition format 0.0.4）输出
+注意:
+- 计数器和直方图按线程分片: 每个线程只写自己的分片（不加锁），输出时再把所有分片加起来，
+  请求处理、消息线程、监视线程可以同时更新；
+- 同一个线程中的 greenlet 不会在一次更新的中途切换，共用一个分片也是安全的；
+- 指标只在主进程中有意义，任务子进程中的更新不会被输出，子进程的状态通过
+  任务状态事件（libs.events）传回主进程后再统计；
+'''
+
+import threading
+
+# 秒级耗时的默认分桶
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+# 任务运行时间的分桶
+RUNTIME_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+# 请求、响应大小的分桶（字节）
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    if not isinstance(value, basestring):
+        value = str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+class _Shards(object):
+    '''每个线程一个字典，只由这个线程写入'''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            # 每个线程只在第一次更新时加锁
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def snapshot(self):
+        with self._lock:
+            shards = list(self._shards)
+        # dict.items() 在 GIL 下一次完成，不会因为其他线程写入而出错
+        return [shard.items() for shard in shards]
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry or REGISTRY).register(self)
+
+    def samples(self):
+        '''返回 [(后缀, 标签值, 额外的标签, 值)]'''
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix,
+                _format_labels(self.labelnames, values, extra),
+                _format_value(value),
+            ))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    '''只增不减的计数器'''
+    type = 'counter'
+
+    def __init__(self, *args, **kw):
+        super(Counter, self).__init__(*args, **kw)
+        self._shards = _Shards()
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shards.get()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return sum(
+            value for items in self._shards.snapshot()
+            for key, value in items if key == labels
+        )
+
+    def samples(self):
+        totals = {}
+        for items in self._shards.snapshot():
+            for key, value in items:
+                totals[key] = totals.get(key, 0) + value
+        return [('', key, None, value) for key, value in sorted(totals.items())]
+
+
+class Gauge(Metric):
+    '''
+    可增可减的值，通常在输出前由收集函数设置
+    collect: 输出前调用的函数，返回 [(标签值, 值)]，设置后 set 的值不再使用
+    '''
+    type = 'gauge'
+
+    def __init__(self, *args, **kw):
+        self.collect = kw.pop('collect', None)
+        super(Gauge, self).__init__(*args, **kw)
+        self._values = {}
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def samples(self):
+        if self.collect is not None:
+            values = list(self.collect())
+        else:
+            values = self._values.items()
+        return [('', key, None, value) for key, value in sorted(values)]
+
+
+class Histogram(Metric):
+    '''分桶统计'''
+    type = 'histogram'
+
+    def __init__(self, *args, **kw):
+        self.buckets = tuple(sorted(kw.pop('buckets', DEFAULT_BUCKETS)))
+        super(Histogram, self).__init__(*args, **kw)
+        self._shards = _Shards()
+
+    def observe(self, value, labels=()):
+        shard = self._shards.get()
+        counts = shard.get(labels)
+        if counts is None:
+            # 各桶的计数（非累计）、+Inf、总和
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        counts[index] += 1
+        counts[-1] += value
+
+    def samples(self):
+        totals = {}
+        for items in self._shards.snapshot():
+            for key, counts in items:
+                total = totals.setdefault(key, [0] * len(counts))
+                for index, count in enumerate(counts):
+                    total[index] += count
+        samples = []
+        for key, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                samples.append((
+                    '_bucket', key, ('le', _format_value(float(bound))),
+                    cumulative,
+                ))
+            samples.append(('_sum', key, None, counts[-1]))
+            samples.append(('_count', key, None, cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        return '\n'.join(m.render() for m in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class WorkerStateTracker(object):
+    '''
+    根据任务状态事件统计任务的启动延迟、运行时间和重试次数
+    订阅主进程的 EventFeed（见 EventFeed.subscribe）
+    '''
+
+    def __init__(self, start_latency, runtime, retries):
+        self.start_latency = start_latency
+        self.runtime = runtime
+        self.retries = retries
+        # {worker_id: (状态, 时间)}
+        self._workers = {}
+
+    def __call__(self, event):
+        worker_id, state, now = event['worker_id'], event['state'], event['time']
+        last = self._workers.get(worker_id)
+        if state == 'prepare':
+            self._workers[worker_id] = (state, now)
+        elif state == 'running':
+            if last is not None and last[0] == 'prepare':
+                self.start_latency.observe(now - last[1])
+            self._workers[worker_id] = (state, now)
+        elif state == 'retry':
+            self.retries.inc((event.get('reason') or 'retry', ))
+        elif state in ('finished', 'error'):
+            if last is not None and last[0] == 'running':
+                self.runtime.observe(
+                    now - last[1], (event.get('script') or '', state, )
+                )
+            self._workers.pop(worker_id, None)
+        else:
+            self._workers.pop(worker_id, None)
+
+
+# 站点机器人的指标
+# 事件驱动的指标，在产生的地方直接更新
+WORKER_START_LATENCY = Histogram(
+    'sitebot_worker_start_latency_seconds',
+    'Time from task creation to the task process running.',
+)
+WORKER_RUNTIME = Histogram(
+    'sitebot_worker_runtime_seconds',
+    'Task run time by script name and final state.',
+    ('script', 'state', ), buckets=RUNTIME_BUCKETS,
+)
+WORKER_RETRIES = Counter(
+    'sitebot_worker_retries_total', 'Task retries by reason.', ('reason', ),
+)
+LOCK_WAIT = Histogram(
+    'sitebot_lock_wait_seconds',
+    'Time a task waited before acquiring a lock.',
+)
+LOCK_HOLD = Histogram(
+    'sitebot_lock_hold_seconds', 'Time a lock was held before release.',
+)
+MQTT_MESSAGES = Counter(
+    'sitebot_mqtt_messages_total', 'MQTT messages received by site.',
+    ('site', ),
+)
+EDO_CLIENTS = Counter(
+    'sitebot_edo_clients_total',
+    'edo_client clients requested by service and whether an existing client '
+    '(and its connections) was reused.',
+    ('application', 'result', ),
+)
+SSH_CONNECTIONS = Counter(
+    'sitebot_ssh_connections_total',
+    'SSH connections requested by scripts (get_host) and whether an '
+    'authenticated connection was reused.',
+    ('result', ),
+)
+INTERNAL_API_LATENCY = Histogram(
+    'sitebot_internal_api_latency_seconds',
+    'Latency of internal API calls (from task processes) by endpoint.',
+    ('endpoint', ),
+)
+# 输出时收集的指标，collect 由 HTTP 服务器设置
+WORKERS = Gauge(
+    'sitebot_workers', 'Tasks by worker name and state.', ('name', 'state', ),
+)
+QUEUE_DEPTH = Gauge(
+    'sitebot_queue_depth',
+    'Items waiting in internal queues (tasks to start, log records, '
+    'blocking calls, synchronous script calls, result callbacks).',
+    ('queue', ),
+)
+CALLBACK_OLDEST_AGE = Gauge(
+    'sitebot_callback_oldest_age_seconds',
+    'Age of the oldest task result callback waiting to be sent.',
+)
+CALLBACKS_FAILED = Gauge(
+    'sitebot_callbacks_failed',
+    'Task result callbacks given up after all retries.',
+)
+MQTT_CONNECTED = Gauge(
+    'sitebot_mqtt_connected', 'Whether the MQTT connection of a site is online.',
+    ('site', ),
+)
+SCRIPT_CACHE = Gauge(
+    'sitebot_script_cache_lookups',
+    'Online script cache lookups (from all task processes) by result.',
+    ('result', ),
+)
+SCRIPT_CACHE_HIT_RATIO = Gauge(
+    'sitebot_script_cache_hit_ratio',
+    'Fraction of online script loads served from the local cache.',
+)
+PROCESS_RSS = Gauge(
+    'sitebot_process_resident_memory_bytes',
+    'Resident memory of the main process.',
+)
+# HTTP 请求，由 libs.requestmetrics 更新
+HTTP_REQUEST_LATENCY = Histogram(
+    'sitebot_http_request_duration_seconds',
+    'HTTP request latency (until the response is fully sent) by endpoint '
+    'and method.',
+    ('endpoint', 'method', ),
+)
+HTTP_REQUESTS = Counter(
+    'sitebot_http_requests_total',
+    'HTTP requests by endpoint, method and status code.',
+    ('endpoint', 'method', 'status', ),
+)
+HTTP_REQUEST_SIZE = Histogram(
+    'sitebot_http_request_size_bytes', 'HTTP request body size by endpoint.',
+    ('endpoint', ), buckets=SIZE_BUCKETS,
+)
+HTTP_RESPONSE_SIZE = Histogram(
+    'sitebot_http_response_size_bytes', 'HTTP response body size by endpoint.',
+    ('endpoint', ), buckets=SIZE_BUCKETS,
+)
+HTTP_SLOW_REQUESTS = Counter(
+    'sitebot_http_slow_requests_total',
+    'HTTP requests that exceeded the slow request threshold, by endpoint.',
+    ('endpoint', ),
+)
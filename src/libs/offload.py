@@ -0,0 +1,101 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+把阻塞操作放到线程池中执行
+HTTP 服务器是 gevent 的 WSGIServer，但没有 monkey patch，请求处理函数中的网络请求、
+psutil 等待进程退出、同步运行脚本等操作会阻塞整个事件循环，所有其他请求（包括锁接口）都要等待。
+BlockingPool 把这些操作交给 gevent.threadpool 中的系统线程，当前 greenlet 等待结果，
+事件循环可以继续处理其他请求。
+注意:
+- 只有在创建线程池的线程（即运行事件循环的线程）中调用才会使用线程池，
+  其他线程（监视线程、消息线程、线程池自己的线程）中直接调用；
+- 线程池的线程数有上限，超出的调用排队等待；
+ExecutorPool 是预先启动所有线程的线程池，每个线程有固定的编号，用于同步运行脚本。
+'''
+
+import Queue
+import thread
+
+from gevent.threadpool import ThreadPool
+
+
+class BlockingPool(object):
+
+    def __init__(self, size=10):
+        self._owner = thread.get_ident()
+        self._pool = ThreadPool(size)
+        self.size = size
+
+    def in_loop(self):
+        '''当前是否在事件循环的线程中'''
+        return thread.get_ident() == self._owner
+
+    def run(self, func, *args, **kw):
+        '''执行 func 并返回结果（或抛出它的异常），在事件循环线程中调用时交给线程池执行'''
+        if not self.in_loop():
+            return func(*args, **kw)
+        return self._pool.apply(func, args, kw)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'busy': len(self._pool),
+        }
+
+    def kill(self):
+        self._pool.kill()
+
+
+class ExecutorPool(BlockingPool):
+    '''
+    预先启动 size 个线程（执行器），每个执行器有固定的编号 <prefix>-<序号>，
+    同时最多运行 size 个调用
+    '''
+
+    def __init__(self, size=4, prefix='executor'):
+        super(ExecutorPool, self).__init__(size)
+        self._slots = Queue.Queue()
+        for index in range(size):
+            self._slots.put('{}-{}'.format(prefix, index))
+        # 预先启动所有线程，调用时不用再创建
+        self._pool.size = size
+
+    def _call_in_slot(self, func, args, kw):
+        # 线程数与编号数相同，总能立即取到编号
+        slot = self._slots.get()
+        try:
+            return func(slot, *args, **kw)
+        finally:
+            self._slots.put(slot)
+
+    def call(self, timeout, func, *args, **kw):
+        '''
+        在一个执行器中运行 func(执行器编号, *args, **kw) 并返回结果
+        在事件循环线程中调用时，超过 timeout 秒没有完成则抛出 gevent.Timeout，
+        func 仍在执行器中继续运行，直到结束后执行器才能再次使用
+        '''
+        if not self.in_loop():
+            return self._call_in_slot(func, args, kw)
+        result = self._pool.spawn(self._call_in_slot, func, args, kw)
+        return result.get(timeout=timeout or None)
+
+    def stats(self):
+        stats = super(ExecutorPool, self).stats()
+        stats['idle'] = self._slots.qsize()
+        return stats
@@ -16,26 +16,148 @@
  */
 """
 
+'''
+把任务日志作为进度回报给站点（调用进度脚本 progress_script）
+记录日志时只放进缓冲区，由后台线程成批回报，脚本不用等待站点接口:
+- 缓冲区中的记录达到 batch_size 条，或者最早的记录已经等待 interval 秒时回报一次，
+  一批记录合并成一条消息（每条记录一行）；
+- 缓冲区有上限 capacity，满了以后先丢弃级别最低的（同级别丢弃最早的），
+  丢弃的数量在下一次回报中说明；
+- 任务结束时调用 close()，回报缓冲区中剩余的记录；
+- 后台线程在第一次记录日志时才启动，创建后没有使用（例如任务准备阶段出错）不会留下线程；
+'''
+
+import threading
+import time
+from collections import deque
 from logging import Handler
 
 
 class ProgressLogHandler(Handler):
-    def __init__(self, wo_client, progress_script, script_title,  progress_params, logger):
+    def __init__(
+        self, wo_client, progress_script, script_title, progress_params,
+        logger, batch_size=20, interval=2, capacity=200,
+    ):
         Handler.__init__(self)
         self.wo_client = wo_client
         self.progress_script = progress_script
         self.progress_params = progress_params
         self.script_title = script_title
         self.logger = logger
+        self.batch_size = batch_size
+        self.interval = interval
+        self.capacity = capacity
+        # (记录时间, 级别, 消息)
+        self._buffer = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        # 还没有在回报中说明的丢弃数量
+        self._dropped = 0
+        self.dropped = 0
+        self.sent = 0
+        # 后台线程在第一次记录日志时启动，没有日志时不创建线程
+        self._thread = None
 
     def emit(self, record):
+        if threading.current_thread() is self._thread:
+            # 回报失败时记录的日志，不再回报
+            return
+        try:
+            message = record.getMessage()
+        except Exception:
+            self.handleError(record)
+            return
+        with self._cond:
+            if self._closed:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='ProgressReporter'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            if len(self._buffer) >= self.capacity:
+                if not self._drop_lowest(record.levelno):
+                    return
+            self._buffer.append((time.time(), record.levelno, message))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _drop_lowest(self, levelno):
+        '''缓冲区满了，丢弃一条级别最低的记录；新记录的级别不比它们高时丢弃新记录'''
+        lowest = min(item[1] for item in self._buffer)
+        self._dropped += 1
+        self.dropped += 1
+        if levelno <= lowest:
+            return False
+        for index, item in enumerate(self._buffer):
+            if item[1] == lowest:
+                del self._buffer[index]
+                break
+        return True
+
+    def _take_batch(self):
+        '''取出要回报的记录，缓冲区中的全部记录合并为一批'''
+        batch = [item[2] for item in self._buffer]
+        self._buffer.clear()
+        dropped, self._dropped = self._dropped, 0
+        return batch, dropped
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    if self._buffer:
+                        wait = self._buffer[0][0] + self.interval - time.time()
+                        self._cond.wait(max(wait, 0.01))
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+                batch, dropped = self._take_batch()
+            self._send(batch, dropped)
+
+    def _due(self):
+        return bool(self._buffer) and (
+            len(self._buffer) >= self.batch_size
+            or time.time() - self._buffer[0][0] >= self.interval
+        )
+
+    def _send(self, batch, dropped):
+        count = len(batch)
+        if dropped:
+            batch.append(u'（缓冲区已满，丢弃了 {} 条日志）'.format(dropped))
+        if not batch:
+            return
         try:
             self.wo_client.xapi(
                 self.progress_script,
-                script_title = self.script_title,
-                message=record.getMessage(),
+                script_title=self.script_title,
+                message=u'\n'.join(batch),
                 **self.progress_params
             )
         except Exception:
             self.logger.exception('进度回调失败！')
+        else:
+            self.sent += count
+
+    def flush(self):
+        '''回报缓冲区中的所有记录（在调用线程中）'''
+        with self._cond:
+            batch, dropped = self._take_batch()
+        self._send(batch, dropped)
 
+    def close(self):
+        '''停止后台线程，回报剩余的记录'''
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(self.interval + 30)
+        self.flush()
+        if self.dropped:
+            self.logger.warn(u'进度回报共丢弃了 %s 条日志', self.dropped)
+        Handler.close(self)
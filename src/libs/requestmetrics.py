@@ -0,0 +1,185 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+HTTP 请求统计（WSGI 中间件）
+- 按接口（Flask endpoint）统计耗时、请求和响应大小、状态码，写入 libs.metrics；
+- 耗时从收到请求算到响应（包括流式响应）全部发送完毕；
+- 慢请求监视线程: 请求超过阈值仍未完成时，记录一次处理这个请求的调用栈；
+注意:
+- endpoint 由 Flask 在 before_request 中写入 environ[ENDPOINT_KEY]，没有匹配到路由时为空；
+- 请求在 greenlet 中处理: 正在运行（阻塞了事件循环）时取线程当前的调用栈，
+  等待 IO 时取 greenlet 挂起处的调用栈；
+'''
+
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from libs.metrics import (
+    HTTP_REQUEST_LATENCY, HTTP_REQUESTS, HTTP_REQUEST_SIZE, HTTP_RESPONSE_SIZE,
+    HTTP_SLOW_REQUESTS,
+)
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    # 没有 gevent 的环境（如单元测试），按线程处理
+    getcurrent = None
+
+ENDPOINT_KEY = 'sitebot.endpoint'
+
+log = logging.getLogger(__name__)
+
+
+class _ResponseIterator(object):
+    '''统计响应大小，响应发送完毕（close）时回调'''
+
+    def __init__(self, result, on_close):
+        self._result = result
+        self._on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._result:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._result, 'close'):
+                self._result.close()
+        finally:
+            self._on_close(self.size)
+
+
+class RequestMetrics(object):
+    '''
+    包装 WSGI 应用
+    slow_threshold: 慢请求的阈值（秒），为 0 时不监视
+    slow_ignore: 不监视的 endpoint，例如长轮询、SSE 接口
+    slow_logger: 记录慢请求的 logger
+    '''
+
+    def __init__(
+        self, app, slow_threshold=5, slow_ignore=(), slow_logger=None,
+        interval=1,
+    ):
+        self.app = app
+        self.slow_threshold = slow_threshold
+        self.slow_ignore = set(slow_ignore)
+        self.slow_logger = slow_logger or log
+        self.interval = interval
+        # 正在处理的请求 {id: 请求信息}
+        self._inflight = {}
+        self._watchdog = None
+
+    def __call__(self, environ, start_response):
+        request = {
+            'start': time.time(),
+            'environ': environ,
+            'status': '500',
+            'thread': threading.current_thread().ident,
+            'greenlet': getcurrent() if getcurrent is not None else None,
+            'reported': False,
+        }
+        key = id(request)
+        self._inflight[key] = request
+
+        def _start_response(status, headers, exc_info=None):
+            request['status'] = status.split(' ', 1)[0]
+            if exc_info is not None:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+
+        try:
+            result = self.app(environ, _start_response)
+        except Exception:
+            self._finish(key, 0)
+            raise
+        return _ResponseIterator(result, lambda size: self._finish(key, size))
+
+    def _finish(self, key, response_size):
+        request = self._inflight.pop(key, None)
+        if request is None:
+            return
+        environ = request['environ']
+        endpoint = environ.get(ENDPOINT_KEY) or ''
+        method = environ.get('REQUEST_METHOD', '')
+        HTTP_REQUEST_LATENCY.observe(
+            time.time() - request['start'], (endpoint, method, )
+        )
+        HTTP_REQUESTS.inc((endpoint, method, request['status'], ))
+        try:
+            request_size = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_size = 0
+        HTTP_REQUEST_SIZE.observe(request_size, (endpoint, ))
+        HTTP_RESPONSE_SIZE.observe(response_size, (endpoint, ))
+
+    def start_watchdog(self):
+        '''启动慢请求监视线程'''
+        if not self.slow_threshold or self._watchdog is not None:
+            return
+        self._watchdog = threading.Thread(
+            target=self._watch, name='SlowRequestWatchdog'
+        )
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check_slow_requests()
+            except Exception:
+                log.debug(u'检查慢请求出错', exc_info=True)
+
+    def _get_stack(self, request):
+        frame = None
+        if request['greenlet'] is not None:
+            # 正在运行的 greenlet 没有 gr_frame
+            frame = request['greenlet'].gr_frame
+        if frame is None:
+            frame = sys._current_frames().get(request['thread'])
+        if frame is None:
+            return u''
+        return ''.join(traceback.format_stack(frame))
+
+    def check_slow_requests(self, now=None):
+        '''记录超过阈值的请求（每个请求只记录一次），返回这次记录的数量'''
+        now = now or time.time()
+        reported = 0
+        for request in self._inflight.values():
+            elapsed = now - request['start']
+            environ = request['environ']
+            endpoint = environ.get(ENDPOINT_KEY) or ''
+            if request['reported'] or elapsed < self.slow_threshold\
+                    or endpoint in self.slow_ignore:
+                continue
+            request['reported'] = True
+            reported += 1
+            HTTP_SLOW_REQUESTS.inc((endpoint, ))
+            self.slow_logger.warn(
+                u'慢请求 %s %s（%s）已经运行 %.1f 秒，调用栈:\n%s',
+                environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                endpoint, elapsed, self._get_stack(request)
+            )
+        return reported
@@ -0,0 +1,101 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+任务结果的存储
+较大的任务结果（JSON）不保存在 workerdb 中，而是单独压缩保存为 <任务 ID>.json.gz，
+workerdb 中只保存引用（_result_ref: 大小和 sha1），任务列表等操作不用读取和解析结果。
+注意:
+- 不超过 inline_bytes 的结果仍然直接保存在 workerdb 的 _result 中；
+- 写入时先写临时文件再改名，读取时校验 sha1，不会读到写了一半或被替换的结果；
+- 结果文件随任务记录一起删除（worker.remove_worker_db）；
+'''
+
+import gzip
+import hashlib
+import os
+import zlib
+
+from libs.scriptcache import atomic_write, ensure_dir
+
+# 流式读取时每次读取的大小
+CHUNK_SIZE = 64 * 2 ** 10
+
+
+class ResultStore(object):
+
+    def __init__(self, root, inline_bytes=64 * 2 ** 10):
+        self.root = root
+        self.inline_bytes = inline_bytes
+        ensure_dir(root)
+
+    def path(self, worker_id):
+        return os.path.join(self.root, '{}.json.gz'.format(worker_id))
+
+    def dump(self, worker_id, data):
+        '''
+        保存任务结果（JSON 字符串）
+        结果较小时不保存，返回 None；否则返回保存在 workerdb 中的引用
+        '''
+        if len(data) <= self.inline_bytes:
+            self.remove(worker_id)
+            return None
+        # gzip 格式，下载时可以直接作为 Content-Encoding: gzip 的响应
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        atomic_write(self.path(worker_id), compressed)
+        return {
+            'size': len(data),
+            'compressed_size': len(compressed),
+            'sha1': hashlib.sha1(data).hexdigest(),
+        }
+
+    def load(self, worker_id, ref):
+        '''读取任务结果（JSON 字符串），文件不存在或与引用不符时抛出 IOError'''
+        with gzip.open(self.path(worker_id), 'rb') as f:
+            data = f.read()
+        if len(data) != ref['size']\
+                or hashlib.sha1(data).hexdigest() != ref['sha1']:
+            raise IOError(u'任务 #{} 的结果文件已损坏'.format(worker_id))
+        return data
+
+    def iter_raw(self, worker_id, decompress=True, chunk_size=CHUNK_SIZE):
+        '''
+        逐块读取任务结果，不把整个结果读入内存
+        decompress: 为 False 时返回压缩（gzip）的内容
+        文件不存在时在调用时（而不是迭代时）抛出 IOError
+        '''
+        if decompress:
+            f = gzip.open(self.path(worker_id), 'rb')
+        else:
+            f = open(self.path(worker_id), 'rb')
+
+        def generate():
+            with f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        return generate()
+
+    def remove(self, worker_id):
+        try:
+            os.remove(self.path(worker_id))
+        except OSError:
+            pass
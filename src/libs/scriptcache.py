@@ -0,0 +1,256 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+联机脚本的本地缓存
+每次运行联机脚本都要从站点下载脚本，缓存后短时间内再次运行同一个脚本不用再下载。
+翻译文件（load_i18n）等其他从站点下载的 JSON 内容也用同样的方式缓存（不同的目录）。
+目录结构:
+- objects/<sha1>.json: 脚本内容，以内容的 sha1 命名，相同的内容只保存一份；
+- index/<sha1(站点, 脚本名)>.json: 脚本名到内容的索引，以及版本、检查时间；
+- hits、misses: 命中、未命中的计数，文件大小即次数；写满 COUNT_BASE 字节后进位，
+  hits.1、hits.2 ... 中的每个字节分别代表 COUNT_BASE、COUNT_BASE ** 2 ... 次，文件不会一直增长；
+注意:
+- 缓存保存在磁盘上，重启后仍然有效，所有任务子进程共用；
+- 写入时先写临时文件再改名，其他进程不会读到写了一半的文件；
+- 以下情况需要重新下载: 超过 ttl 秒（或写入时指定的有效期）没有检查过、软件包版本与缓存时不同；
+- 内容文件总大小超过 max_bytes 时，删除最久没有使用的内容文件；
+'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+# 计数文件的进位: 每个文件最多约 COUNT_BASE 字节，最高一级不再进位
+COUNT_BASE = 1024
+COUNT_LEVELS = 4
+CARRY_WAIT = 0.01
+
+
+def ensure_dir(path):
+    '''创建目录（包括上级目录），已经存在时不做任何事'''
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # 其他进程同时创建
+            if not os.path.isdir(path):
+                raise
+
+
+def atomic_write(path, data):
+    '''先写临时文件再改名，其他进程不会读到写了一半的文件'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def trim_directory(directory, max_bytes):
+    '''目录中文件的总大小超过上限时，按修改时间从旧到新删除文件'''
+    files = []
+    total = 0
+    for name in os.listdir(directory):
+        if name.endswith('.tmp'):
+            # 其他进程正在写入
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    for _mtime, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def version_key(package_versions):
+    '''把软件包版本（任务参数 package_versions_）转换为可比较的字符串'''
+    if not package_versions:
+        return None
+    return json.dumps(package_versions, sort_keys=True)
+
+
+class ScriptCache(object):
+
+    def __init__(self, root, ttl=5 * 60, max_bytes=50 * 2 ** 20):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_dir = os.path.join(root, 'index')
+        ensure_dir(self.objects_dir)
+        ensure_dir(self.index_dir)
+
+    def _index_path(self, site, script_name):
+        key = hashlib.sha1(
+            u'{}\n{}'.format(site, script_name).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.index_dir, key + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest + '.json')
+
+    def _count_path(self, name, level=0):
+        return os.path.join(
+            self.root, '{}.{}'.format(name, level) if level else name
+        )
+
+    def _count(self, name, level=0, times=1):
+        # 追加写入在多个进程之间是原子的，不需要加锁
+        path = self._count_path(name, level)
+        try:
+            with open(path, 'ab') as f:
+                f.write('.' * times)
+            size = os.path.getsize(path)
+        except (IOError, OSError):
+            return
+        if size >= COUNT_BASE and level < COUNT_LEVELS - 1:
+            self._carry(name, level)
+
+    def _carry(self, name, level):
+        '''计数文件写满后，每 COUNT_BASE 个字节在上一级文件中记为 1 个字节'''
+        path = self._count_path(name, level)
+        carrying = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            # 改名是原子的，同时进位的进程中只有一个成功
+            os.rename(path, carrying)
+            # 等改名前已经打开文件的进程写完（每 COUNT_BASE 次计数才进位一次）
+            time.sleep(CARRY_WAIT)
+            size = os.path.getsize(carrying)
+            os.remove(carrying)
+        except OSError:
+            return
+        carry, remainder = divmod(size, COUNT_BASE)
+        if remainder:
+            self._count(name, level, remainder)
+        if carry:
+            self._count(name, level + 1, carry)
+
+    def get(self, site, script_name, version=None, now=None):
+        '''返回缓存的脚本，没有缓存或需要重新下载时返回 None'''
+        now = now or time.time()
+        try:
+            with open(self._index_path(site, script_name), 'rb') as f:
+                entry = json.load(f)
+            if now - entry['checked'] > (entry.get('ttl') or self.ttl)\
+                    or (version is not None and entry['version'] != version):
+                raise KeyError(script_name)
+            object_path = self._object_path(entry['digest'])
+            with open(object_path, 'rb') as f:
+                script = json.load(f)
+            # 更新修改时间，淘汰时按修改时间判断最近是否使用
+            os.utime(object_path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            self._count('misses')
+            return None
+        self._count('hits')
+        return script
+
+    def put(self, site, script_name, script, version=None, now=None, ttl=None):
+        '''
+        缓存下载的脚本
+        ttl: 这一项的有效期（秒），不指定时使用缓存的 ttl
+        '''
+        try:
+            data = json.dumps(script, sort_keys=True)
+        except (TypeError, ValueError):
+            log.debug(u'脚本 %s 无法序列化，不缓存', script_name)
+            return
+        digest = hashlib.sha1(data).hexdigest()
+        object_path = self._object_path(digest)
+        if os.path.exists(object_path):
+            os.utime(object_path, None)
+        else:
+            atomic_write(object_path, data)
+        atomic_write(self._index_path(site, script_name), json.dumps({
+            'site': site,
+            'script_name': script_name,
+            'digest': digest,
+            'version': version,
+            'checked': now or time.time(),
+            'ttl': ttl,
+        }))
+        self.evict()
+
+    def evict(self):
+        '''内容文件总大小超过上限时，删除最久没有使用的内容文件'''
+        # 引用被删除内容的索引，下次读取时视为未命中
+        trim_directory(self.objects_dir, self.max_bytes)
+
+    def clear(self):
+        for directory in (self.objects_dir, self.index_dir):
+            for name in os.listdir(directory):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        stats = {}
+        for name in ('hits', 'misses', ):
+            stats[name] = 0
+            for level in range(COUNT_LEVELS):
+                try:
+                    size = os.path.getsize(self._count_path(name, level))
+                except OSError:
+                    continue
+                stats[name] += size * COUNT_BASE ** level
+        return stats
+
+
+def cached_loader(load_script, cache, site, version=None):
+    '''
+    包装脚本引擎的 load_script，先从缓存中读取
+    同一次运行中多次加载同一个脚本（先加载脚本信息、运行时再次加载）只读取一次
+    '''
+    loaded = {}
+
+    def load(script_name, *args, **kw):
+        if args or kw:
+            return load_script(script_name, *args, **kw)
+        if script_name in loaded:
+            return loaded[script_name]
+        script = cache.get(site, script_name, version)
+        if script is None:
+            script = load_script(script_name)
+            try:
+                cache.put(site, script_name, script, version)
+            except (IOError, OSError):
+                log.warn(u'缓存脚本 %s 失败', script_name, exc_info=True)
+        loaded[script_name] = script
+        return script
+    return load
@@ -0,0 +1,678 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+SSH 连接的复用（联机脚本的 get_host）
+每次 get_host 得到的 Connection 都要重新建立 SSH 连接（密钥交换、认证），
+这里保持已认证的连接（paramiko Transport），连接同一个主机时在已有连接上打开新的通道。
+注意:
+- 以 (主机, 端口, 用户, 认证参数的 sha1) 为键，密码、私钥本身不保存在键中；经过跳板机（gateway）的连接不复用；
+- 同一个连接可以同时被多个脚本使用（SSH 通道多路复用），Connection.close() 只是归还连接；
+- 空闲超过 idle_timeout 秒的连接被关闭；取用时检查连接是否可用，断开的连接重新建立；
+- paramiko 的连接不能跨进程使用，连接都保持在主进程中（类似 OpenSSH 的 ControlMaster）:
+  主进程启动本地代理 SSHProxy（只监听 127.0.0.1），地址、令牌和代理的主机密钥通过环境变量传给任务子进程；
+  子进程的 Connection 连接本地代理，先发送一行 JSON（令牌、主机、端口、用户、认证参数），
+  代理从主进程的 SSHBroker 借用已认证的连接，再在这个 socket 上做本地的 SSH 握手，
+  子进程打开的通道（exec、pty、shell、sftp 等 subsystem）由代理转发到借用的连接上；
+  子进程只需要和本地代理握手，不再和远程主机做密钥交换和认证；
+- 主进程中的同步执行器（/call_script_sync）直接借用连接；没有代理（或代理连不上）时，
+  子进程退回到进程内的复用，fork 出的子进程第一次使用时清空从父进程继承的连接；
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from StringIO import StringIO
+
+try:
+    import paramiko
+except ImportError:
+    # 没有 paramiko 时不能启动代理，子进程也不会使用代理
+    paramiko = None
+
+from libs.metrics import SSH_CONNECTIONS
+
+log = logging.getLogger(__name__)
+
+# 本地代理的设置（JSON），由主进程设置，任务子进程继承
+PROXY_ENV = 'SITEBOT_SSH_PROXY'
+# 代理转发通道数据时每次读取的大小
+RELAY_BUFSIZE = 32768
+
+
+def connection_key(host, port, user, connect_kwargs=None):
+    '''
+    连接的键，认证参数（密码、私钥文件、私钥）取 sha1
+    认证参数无法识别时返回 None，不复用
+    '''
+    auth = {}
+    for name, value in (connect_kwargs or {}).items():
+        if name == 'pkey' and value is not None:
+            value = hashlib.sha1(value.get_fingerprint()).hexdigest()
+        auth[name] = value
+    try:
+        digest = hashlib.sha1(json.dumps(auth, sort_keys=True)).hexdigest()
+    except (TypeError, ValueError):
+        return None
+    return (host, port, user, digest)
+
+
+class _Entry(object):
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.users = 0
+        self.last_used = time.time()
+
+    @property
+    def transport(self):
+        return self.client.get_transport()
+
+    def is_active(self):
+        transport = self.transport
+        return transport is not None and transport.is_active()
+
+
+class SharedClient(object):
+    '''
+    借出的 SSHClient，除 close 外的操作都交给共用的 SSHClient
+    close() 只是归还连接，不关闭
+    '''
+
+    def __init__(self, broker, entry):
+        self._broker = broker
+        self._entry = entry
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._entry.client, name)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._broker.release(self._entry)
+
+    def __del__(self):
+        # 脚本没有关闭 Connection 时，回收后归还
+        self.close()
+
+
+class SSHBroker(object):
+    '''
+    idle_timeout: 连接空闲多久（秒）之后关闭，为 0 时不复用
+    keepalive: 连接的 keepalive 间隔（秒），超过这个时间没有使用的连接，取用前先检查
+    maxsize: 最多保持的连接数，超过时关闭最久没有使用的空闲连接
+    proxy: 本地代理的设置（见 SSHProxy.start），为 None 时从环境变量读取，主进程中不使用代理
+    '''
+
+    def __init__(self, idle_timeout=5 * 60, keepalive=30, maxsize=32,
+                 proxy=None):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.maxsize = maxsize
+        self.proxy = proxy
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # {键: _Entry}，最近使用的在末尾
+        self._entries = OrderedDict()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # 父进程的连接在子进程中不可用，也不能关闭
+            self._reset()
+
+    def _is_healthy(self, entry, now):
+        if not entry.is_active():
+            return False
+        if now - entry.last_used > self.keepalive:
+            try:
+                entry.transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+    def get(self, key, connect):
+        '''
+        借出一个已认证的连接，没有可用的连接时调用 connect() 建立（返回已连接的 SSHClient）
+        Return: SharedClient，用完后调用 close() 归还
+        '''
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            if self._is_healthy(entry, now):
+                with self._lock:
+                    self._entries[key] = entry
+                    entry.users += 1
+                    entry.last_used = now
+                SSH_CONNECTIONS.inc(('reused', ))
+                return SharedClient(self, entry)
+            log.info(u'SSH 连接 %s@%s:%s 已断开，重新连接', key[2], key[0], key[1])
+            self._close(entry)
+        # 建立连接比较慢，不在锁内进行
+        entry = _Entry(key, connect())
+        if self.keepalive and entry.transport is not None:
+            entry.transport.set_keepalive(self.keepalive)
+        SSH_CONNECTIONS.inc(('new', ))
+        with self._lock:
+            replaced = self._entries.pop(key, None)
+            entry.users += 1
+            self._entries[key] = entry
+            idle = [
+                e for e in self._entries.values() if e.users == 0
+            ][:max(len(self._entries) - self.maxsize, 0)]
+            for e in idle:
+                self._entries.pop(e.key)
+        # 同时建立了同一个键的连接，原来的连接没有使用者时关闭，否则在归还时关闭
+        if replaced is not None and replaced.users == 0:
+            idle.append(replaced)
+        for e in idle:
+            self._close(e)
+        return SharedClient(self, entry)
+
+    def release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.time()
+            current = self._entries.get(entry.key)
+            # 重新连接时可能复用了同一个 SSHClient，这时不能关闭
+            orphaned = entry.users == 0 and current is not entry\
+                and (current is None or current.client is not entry.client)
+        if orphaned:
+            self._close(entry)
+
+    def _close(self, entry):
+        try:
+            entry.client.close()
+        except Exception:
+            log.debug(u'关闭 SSH 连接出错', exc_info=True)
+
+    def reap(self, now=None):
+        '''关闭空闲超时或已经断开（不论是否在使用）的连接，返回关闭的数量'''
+        now = now or time.time()
+        with self._lock:
+            self._check_pid()
+            expired = [
+                entry for entry in self._entries.values()
+                if not entry.is_active() or (
+                    entry.users == 0
+                    and now - entry.last_used > self.idle_timeout
+                )
+            ]
+            for entry in expired:
+                self._entries.pop(entry.key)
+        for entry in expired:
+            self._close(entry)
+        return len(expired)
+
+    def close_all(self):
+        with self._lock:
+            entries = self._entries.values()
+            self._entries.clear()
+        for entry in entries:
+            self._close(entry)
+
+    def start(self, interval=30):
+        '''启动后台线程，定时关闭空闲的连接'''
+        def run():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.reap()
+                except Exception:
+                    log.warn(u'清理 SSH 连接出错', exc_info=True)
+
+        thread = threading.Thread(target=run, name='SSHBrokerReaper')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': len(self._entries),
+                'in_use': len([e for e in self._entries.values() if e.users]),
+            }
+
+    def attach(self, connection):
+        '''
+        让 fabric 的 Connection 从这里借用连接: 替换 connection.open，
+        打开时先取已有的连接，没有时连接本地代理（任务子进程），或者按原来的方式连接后登记；
+        调用 close() 归还连接后，再次使用（run 等方法先调用 open）时重新借用
+        '''
+        if not self.idle_timeout or getattr(connection, 'gateway', None):
+            return connection
+        key = connection_key(
+            connection.host, connection.port, connection.user,
+            connection.connect_kwargs,
+        )
+        if key is None:
+            return connection
+        proxy = self.proxy or proxy_settings()
+        original_open = connection.open
+        own_client = connection.client
+
+        def connect():
+            if proxy is not None:
+                client = proxy_connect(
+                    proxy, connection.host, connection.port, connection.user,
+                    connection.connect_kwargs,
+                    getattr(connection, 'connect_timeout', None),
+                )
+                if client is not None:
+                    return client
+            # 用这个 Connection 自己的 SSHClient 连接，不影响借出的连接
+            connection.client = own_client
+            connection.transport = own_client.get_transport()
+            original_open()
+            return own_client
+
+        def open():
+            client = connection.client
+            if isinstance(client, SharedClient) and not client._released:
+                if connection.is_connected:
+                    return
+                # 借用的连接已经断开，归还后重新借用
+                client.close()
+            connection.client = self.get(key, connect)
+            connection.transport = connection.client.get_transport()
+        connection.open = open
+        return connection
+
+
+def brokered(get_host, broker):
+    '''包装 get_host，返回的 Connection 从 broker 借用连接'''
+    def wrapper(*args, **kw):
+        return broker.attach(get_host(*args, **kw))
+    return wrapper
+
+
+def proxy_settings():
+    '''
+    从环境变量读取本地代理的设置
+    没有设置，或者当前就是运行代理的主进程时，返回 None
+    '''
+    value = os.environ.get(PROXY_ENV)
+    if not value or paramiko is None:
+        return None
+    try:
+        settings = json.loads(value)
+    except ValueError:
+        log.warn(u'SSH 代理设置 %s 无效: %s', PROXY_ENV, value)
+        return None
+    if settings.get('pid') == os.getpid():
+        return None
+    return settings
+
+
+def _readline(sock, limit=65536):
+    '''逐字节读取一行，不能多读: 后面紧接着是 SSH 协议的数据'''
+    chars = []
+    while len(chars) < limit:
+        char = sock.recv(1)
+        if not char:
+            raise EOFError('connection closed')
+        if char == '\n':
+            return ''.join(chars)
+        chars.append(char)
+    raise ValueError('line too long')
+
+
+def _dump_kwargs(connect_kwargs):
+    '''认证参数转为 JSON 可以表示的形式，私钥（pkey）转为文本，无法转换时返回 None'''
+    kwargs = dict(connect_kwargs or {})
+    pkey = kwargs.pop('pkey', None)
+    if pkey is not None:
+        data = StringIO()
+        try:
+            pkey.write_private_key(data)
+        except Exception:
+            return None
+        kwargs['pkey'] = data.getvalue()
+    return kwargs
+
+
+def _load_kwargs(kwargs):
+    pkey = kwargs.pop('pkey', None)
+    if pkey is not None:
+        for key_class in (
+            paramiko.RSAKey, paramiko.ECDSAKey, paramiko.DSSKey,
+        ):
+            try:
+                kwargs['pkey'] = key_class.from_private_key(StringIO(pkey))
+                break
+            except paramiko.SSHException:
+                continue
+        else:
+            raise paramiko.SSHException('unsupported private key')
+    return kwargs
+
+
+def _host_key_name(host, port):
+    # 与 paramiko.SSHClient.connect 查找 known_hosts 时的名字相同
+    if port == 22:
+        return host
+    return '[{}]:{}'.format(host, port)
+
+
+def proxy_connect(settings, host, port, user, connect_kwargs, timeout=None):
+    '''
+    通过本地代理连接，返回已连接的 SSHClient；代理连不上时返回 None
+    远程主机连接或认证失败时抛出异常（与直接连接时相同的 paramiko 异常类型）
+    '''
+    kwargs = _dump_kwargs(connect_kwargs)
+    if kwargs is None:
+        return None
+    request = json.dumps({
+        'token': settings['token'],
+        'host': host,
+        'port': port,
+        'user': user,
+        'connect_kwargs': kwargs,
+        'timeout': timeout,
+    })
+    try:
+        sock = socket.create_connection(tuple(settings['address']), timeout)
+        sock.sendall(request + '\n')
+    except socket.error:
+        log.warn(u'连接 SSH 代理 %s 失败，直接连接', settings['address'],
+                 exc_info=True)
+        return None
+    try:
+        # 代理在这期间连接远程主机
+        sock.settimeout(None)
+        reply = json.loads(_readline(sock))
+        if reply.get('error'):
+            if reply.get('auth'):
+                raise paramiko.AuthenticationException(reply['error'])
+            raise paramiko.SSHException(reply['error'])
+        # 只信任代理的主机密钥
+        client = paramiko.SSHClient()
+        client.get_host_keys().add(
+            _host_key_name(host, port), 'ecdsa-sha2-nistp256',
+            paramiko.ECDSAKey(data=base64.b64decode(settings['host_key'])),
+        )
+        client.connect(
+            hostname=host, port=port, username=user,
+            password=settings['token'], sock=sock,
+            look_for_keys=False, allow_agent=False,
+        )
+    except Exception:
+        sock.close()
+        raise
+    return client
+
+
+class SSHProxy(object):
+    '''
+    主进程中的本地 SSH 代理，给任务子进程使用主进程中的连接（见模块说明）
+    broker: 主进程的 SSHBroker
+    '''
+
+    def __init__(self, broker, host='127.0.0.1'):
+        self.broker = broker
+        self.host = host
+        self.sock = None
+        self.settings = None
+
+    def start(self):
+        '''开始监听，设置环境变量（之后启动的子进程继承），返回代理的设置'''
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((self.host, 0))
+        self.sock.listen(32)
+        self.settings = {
+            'address': self.sock.getsockname(),
+            'token': uuid.uuid4().hex,
+            'host_key': self.host_key.get_base64(),
+            'pid': os.getpid(),
+        }
+        thread = threading.Thread(target=self._accept, name='SSHProxy')
+        thread.daemon = True
+        thread.start()
+        os.environ[PROXY_ENV] = json.dumps(self.settings)
+        return self.settings
+
+    def stop(self):
+        if os.environ.get(PROXY_ENV) == json.dumps(self.settings):
+            os.environ.pop(PROXY_ENV)
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _addr = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(
+                target=self._serve, args=(client, ), name='SSHProxyClient'
+            )
+            thread.daemon = True
+            thread.start()
+
+    def _connect(self, request):
+        kwargs = _load_kwargs(request['connect_kwargs'])
+        key = connection_key(
+            request['host'], request['port'], request['user'], kwargs
+        )
+        if key is None:
+            raise paramiko.SSHException('invalid connect_kwargs')
+
+        def connect():
+            # 与 fabric2.Connection.open 相同的连接方式
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            if request['timeout']:
+                kwargs['timeout'] = request['timeout']
+            if 'key_filename' in kwargs and not kwargs['key_filename']:
+                del kwargs['key_filename']
+            client.connect(
+                hostname=request['host'], port=request['port'],
+                username=request['user'], **kwargs
+            )
+            return client
+        return self.broker.get(key, connect)
+
+    def _serve(self, sock):
+        shared = None
+        try:
+            request = json.loads(_readline(sock))
+            if not hmac.compare_digest(
+                str(request.get('token', '')), str(self.settings['token'])
+            ):
+                log.warn(u'SSH 代理收到令牌错误的连接')
+                return
+            try:
+                shared = self._connect(request)
+            except Exception as e:
+                log.info(u'SSH 代理连接 %s@%s:%s 失败: %r', request['user'],
+                         request['host'], request['port'], e)
+                sock.sendall(json.dumps({
+                    'error': str(e) or repr(e),
+                    'auth': isinstance(e, paramiko.AuthenticationException),
+                }) + '\n')
+                return
+            sock.sendall(json.dumps({'error': None}) + '\n')
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            interface = _ProxyInterface(shared, self.settings['token'])
+            transport.start_server(server=interface)
+            # 通道在 _ProxyInterface 中转发，这里只等待子进程断开；
+            # paramiko 只保持通道的弱引用，通道关闭之前要保持引用
+            channels = []
+            while transport.is_active():
+                channel = transport.accept(1)
+                channels = [c for c in channels if not c.closed]
+                if channel is not None:
+                    channels.append(channel)
+            interface.close()
+        except Exception:
+            log.warn(u'SSH 代理出错', exc_info=True)
+        finally:
+            if shared is not None:
+                shared.close()
+            sock.close()
+
+
+def _pump(recv, send):
+    while True:
+        data = recv(RELAY_BUFSIZE)
+        if not data:
+            return
+        send(data)
+
+
+def _relay(channel, upstream, on_close):
+    '''
+    转发一个通道: 输出、错误输出、退出码转给子进程，输入转给远程主机
+    远程主机上的通道结束后调用 on_close()
+    '''
+    def stdout():
+        stderr = threading.Thread(
+            target=_pump, args=(upstream.recv_stderr, channel.sendall_stderr)
+        )
+        stderr.daemon = True
+        stderr.start()
+        try:
+            _pump(upstream.recv, channel.sendall)
+            stderr.join()
+            status = upstream.recv_exit_status()
+            if status != -1:
+                channel.send_exit_status(status)
+            # 由子进程关闭通道，避免在请求得到回复之前关闭
+            channel.shutdown_write()
+        except Exception:
+            log.debug(u'SSH 代理转发输出出错', exc_info=True)
+        finally:
+            upstream.close()
+            on_close()
+
+    def stdin():
+        try:
+            _pump(channel.recv, upstream.sendall)
+            if channel.closed:
+                upstream.close()
+            else:
+                upstream.shutdown_write()
+        except Exception:
+            log.debug(u'SSH 代理转发输入出错', exc_info=True)
+
+    for target in (stdout, stdin):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+
+if paramiko is not None:
+    class _ProxyInterface(paramiko.ServerInterface):
+        '''
+        本地代理的服务端: 用令牌认证，在借用的连接上打开对应的通道，转发通道上的请求
+        '''
+
+        def __init__(self, client, token):
+            self.client = client
+            self.token = token
+            # {本地通道 id: 远程主机上的通道}
+            self.channels = {}
+
+        def close(self):
+            for upstream in self.channels.values():
+                upstream.close()
+            self.channels.clear()
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_auth_password(self, username, password):
+            if hmac.compare_digest(str(password), str(self.token)):
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def check_channel_request(self, kind, chanid):
+            if kind != 'session':
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+            try:
+                self.channels[chanid] = self.client.get_transport()\
+                    .open_session()
+            except Exception:
+                log.info(u'SSH 代理打开通道失败', exc_info=True)
+                return paramiko.OPEN_FAILED_CONNECT_FAILED
+            return paramiko.OPEN_SUCCEEDED
+
+        def _request(self, channel, method, *args):
+            upstream = self.channels.get(channel.get_id())
+            if upstream is None:
+                return False
+            try:
+                getattr(upstream, method)(*args)
+            except Exception:
+                log.info(u'SSH 代理转发 %s 请求失败', method, exc_info=True)
+                return False
+            return True
+
+        def _start(self, channel, method, *args):
+            if not self._request(channel, method, *args):
+                return False
+            chanid = channel.get_id()
+            _relay(
+                channel, self.channels[chanid],
+                lambda: self.channels.pop(chanid, None),
+            )
+            return True
+
+        def check_channel_pty_request(self, channel, term, width, height,
+                                      pixelwidth, pixelheight, modes):
+            return self._request(
+                channel, 'get_pty', term, width, height, pixelwidth,
+                pixelheight,
+            )
+
+        def check_channel_window_change_request(self, channel, width, height,
+                                                pixelwidth, pixelheight):
+            return self._request(
+                channel, 'resize_pty', width, height, pixelwidth, pixelheight
+            )
+
+        def check_channel_env_request(self, channel, name, value):
+            return self._request(
+                channel, 'set_environment_variable', name, value
+            )
+
+        def check_channel_exec_request(self, channel, command):
+            return self._start(channel, 'exec_command', command)
+
+        def check_channel_shell_request(self, channel):
+            return self._start(channel, 'invoke_shell')
+
+        def check_channel_subsystem_request(self, channel, name):
+            return self._start(channel, 'invoke_subsystem', name)
@@ -0,0 +1,126 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+外部程序输出的流式读取
+Popen.communicate() 要等程序退出后才一次返回全部输出，输出很多时占用大量内存。
+这里每个管道由一个线程逐行读取:
+- 每读到一行就回调 on_line(stream, line)，例如写入任务日志；
+- 只保留最后 tail_lines 行作为返回值；
+- 指定 output_file 时，完整的输出（stdout 和 stderr 按到达顺序交错）写入这个文件；
+注意:
+- 用线程而不是 select 读取，Windows 上的管道也可以使用；
+- 两个管道都读到结尾（程序及其子进程都已退出或关闭了输出）后，在剩余的超时时间内等待程序退出；
+- 每次最多读取 LINE_LIMIT 字节，没有换行的很长的输出分成多段回调，不会一次读入内存；
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# 超时杀死进程后，等待读取线程结束、进程退出的时间（秒）
+KILL_WAIT = 5
+# 每次读取的一行最多这么多字节，超过的部分作为下一行
+LINE_LIMIT = 64 * 2 ** 10
+# 等待进程退出时检查的间隔（秒）
+POLL_INTERVAL = 0.05
+
+
+class _PipeReader(threading.Thread):
+
+    def __init__(self, name, pipe, on_line, tail_lines, output, output_lock):
+        super(_PipeReader, self).__init__(name='PipeReader-' + name)
+        self.daemon = True
+        self.stream = name
+        self.pipe = pipe
+        self.on_line = on_line
+        self.tail = deque(maxlen=tail_lines)
+        self.output = output
+        self.output_lock = output_lock
+
+    def run(self):
+        try:
+            for line in iter(lambda: self.pipe.readline(LINE_LIMIT), b''):
+                self.tail.append(line)
+                if self.output is not None:
+                    with self.output_lock:
+                        if not self.output.closed:
+                            self.output.write(line)
+                if self.on_line is not None:
+                    try:
+                        self.on_line(self.stream, line)
+                    except Exception:
+                        log.debug(u'处理程序输出出错', exc_info=True)
+        finally:
+            self.pipe.close()
+
+
+def _wait(popen, deadline):
+    '''等待进程退出，到 deadline 时仍未退出返回 False（Python 2 的 Popen.wait 不支持超时）'''
+    if deadline is None:
+        popen.wait()
+        return True
+    while popen.poll() is None:
+        if time.time() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def stream_output(
+    popen, timeout=None, on_line=None, tail_lines=200, output_file=None,
+    kill=None,
+):
+    '''
+    读取 popen（stdout、stderr 都是 PIPE）的输出直到运行结束
+    timeout: 超过这个时间（秒）仍未结束时调用 kill(popen) 杀死进程，默认为 popen.kill
+    Return: (stdout 最后 tail_lines 行, stderr 最后 tail_lines 行, 是否超时)
+    '''
+    output = open(output_file, 'ab') if output_file else None
+    output_lock = threading.Lock()
+    readers = [
+        _PipeReader(name, pipe, on_line, tail_lines, output, output_lock)
+        for name, pipe in (('stdout', popen.stdout), ('stderr', popen.stderr))
+        if pipe is not None
+    ]
+    try:
+        for reader in readers:
+            reader.start()
+        deadline = time.time() + timeout if timeout is not None else None
+        for reader in readers:
+            reader.join(
+                None if deadline is None else max(deadline - time.time(), 0)
+            )
+        # 程序可能关闭了输出但仍在运行，同样受超时限制
+        timed_out = any(reader.is_alive() for reader in readers)\
+            or not _wait(popen, deadline)
+        if timed_out:
+            (kill or (lambda p: p.kill()))(popen)
+            # 进程被杀死后管道随之关闭，读取线程很快结束
+            for reader in readers:
+                reader.join(KILL_WAIT)
+            _wait(popen, time.time() + KILL_WAIT)
+    finally:
+        if output is not None:
+            with output_lock:
+                output.close()
+    tails = dict((reader.stream, b''.join(reader.tail)) for reader in readers)
+    return tails.get('stdout'), tails.get('stderr'), timed_out
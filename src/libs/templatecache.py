@@ -0,0 +1,99 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+'''
+模板编译缓存
+- 字符串模板（联机脚本、通知内容等）按源码的 sha1 缓存编译结果，LRU 淘汰；
+- 文件模板由共用的 Environment 加载，Environment 自己按文件修改时间缓存编译结果，
+  编译出的字节码另外缓存在磁盘上，进程重启后不需要重新解析模板；
+'''
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import jinja2
+
+# 缓存的字符串模板数
+STRING_CACHE_SIZE = 128
+
+
+def make_file_environment(template_dir, bytecode_dir=None):
+    '''
+    创建加载模板文件的 Environment
+    bytecode_dir: 字节码缓存目录，不指定则不缓存到磁盘
+    '''
+    bytecode_cache = None
+    if bytecode_dir is not None:
+        if not os.path.isdir(bytecode_dir):
+            os.makedirs(bytecode_dir)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_dir),
+        bytecode_cache=bytecode_cache,
+    )
+
+
+class StringTemplateCache(object):
+    '''
+    字符串模板的编译缓存，线程安全
+    environment: 编译模板用的 Environment，默认与 jinja2.Template 的设置相同
+    '''
+
+    def __init__(self, maxsize=STRING_CACHE_SIZE, environment=None):
+        self.maxsize = maxsize
+        self.environment = environment or jinja2.Environment()
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _key(self, source):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        return hashlib.sha1(source).hexdigest()
+
+    def get(self, source):
+        '''取出（或编译）source 对应的模板'''
+        key = self._key(source)
+        with self._lock:
+            template = self._templates.pop(key, None)
+            if template is not None:
+                self._templates[key] = template
+                self.hits += 1
+                return template
+        # 编译比较慢，不占用锁；并发编译同一个模板时后一个结果覆盖前一个
+        template = self.environment.from_string(source)
+        with self._lock:
+            self.misses += 1
+            self._templates[key] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._templates),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
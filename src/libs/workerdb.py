@@ -153,6 +153,30 @@ class PersistentDict(dict):
         raise ValueError('File not in a supported format')
 
 
+class MemoryDict(dict):
+    '''
+    只保存在内存中的任务数据，接口与 PersistentDict 相同，sync 不写入磁盘
+    用于同步运行的脚本（不保留任务记录）
+    '''
+
+    def __init__(self, id, *args, **kwds):
+        self.id = id
+        self.filename = None
+        dict.__init__(self, *args, **kwds)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
 if __name__ == '__main__':
     '''Test'''
     import random
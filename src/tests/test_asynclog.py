@@ -0,0 +1,91 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from libs.asynclog import LogWriter, QueueHandler
+
+
+class BlockingHandler(logging.Handler):
+    '''第一条记录写入时阻塞，用来让队列堆积'''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.started = threading.Event()
+        self.unblock = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.started.set()
+        self.unblock.wait(5)
+        self.records.append(record.getMessage())
+
+
+class AsyncLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_logger(self, name, handler, writer):
+        logger = logging.getLogger(name)
+        logger.propagate = 0
+        logger.setLevel(logging.DEBUG)
+        logger.handlers = [QueueHandler(handler, writer)]
+        return logger
+
+    def test_write_and_close(self):
+        path = os.path.join(self.tmpdir, 'worker_1.log')
+        writer = LogWriter()
+        logger = self.make_logger(
+            'test_asynclog.write', logging.FileHandler(path, delay=1), writer
+        )
+        payload = {'a': 1}
+        logger.info(u'payload %s', payload)
+        payload['a'] = 2
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed')
+        logger.handlers[0].close()
+        with open(path) as f:
+            content = f.read()
+        self.assertIn("payload {'a': 1}", content)
+        self.assertIn('ValueError: boom', content)
+
+    def test_drop_debug_first(self):
+        handler = BlockingHandler()
+        writer = LogWriter(maxsize=2, policy='drop_debug')
+        logger = self.make_logger('test_asynclog.drop', handler, writer)
+        logger.info('first')
+        handler.started.wait(5)
+        logger.debug('debug')
+        logger.info('second')
+        logger.info('third')
+        logger.info('fourth')
+        handler.unblock.set()
+        writer.flush()
+        self.assertEqual(handler.records, ['first', 'second', 'third'])
+        self.assertEqual(writer.stats()['dropped'], {'DEBUG': 1, 'INFO': 1})
@@ -0,0 +1,139 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from libs.callbacks import CallbackDispatcher, CallbackError, CallbackSpool
+
+
+class FakeSender(object):
+    '''模拟回调接口: 按顺序返回结果或抛出异常，记录发送的回调和使用的连接'''
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    def __call__(self, entry, session):
+        self.sent.append((entry['url'], session))
+        outcome = self.outcomes.pop(0) if self.outcomes else 'ok'
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class CallbackDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.spool = CallbackSpool(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_dispatcher(self, sender, **kw):
+        return CallbackDispatcher(
+            self.spool, retry_delay=10, max_attempts=3,
+            senders={'post': sender}, **kw
+        )
+
+    def put(self, url='http://a.example.com/callback', **kw):
+        return self.spool.put(
+            'post', worker_id='1', url=url,
+            data={'result': json.dumps([1, 2])}, **kw
+        )
+
+    def test_persisted_and_sent(self):
+        '''回调保存在磁盘上（token 加密），新的队列对象（重启后）仍然可以发送'''
+        callback_id = self.put(token='secret-token')
+        with open(os.path.join(self.root, callback_id + '.db')) as f:
+            self.assertNotIn('secret-token', f.read())
+
+        sender = FakeSender()
+        spool = CallbackSpool(self.root)
+        self.assertEqual(spool.list()[0]['token'], 'secret-token')
+        dispatcher = CallbackDispatcher(spool, senders={'post': sender})
+        self.assertEqual(dispatcher.dispatch(), 1)
+        self.assertEqual(spool.stats()['queued'], 0)
+
+    def test_retry_with_backoff(self):
+        sender = FakeSender(CallbackError('HTTP 502'), CallbackError('timeout'))
+        dispatcher = self.make_dispatcher(sender)
+        self.put()
+        now = time.time()
+        self.assertEqual(dispatcher.dispatch(now), 0)
+        entry = self.spool.list()[0]
+        self.assertEqual(entry['attempts'], 1)
+        self.assertEqual(entry['next_attempt'], now + 10)
+        # 没到重试时间，不发送
+        self.assertEqual(dispatcher.dispatch(now + 5), 0)
+        self.assertEqual(len(sender.sent), 1)
+        # 第二次失败，等待时间加倍
+        self.assertEqual(dispatcher.dispatch(now + 10), 0)
+        self.assertEqual(self.spool.list()[0]['next_attempt'], now + 30)
+        self.assertEqual(dispatcher.dispatch(now + 30), 1)
+        self.assertEqual(self.spool.stats(), {
+            'queued': 0, 'oldest_age': 0, 'failed': 0,
+        })
+
+    def test_give_up(self):
+        dispatcher = self.make_dispatcher(FakeSender(
+            CallbackError('HTTP 404', retry=False),
+            ValueError('x'), ValueError('x'), ValueError('x'),
+        ))
+        self.put()
+        now = time.time()
+        dispatcher.dispatch(now)
+        self.assertEqual(self.spool.stats()['failed'], 1)
+
+        # 超过最大次数
+        self.put()
+        now = time.time()
+        for delay in (0, 10, 30):
+            dispatcher.dispatch(now + delay)
+        stats = self.spool.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['failed'], 2)
+
+    def test_grouped_by_destination(self):
+        sender = FakeSender()
+        dispatcher = self.make_dispatcher(sender)
+        for url in (
+            'http://a.example.com/1', 'http://b.example.com/1',
+            'http://a.example.com/2',
+        ):
+            self.put(url)
+        self.assertGreater(self.spool.stats()['oldest_age'], 0)
+        self.assertEqual(dispatcher.dispatch(), 3)
+        sessions = dict(sender.sent)
+        self.assertIs(
+            sessions['http://a.example.com/1'],
+            sessions['http://a.example.com/2']
+        )
+        self.assertIsNot(
+            sessions['http://a.example.com/1'],
+            sessions['http://b.example.com/1']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import unittest
+
+from libs.clientregistry import ClientRegistry
+from libs.metrics import EDO_CLIENTS
+
+SITE = ('https://oc.example.com', 'zopen', 'default', )
+
+
+class FakeClient(object):
+    '''模拟 edo_client 的客户端，记录创建次数'''
+    created = 0
+
+    def __init__(self, token):
+        FakeClient.created += 1
+        self.token = token
+
+
+class ApiError(Exception):
+    pass
+
+
+class ClientRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FakeClient.created = 0
+        self.registry = ClientRegistry(maxsize=2)
+
+    def get(self, token, application='workonline'):
+        return self.registry.get(
+            application, *(SITE + (token, lambda: FakeClient(token)))
+        )
+
+    def test_reuse(self):
+        reused = EDO_CLIENTS.get(('workonline', 'reused', ))
+        client = self.get('token-a')
+        self.assertIs(self.get('token-a'), client)
+        self.assertEqual(FakeClient.created, 1)
+        self.assertEqual(EDO_CLIENTS.get(('workonline', 'reused', )), reused + 1)
+
+        # 不同的 token、不同的服务，不共用客户端
+        self.assertIsNot(self.get('token-b'), client)
+        self.assertIsNot(self.get('token-a', 'message'), client)
+        self.assertEqual(FakeClient.created, 3)
+        # 最多保留 2 个，最久没有使用的 token-a 被淘汰
+        self.get('token-a')
+        self.assertEqual(FakeClient.created, 4)
+
+    def test_expire_forget_and_fork(self):
+        client = self.get('token-a')
+        self.registry.ttl = 0
+        self.assertIsNot(self.get('token-a'), client)
+        self.registry.ttl = 60
+
+        client = self.get('token-a')
+        self.registry.forget('token-a')
+        self.assertIsNot(self.get('token-a'), client)
+
+        # 模拟 fork 出的子进程
+        client = self.get('token-a')
+        self.registry._pid = -1
+        self.assertIsNot(self.get('token-a'), client)
+
+    def test_token_info(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {'user': 'zhangsan'}
+
+        def fail():
+            raise ApiError('invalid token')
+
+        for i in range(3):
+            info = self.registry.get_token_info(*(SITE + ('token-a', fetch)))
+            self.assertEqual(info['user'], 'zhangsan')
+        self.assertEqual(len(calls), 1)
+        # 其他种类的信息单独缓存
+        self.registry.get_token_info(
+            *(SITE + ('token-a', fetch)), kind='objects_info'
+        )
+        self.assertEqual(len(calls), 2)
+        # 失败的结果不缓存
+        for i in range(2):
+            self.assertRaises(
+                ApiError, self.registry.get_token_info,
+                *(SITE + ('token-b', fail))
+            )
+        self.registry.token_info_ttl = 0
+        self.registry.forget('token-a')
+        self.registry.get_token_info(*(SITE + ('token-a', fetch)))
+        self.registry.get_token_info(*(SITE + ('token-a', fetch)))
+        self.assertEqual(len(calls), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
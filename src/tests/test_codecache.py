@@ -0,0 +1,126 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import marshal
+import os
+import shutil
+import tempfile
+import timeit
+import unittest
+
+from libs.codecache import CodeCache
+
+FUNCTION = u'''
+def step_{index}(items, factor={index}):
+    u\'\'\'第 {index} 步\'\'\'
+    result = []
+    for item in items:
+        if item % 3 == 0:
+            result.append(item * factor)
+        elif item % 3 == 1:
+            result.append({{'value': item, 'step': {index}}})
+        else:
+            result.extend([item] * 2)
+    return result
+'''
+
+
+def make_package(functions=500):
+    '''模拟一个较大的脚本包: 几千行代码'''
+    source = u'\n'.join(FUNCTION.format(index=i) for i in range(functions))
+    return source + u'\nresult = step_{}([1, 2, 3])\n'.format(functions - 1)
+
+
+# 性能测试只输出耗时，不作判断，设置环境变量 BENCHMARK 时才运行
+BENCHMARK = os.environ.get('BENCHMARK')
+
+
+class CodeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_code(self, code):
+        env = {}
+        exec(code) in env
+        return env['result']
+
+    def test_shared_between_processes(self):
+        '''新的缓存对象（相当于另一个任务子进程）直接加载编译结果'''
+        source = make_package(10)
+        code = CodeCache(self.root).compile(source)
+        cache = CodeCache(self.root)
+        cached = cache.compile(source)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 0})
+        self.assertEqual(self.run_code(code), self.run_code(cached))
+
+        # 源码或文件名变化，重新编译
+        cache.compile(source + u'\nresult = 1\n')
+        cache.compile(source, '<other>')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+        self.assertEqual(len(os.listdir(self.root)), 3)
+
+    def test_corrupted_cache(self):
+        source = u'result = 42\n'
+        cache = CodeCache(self.root)
+        cache.compile(source)
+        for name in os.listdir(self.root):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write('broken')
+        self.assertEqual(self.run_code(cache.compile(source)), 42)
+
+        # 可以加载但不是 code object 的文件
+        for name in os.listdir(self.root):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                marshal.dump('result = 0', f)
+        self.assertEqual(self.run_code(cache.compile(source)), 42)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 3})
+
+    def test_large_package(self):
+        '''较大的脚本包，编译一次后都从缓存加载'''
+        source = make_package()
+        cache = CodeCache(self.root)
+        code = cache.compile(source)
+        for _i in range(3):
+            self.assertEqual(
+                self.run_code(cache.compile(source)), self.run_code(code)
+            )
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1})
+
+    @unittest.skipUnless(BENCHMARK, 'set BENCHMARK=1 to run benchmarks')
+    def test_large_package_benchmark(self):
+        '''较大的脚本包: 每次编译与加载缓存的编译结果的耗时'''
+        source = make_package()
+        cache = CodeCache(self.root)
+        cache.compile(source)
+        compile_time = min(timeit.repeat(
+            lambda: compile(source, '<script>', 'exec'), number=3, repeat=3
+        )) / 3
+        cached_time = min(timeit.repeat(
+            lambda: cache.compile(source), number=3, repeat=3
+        )) / 3
+        print('\n{} lines, compile: {:.4f}s, cached: {:.4f}s'.format(
+            source.count(u'\n'), compile_time, cached_time
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
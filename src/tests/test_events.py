@@ -0,0 +1,73 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import threading
+import time
+import unittest
+
+from libs.events import EventFeed
+
+
+class EventFeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = EventFeed(maxlen=3, interval=0.01)
+
+    def test_resume_from_seq(self):
+        self.feed.publish(1, 'prepare')
+        self.feed.publish(1, 'running')
+        self.feed.publish(2, 'prepare')
+        self.assertEqual(
+            [e['state'] for e in self.feed.since(1, worker_id=1)], ['running']
+        )
+        self.assertEqual(len(self.feed.since(0)), 3)
+        self.assertEqual(self.feed.since(3), [])
+
+    def test_bounded(self):
+        for state in ('prepare', 'running', 'finished', 'prepare'):
+            self.feed.publish(1, state)
+        events = self.feed.since(0)
+        self.assertEqual([e['seq'] for e in events], [2, 3, 4])
+
+    def test_internal_state(self):
+        '''只用于统计的状态通知订阅者，客户端看不到'''
+        received = []
+        self.feed.subscribe(received.append)
+        self.feed.publish(1, 'running')
+        event = self.feed.publish(1, 'retry', reason='network')
+        self.assertNotIn('seq', event)
+        self.assertEqual(
+            [(e['state'], e.get('reason')) for e in received],
+            [('running', None), ('retry', 'network')]
+        )
+        self.assertEqual([e['state'] for e in self.feed.since(0)], ['running'])
+        self.assertEqual(self.feed.last_seq, 1)
+
+    def test_restarted_feed(self):
+        self.feed.publish(1, 'finished')
+        self.assertEqual(len(self.feed.since(100)), 1)
+
+    def test_wait(self):
+        self.assertEqual(self.feed.wait(0, timeout=0.05), [])
+        timer = threading.Timer(0.05, self.feed.publish, (1, 'finished'))
+        timer.start()
+        start = time.time()
+        events = self.feed.wait(0, worker_id=1, timeout=5)
+        timer.join()
+        self.assertEqual(events[0]['state'], 'finished')
+        self.assertTrue(time.time() - start < 1)
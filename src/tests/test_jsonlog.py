@@ -0,0 +1,73 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import logging
+import unittest
+from StringIO import StringIO
+
+from libs.jsonlog import (
+    ContextFilter, JSONFormatter, log_context, get_log_context,
+    iter_log_records, parse_log_line,
+)
+
+
+class JSONLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(JSONFormatter())
+        self.logger = logging.getLogger('test_jsonlog')
+        self.logger.propagate = 0
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.handlers = [handler]
+        self.logger.filters = [ContextFilter(worker_id='7')]
+
+    def test_context_roundtrip(self):
+        with log_context(correlation_id='abc', script_name='zopen.test:run'):
+            self.logger.info(u'第一行\n第二行')
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                self.logger.exception('failed')
+        self.logger.debug('outside')
+        self.assertEqual(get_log_context(), {})
+
+        lines = self.stream.getvalue().splitlines(True)
+        self.assertEqual(len(lines), 3)
+        records = list(iter_log_records(lines, correlation_id='abc'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['msg'], u'第一行\n第二行')
+        self.assertEqual(records[0]['worker_id'], '7')
+        self.assertEqual(records[0]['script_name'], 'zopen.test:run')
+        self.assertIn('ValueError: boom', records[1]['exc'])
+        last = parse_log_line(lines[2])
+        self.assertNotIn('correlation_id', last)
+        self.assertEqual(last['level'], 'DEBUG')
+
+    def test_parse_text_format(self):
+        lines = [
+            '2019-01-01 10:00:00,123 (L12) MainThread ERROR failed\n',
+            'Traceback (most recent call last):\n',
+            '2019-01-01 10:00:01,001 (L13) Thread-1 INFO done\n',
+        ]
+        records = list(iter_log_records(lines))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['line'], 12)
+        self.assertEqual(records[0]['msg'], 'failed\nTraceback (most recent call last):')
+        self.assertEqual(records[1]['thread'], 'Thread-1')
@@ -0,0 +1,66 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+from libs.lockstats import LockStats
+
+
+class LockStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = LockStats(window=60, max_samples=10, waiter_ttl=5)
+
+    def test_wait_time_and_waiters(self):
+        self.stats.record_attempt('db', 1, True, now=100)
+        self.stats.record_attempt('db', 2, False, now=101)
+        self.stats.record_attempt('db', 2, False, now=102)
+        stat = self.stats.get_stats(now=103)['db']
+        self.assertEqual(stat['acquisitions'], 1)
+        self.assertEqual(stat['failures'], 2)
+        self.assertEqual([w['worker_id'] for w in stat['waiters']], ['2'])
+
+        self.stats.record_attempt('db', 2, True, now=104)
+        stat = self.stats.get_stats(now=104)['db']
+        self.assertEqual(stat['waiters'], [])
+        self.assertEqual(stat['wait_time']['max'], 3)
+
+    def test_abandoned_waiter(self):
+        self.stats.record_attempt('db', 2, False, now=100)
+        self.stats.record_attempt('db', 3, False, now=110)
+        stat = self.stats.get_stats(now=111)['db']
+        self.assertEqual(stat['abandoned'], 1)
+
+    def test_hold_time(self):
+        lock = {'worker_id': 1, 'since': datetime.now() - timedelta(seconds=2)}
+        self.stats.record_release('db', lock)
+        hold = self.stats.get_stats()['db']['hold_time']
+        self.assertEqual(hold['count'], 1)
+        self.assertTrue(1.5 < hold['max'] < 3)
+        self.assertEqual(hold['histogram'][-1], ['+Inf', 1])
+
+    def test_bounded_memory(self):
+        stats = LockStats(max_samples=3, max_locks=2)
+        for i in range(10):
+            stats.record_attempt('db', 1, True)
+        stats.record_attempt('other', 1, True)
+        stats.record_attempt('third', 1, True)
+        result = stats.get_stats()
+        self.assertEqual(len(result), 2)
+        self.assertIn('third', result)
@@ -0,0 +1,136 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from libs import logarchive
+from libs.logarchive import (
+    ArchivingRotatingFileHandler, archive_path, clean_archives, compress,
+    find_segment, list_archives, log_size, open_log,
+)
+from libs.logindex import LogIndex
+from libs.logtail import read_tail
+
+
+class PendingArchiver(object):
+    '''只记录待压缩的归档，由测试自己压缩'''
+
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, path):
+        self.pending.append(path)
+
+
+class LogArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmpdir, 'worker_1.log')
+        self.archiver = PendingArchiver()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data, path=None):
+        with open(path or self.log_file, 'ab') as f:
+            f.write(data)
+
+    def rollover(self):
+        handler = ArchivingRotatingFileHandler(
+            self.log_file, delay=1, archiver=self.archiver
+        )
+        handler.doRollover()
+        handler.close()
+
+    def test_rollover_and_compress(self):
+        self.write('first\n')
+        first = os.stat(self.log_file).st_ino
+        self.rollover()
+        self.write('second\n')
+        self.rollover()
+
+        pending = archive_path(self.log_file, first, False)
+        self.assertEqual(self.archiver.pending, [pending])
+        self.assertEqual(list_archives(self.log_file), [pending])
+        compress(pending)
+        archived = find_segment(self.log_file, first)
+        self.assertEqual(archived, archive_path(self.log_file, first))
+        self.assertEqual(log_size(archived), len('first\n'))
+        with open_log(archived) as f:
+            self.assertEqual(f.read(), 'first\n')
+
+    def test_tail_and_search_archived(self):
+        self.write('alpha 1\nalpha 2\n')
+        first = read_tail(self.log_file, offset=0)
+        index = LogIndex(os.path.join(self.tmpdir, 'index'), self.tmpdir)
+        index.update()
+        self.write('alpha 3\n')
+        self.rollover()
+        self.write('beta 1\n')
+        self.rollover()
+        self.write('gamma 1\n')
+        compress(archive_path(self.log_file, first['generation'], False))
+
+        result = read_tail(self.log_file, first['offset'], first['generation'])
+        self.assertEqual(result['content'], u'alpha 3\n')
+        result = read_tail(self.log_file, result['offset'], result['generation'])
+        self.assertEqual(result['content'], u'beta 1\ngamma 1\n')
+        history = read_tail(self.log_file, history=True)
+        self.assertEqual(
+            history['content'], u'alpha 1\nalpha 2\nalpha 3\nbeta 1\ngamma 1\n'
+        )
+
+        index.update()
+        self.assertEqual(len(index.search('alpha')), 3)
+        self.assertEqual(len(index.search('beta')), 1)
+
+    def test_clean_archives(self):
+        now = time.time()
+        for name, inode, size, age in (
+            ('worker_1.log', 11, 100, 1),
+            ('worker_1.log', 12, 100, 2),
+            ('worker_1.log', 13, 100, 3),
+            ('worker_2.log', 21, 100, 4),
+        ):
+            path = '{}.gz'.format(archive_path(os.path.join(self.tmpdir, name), inode, False))
+            self.write('x' * size, path)
+            os.utime(path, (now - age, now - age))
+        # 刚滚动、还在压缩中的归档不处理
+        self.write('pending\n', archive_path(self.log_file, 14, False))
+        self.write('partial', archive_path(self.log_file, 14) + '.tmp')
+
+        removed = clean_archives(self.tmpdir, 2, 1000, 250)
+        self.assertEqual(removed, 2)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), [
+            'worker_1.log.11.gz', 'worker_1.log.12.gz', 'worker_1.log.14',
+            'worker_1.log.14.gz.tmp',
+        ])
+
+        # 压缩中途退出留下的临时文件，过了一段时间后删除
+        grace = logarchive.PENDING_GRACE
+        logarchive.PENDING_GRACE = 0
+        try:
+            clean_archives(self.tmpdir, 2, 1000, 250)
+        finally:
+            logarchive.PENDING_GRACE = grace
+        self.assertNotIn('worker_1.log.14.gz.tmp', os.listdir(self.tmpdir))
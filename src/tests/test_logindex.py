@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from libs.logindex import LogIndex, encode_postings, decode_postings
+
+
+class LogIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_dir = os.path.join(self.tmpdir, 'logs')
+        self.index_dir = os.path.join(self.tmpdir, 'index')
+        os.mkdir(self.log_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        with open(os.path.join(self.log_dir, name), 'ab') as f:
+            f.write(data)
+
+    def test_postings_roundtrip(self):
+        postings = [(0, 10, 1000), (0, 50, 999), (3, 0, 2000), (3, 7, 2001)]
+        self.assertEqual(decode_postings(encode_postings(postings)), postings)
+
+    def test_search_with_context(self):
+        self.write('worker_1.log', (
+            '2019-01-01 10:00:00 I start\n'
+            '2019-01-01 10:00:01 E Connection refused by server\n'
+            'Traceback line\n'
+        ))
+        self.write('worker_2.log', '2019-01-01 11:00:00 I all good\n')
+        self.write('webserver.log', 'Connection refused\n')
+        index = LogIndex(self.index_dir, self.log_dir)
+        index.update()
+
+        results = index.search('connection refused')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['worker_id'], '1')
+        self.assertEqual(results[0]['before'], ['2019-01-01 10:00:00 I start'])
+        self.assertEqual(results[0]['after'], ['Traceback line'])
+        self.assertEqual(index.search('refused connection'), [])
+        self.assertEqual(index.search('connection', name='worker_2'), [])
+
+    def test_incremental_and_rotation(self):
+        path = os.path.join(self.log_dir, 'worker_3.log')
+        self.write('worker_3.log', 'first 任务出错\n')
+        index = LogIndex(self.index_dir, self.log_dir)
+        index.update()
+        self.write('worker_3.log', 'second line\npartial')
+        os.rename(path, path + '.1')
+        self.write('worker_3.log', 'third line\n')
+        index.update()
+
+        self.assertEqual(index.search(u'出错')[0]['file'], 'worker_3.log.1')
+        self.assertEqual(len(index.search('line')), 2)
+        self.assertEqual(len(index.search('partial')), 1)
+
+        # 重新打开索引，不会重复索引
+        index = LogIndex(self.index_dir, self.log_dir)
+        index.update()
+        self.assertEqual(len(index.search('line')), 2)
+
+    def test_merge_drops_deleted_logs(self):
+        index = LogIndex(self.index_dir, self.log_dir, max_segments=1)
+        self.write('worker_4.log', 'alpha\n')
+        index.update()
+        self.write('worker_5.log', 'alpha\n')
+        os.remove(os.path.join(self.log_dir, 'worker_4.log'))
+        index.update()
+        self.assertEqual(len(index.segments), 1)
+        self.assertEqual(
+            [r['name'] for r in index.search('alpha')], ['worker_5']
+        )
@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from libs.logtail import read_tail
+
+
+class ReadTailTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmpdir, 'worker_1.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        with open(self.log_file, 'ab') as f:
+            f.write(data)
+
+    def test_incremental_line_aligned(self):
+        self.write('line 1\nline 2\nhalf')
+        result = read_tail(self.log_file, offset=0)
+        self.assertEqual(result['content'], u'line 1\nline 2\n')
+
+        self.write(' line\n')
+        result = read_tail(
+            self.log_file, result['offset'], result['generation']
+        )
+        self.assertEqual(result['content'], u'half line\n')
+        self.assertFalse(result['rotated'])
+
+    def test_initial_tail(self):
+        self.write('aaaa\nbbbb\ncccc\n')
+        result = read_tail(self.log_file, limit=7)
+        self.assertEqual(result['content'], u'cccc\n')
+
+    def test_rotation(self):
+        self.write('old 1\n')
+        first = read_tail(self.log_file, offset=0)
+        self.write('old 2\n')
+        os.rename(self.log_file, self.log_file + '.1')
+        self.write('new 1\n')
+
+        result = read_tail(self.log_file, first['offset'], first['generation'])
+        self.assertTrue(result['rotated'])
+        self.assertEqual(result['content'], u'old 2\nnew 1\n')
+        self.assertEqual(result['generation'], os.stat(self.log_file).st_ino)
+
+    def test_truncated(self):
+        self.write('x' * 10 + '\n')
+        result = read_tail(self.log_file, offset=0)
+        os.remove(self.log_file)
+        self.write('y\n')
+        result = read_tail(self.log_file, result['offset'], os.stat(self.log_file).st_ino)
+        self.assertTrue(result['reset'])
+        self.assertEqual(result['content'], u'y\n')
@@ -0,0 +1,88 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import threading
+import unittest
+
+from libs.events import EventFeed
+from libs.metrics import (
+    Counter, Gauge, Histogram, Registry, WorkerStateTracker,
+)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_threads(self):
+        counter = Counter(
+            'test_total', 'Test.', ('site', ), registry=self.registry
+        )
+
+        def work():
+            for _i in range(1000):
+                counter.inc((u'站点"a"', ))
+        threads = [threading.Thread(target=work) for _i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(counter.get((u'站点"a"', )), 4000)
+        self.assertIn(
+            'test_total{site="站点\\"a\\""} 4000', self.registry.render()
+        )
+
+    def test_histogram_and_gauge(self):
+        histogram = Histogram(
+            'test_seconds', 'Test.', buckets=(0.1, 1), registry=self.registry
+        )
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        Gauge(
+            'test_workers', 'Test.', ('state', ), registry=self.registry,
+            collect=lambda: [(('running', ), 2)],
+        )
+        lines = self.registry.render().splitlines()
+        for line in (
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+            'test_workers{state="running"} 2',
+        ):
+            self.assertIn(line, lines)
+
+    def test_worker_state_tracker(self):
+        latency = Histogram('latency', 'Test.', registry=self.registry)
+        runtime = Histogram(
+            'runtime', 'Test.', ('script', 'state', ), registry=self.registry
+        )
+        retries = Counter('retries', 'Test.', ('reason', ), registry=self.registry)
+        feed = EventFeed()
+        feed.subscribe(WorkerStateTracker(latency, runtime, retries))
+        feed.publish(1, 'prepare')
+        feed.publish(1, 'running', script='zopen.test:run')
+        feed.publish(1, 'retry', reason='network error')
+        feed.publish(1, 'finished', script='zopen.test:run')
+        rendered = self.registry.render()
+        self.assertIn('latency_count 1', rendered)
+        self.assertIn(
+            'runtime_count{script="zopen.test:run",state="finished"} 1', rendered
+        )
+        self.assertEqual(retries.get(('network error', )), 1)
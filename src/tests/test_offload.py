@@ -0,0 +1,111 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import threading
+import time
+import unittest
+
+import gevent
+
+from libs.offload import BlockingPool, ExecutorPool
+
+
+def slow_sync_script(seconds):
+    '''模拟同步运行的脚本: 没有 monkey patch，time.sleep 会阻塞整个线程'''
+    time.sleep(seconds)
+    return 'done'
+
+
+class BlockingPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = BlockingPool(2)
+
+    def tearDown(self):
+        self.pool.kill()
+
+    def measure_lock_latency(self, run):
+        '''
+        慢脚本运行期间，在事件循环中反复加锁、释放锁（与锁接口相同，操作 LOCKS 字典），
+        返回最大的延迟
+        '''
+        locks = {}
+        latencies = []
+        script = gevent.spawn(run, slow_sync_script, 0.5)
+        for i in range(10):
+            start = time.time()
+            gevent.sleep(0.01)
+            locks['lock'] = {'worker_id': i}
+            locks.pop('lock')
+            latencies.append(time.time() - start)
+        self.assertEqual(script.get(), 'done')
+        return max(latencies)
+
+    def test_lock_latency_during_slow_script(self):
+        self.assertGreater(self.measure_lock_latency(lambda f, *a: f(*a)), 0.4)
+        self.assertLess(self.measure_lock_latency(self.pool.run), 0.1)
+
+    def test_other_threads_run_inline(self):
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(
+                self.pool.run(threading.current_thread)
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertIs(result[0], thread)
+
+    def test_exception(self):
+        self.assertRaises(ValueError, self.pool.run, int, 'x')
+
+
+class ExecutorPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ExecutorPool(2, prefix='sync')
+
+    def tearDown(self):
+        self.pool.kill()
+
+    def test_quick_calls_latency(self):
+        '''执行器已经启动，快速的同步调用 p99 延迟在 50 毫秒以内'''
+        latencies = []
+        slots = set()
+        for i in range(200):
+            start = time.time()
+            slots.add(self.pool.call(5, lambda slot: slot))
+            latencies.append(time.time() - start)
+        latencies.sort()
+        self.assertLess(latencies[int(len(latencies) * 0.99) - 1], 0.05)
+        self.assertTrue(slots <= set(['sync-0', 'sync-1']))
+
+    def test_timeout_does_not_block_loop(self):
+        ticks = []
+        ticker = gevent.spawn(
+            lambda: [ticks.append(gevent.sleep(0.01)) for i in range(20)]
+        )
+        self.assertRaises(
+            gevent.Timeout, self.pool.call, 0.1,
+            lambda slot: slow_sync_script(0.5),
+        )
+        # 超时的脚本仍在运行，占用一个执行器
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        ticker.join()
+        self.assertEqual(len(ticks), 20)
+        self.assertEqual(self.pool.call(5, lambda slot: 'ok'), 'ok')
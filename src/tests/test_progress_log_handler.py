@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import logging
+import threading
+import time
+import unittest
+
+from libs.progress_log_handler import ProgressLogHandler
+
+
+class SlowWoClient(object):
+    '''模拟站点接口: 每次调用耗时 delay 秒'''
+
+    def __init__(self, delay=0.1, block=None):
+        self.delay = delay
+        self.block = block
+        self.messages = []
+
+    def xapi(self, script_name, script_title, message, **params):
+        if self.block is not None:
+            self.block.wait(5)
+        time.sleep(self.delay)
+        self.messages.append(message)
+        return {'errcode': 0}
+
+
+class ProgressLogHandlerTestCase(unittest.TestCase):
+
+    def make_handler(self, wo_client, **kw):
+        logger = logging.getLogger('test_progress_%s' % id(wo_client))
+        logger.propagate = 0
+        logger.setLevel(logging.DEBUG)
+        handler = ProgressLogHandler(
+            wo_client, 'zopen.test:progress', u'测试', {'uid': 1}, logger, **kw
+        )
+        logger.addHandler(handler)
+        return logger, handler
+
+    def test_chatty_script_does_not_wait(self):
+        wo_client = SlowWoClient(delay=0.1)
+        logger, handler = self.make_handler(
+            wo_client, batch_size=50, interval=0.05
+        )
+        start = time.time()
+        for i in range(200):
+            logger.info(u'第 %s 步', i)
+        self.assertLess(time.time() - start, 0.1)
+        handler.close()
+        lines = u'\n'.join(wo_client.messages).splitlines()
+        self.assertEqual(lines, [u'第 %s 步' % i for i in range(200)])
+        # 成批回报，调用次数远少于日志条数
+        self.assertLess(len(wo_client.messages), 20)
+        self.assertEqual(handler.sent, 200)
+
+    def test_drop_lowest_levels_first(self):
+        block = threading.Event()
+        wo_client = SlowWoClient(delay=0, block=block)
+        logger, handler = self.make_handler(
+            wo_client, batch_size=1000, interval=60, capacity=5
+        )
+        for i in range(5):
+            logger.debug(u'debug %s', i)
+        logger.warn(u'warn 1')
+        logger.warn(u'warn 2')
+        logger.debug(u'debug 5')
+        block.set()
+        handler.close()
+        lines = u'\n'.join(wo_client.messages).splitlines()
+        self.assertEqual(lines[:5], [
+            u'debug 2', u'debug 3', u'debug 4', u'warn 1', u'warn 2',
+        ])
+        self.assertIn(u'3', lines[5])
+        self.assertEqual(handler.dropped, 3)
+
+    def test_failure_not_reported_again(self):
+        class BrokenWoClient(object):
+            calls = 0
+
+            def xapi(self, *args, **kw):
+                BrokenWoClient.calls += 1
+                raise IOError('site is down')
+
+        logger, handler = self.make_handler(
+            BrokenWoClient(), batch_size=1, interval=0.01
+        )
+        logger.error(u'出错了')
+        time.sleep(0.2)
+        handler.close()
+        self.assertEqual(BrokenWoClient.calls, 1)
+
+    def test_thread_started_on_first_record(self):
+        wo_client = SlowWoClient(delay=0)
+        threads = threading.active_count()
+        logger, handler = self.make_handler(wo_client)
+        self.assertEqual(threading.active_count(), threads)
+        # 没有记录过日志也可以关闭
+        handler.close()
+        self.assertEqual(wo_client.messages, [])
+
+        logger, handler = self.make_handler(wo_client)
+        logger.info(u'开始')
+        self.assertEqual(threading.active_count(), threads + 1)
+        handler.close()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(wo_client.messages, [u'开始'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import logging
+import threading
+import time
+import unittest
+
+from libs import metrics
+from libs.requestmetrics import RequestMetrics, ENDPOINT_KEY
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def histogram_sum(histogram, labels):
+    for suffix, key, _extra, value in histogram.samples():
+        if suffix == '_sum' and key == labels:
+            return value
+    return 0.0
+
+
+class RequestMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.logger = logging.getLogger('test_requestmetrics')
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def call(self, middleware, environ):
+        '''模拟 WSGI 服务器: 发送完响应后调用 close'''
+        statuses = []
+        result = middleware(
+            environ, lambda status, headers: statuses.append(status)
+        )
+        try:
+            body = ''.join(result)
+        finally:
+            result.close()
+        return statuses[0], body
+
+    def test_streaming_response(self):
+        '''流式响应: 耗时算到响应发送完毕，统计响应大小和状态码'''
+        labels = ('test.stream', 'GET', )
+
+        def app(environ, start_response):
+            environ[ENDPOINT_KEY] = 'test.stream'
+            start_response('200 OK', [])
+
+            def generate():
+                for i in range(3):
+                    time.sleep(0.05)
+                    yield 'x' * 10
+            return generate()
+
+        middleware = RequestMetrics(app, slow_logger=self.logger)
+        requests = metrics.HTTP_REQUESTS.get(labels + ('200', ))
+        latency = histogram_sum(metrics.HTTP_REQUEST_LATENCY, labels)
+        size = histogram_sum(metrics.HTTP_RESPONSE_SIZE, ('test.stream', ))
+
+        status, body = self.call(
+            middleware, {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream'}
+        )
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(len(body), 30)
+        self.assertEqual(
+            metrics.HTTP_REQUESTS.get(labels + ('200', )), requests + 1
+        )
+        self.assertGreaterEqual(
+            histogram_sum(metrics.HTTP_REQUEST_LATENCY, labels) - latency, 0.15
+        )
+        self.assertEqual(
+            histogram_sum(metrics.HTTP_RESPONSE_SIZE, ('test.stream', )) - size,
+            30,
+        )
+        self.assertEqual(middleware._inflight, {})
+
+    def test_error_counted_as_500(self):
+        def app(environ, start_response):
+            environ[ENDPOINT_KEY] = 'test.error'
+            raise ValueError('boom')
+
+        middleware = RequestMetrics(app, slow_logger=self.logger)
+        labels = ('test.error', 'POST', '500', )
+        requests = metrics.HTTP_REQUESTS.get(labels)
+        self.assertRaises(
+            ValueError, self.call, middleware, {'REQUEST_METHOD': 'POST'}
+        )
+        self.assertEqual(metrics.HTTP_REQUESTS.get(labels), requests + 1)
+        self.assertEqual(middleware._inflight, {})
+
+    def test_slow_request_logged_once(self):
+        '''慢请求记录一次调用栈，忽略的接口不记录'''
+        release = threading.Event()
+        started = threading.Event()
+
+        def app(environ, start_response):
+            environ[ENDPOINT_KEY] = environ['endpoint']
+            start_response('200 OK', [])
+            started.set()
+            wait_for_remote_server(release)
+            return ['done']
+
+        def wait_for_remote_server(event):
+            event.wait(5)
+
+        middleware = RequestMetrics(
+            app, slow_threshold=1, slow_ignore=('test.long_poll', ),
+            slow_logger=self.logger,
+        )
+        threads = []
+        for endpoint in ('test.slow', 'test.long_poll'):
+            started.clear()
+            thread = threading.Thread(target=self.call, args=(
+                middleware, {
+                    'REQUEST_METHOD': 'GET', 'PATH_INFO': '/slow',
+                    'endpoint': endpoint,
+                },
+            ))
+            thread.start()
+            started.wait(5)
+            threads.append(thread)
+        try:
+            slow = metrics.HTTP_SLOW_REQUESTS.get(('test.slow', ))
+            self.assertEqual(middleware.check_slow_requests(), 0)
+            now = time.time() + 2
+            self.assertEqual(middleware.check_slow_requests(now), 1)
+            self.assertEqual(middleware.check_slow_requests(now), 0)
+            self.assertEqual(
+                metrics.HTTP_SLOW_REQUESTS.get(('test.slow', )), slow + 1
+            )
+            self.assertEqual(len(self.handler.messages), 1)
+            self.assertIn('/slow', self.handler.messages[0])
+            self.assertIn('wait_for_remote_server', self.handler.messages[0])
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
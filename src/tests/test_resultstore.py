@@ -0,0 +1,72 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from libs.resultstore import ResultStore
+
+
+class ResultStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ResultStore(self.root, inline_bytes=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_small_result_inline(self):
+        self.assertIsNone(self.store.dump('1', json.dumps([{'uid': 1}])))
+        self.assertFalse(os.path.exists(self.store.path('1')))
+
+    def test_large_result(self):
+        result = [{'uid': i, 'title': u'文件 {}'.format(i)} for i in range(500)]
+        data = json.dumps(result)
+        ref = self.store.dump('1', data)
+        self.assertEqual(ref['size'], len(data))
+        # 重复的内容压缩后小得多
+        self.assertLess(ref['compressed_size'], len(data) / 4)
+        self.assertEqual(json.loads(self.store.load('1', ref)), result)
+
+        chunks = list(self.store.iter_raw('1', chunk_size=1000))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), data)
+        # 压缩的内容可以直接作为 gzip 响应
+        raw = ''.join(self.store.iter_raw('1', decompress=False))
+        self.assertEqual(len(raw), ref['compressed_size'])
+        self.assertEqual(zlib.decompress(raw, 16 + zlib.MAX_WBITS), data)
+
+        # 结果变小后删除结果文件
+        self.assertIsNone(self.store.dump('1', 'null'))
+        self.assertRaises(IOError, self.store.load, '1', ref)
+        self.assertRaises(IOError, self.store.iter_raw, '1')
+
+    def test_corrupted(self):
+        data = json.dumps(range(1000))
+        ref = self.store.dump('1', data)
+        self.store.dump('1', json.dumps(range(1001)))
+        self.assertRaises(IOError, self.store.load, '1', ref)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from libs import scriptcache
+from libs.scriptcache import ScriptCache, cached_loader, version_key
+
+SITE = u'https://oc.example.com/zopen/default'
+
+
+class ScriptCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = ScriptCache(self.root, ttl=60, max_bytes=10 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_loader_downloads_once(self):
+        '''第一次运行下载脚本，之后的运行（新的进程、新的脚本引擎）使用缓存'''
+        downloads = []
+
+        def load_script(script_name):
+            downloads.append(script_name)
+            return {'title': u'测试脚本', 'script': u'return 1'}
+
+        versions = version_key({'zopen.test': '1.0'})
+        for i in range(3):
+            # 每次运行创建新的脚本引擎和缓存对象，与任务子进程相同
+            load = cached_loader(
+                load_script, ScriptCache(self.root), SITE, versions
+            )
+            self.assertEqual(load('zopen.test:run')['title'], u'测试脚本')
+            self.assertEqual(load('zopen.test:run')['script'], u'return 1')
+        self.assertEqual(downloads, ['zopen.test:run'])
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 1})
+
+        # 软件包版本变化，重新下载
+        load = cached_loader(
+            load_script, self.cache, SITE, version_key({'zopen.test': '1.1'})
+        )
+        load('zopen.test:run')
+        self.assertEqual(len(downloads), 2)
+
+    def test_ttl_and_sites(self):
+        script = {'title': 't', 'script': 'pass'}
+        self.cache.put(SITE, 'a', script, now=time.time() - 120)
+        self.assertIsNone(self.cache.get(SITE, 'a'))
+        self.cache.put(SITE, 'a', script)
+        self.assertEqual(self.cache.get(SITE, 'a'), script)
+        self.assertIsNone(self.cache.get(SITE + '2', 'a'))
+
+    def test_empty_result_cached(self):
+        '''翻译文件都下载失败时缓存空的结果，下次不再请求'''
+        key = u'\n'.join(['zopen.test', 'en', 'zh_CN', 'run.json'])
+        self.assertIsNone(self.cache.get(SITE, key))
+        self.cache.put(SITE, key, {})
+        self.assertEqual(self.cache.get(SITE, key), {})
+
+    def test_entry_ttl(self):
+        '''下载失败的结果只短时间缓存'''
+        key = u'\n'.join(['zopen.test', 'en', 'zh_CN', 'run.json'])
+        self.cache.put(SITE, key, {}, now=time.time() - 10, ttl=5)
+        self.assertIsNone(self.cache.get(SITE, key))
+        self.cache.put(SITE, key, {}, now=time.time() - 10)
+        self.assertEqual(self.cache.get(SITE, key), {})
+
+    def test_counters_bounded(self):
+        '''计数文件写满后进位，文件大小不会一直增长'''
+        base, wait = scriptcache.COUNT_BASE, scriptcache.CARRY_WAIT
+        scriptcache.COUNT_BASE, scriptcache.CARRY_WAIT = 4, 0
+        try:
+            for i in range(100):
+                self.cache.get(SITE, 'missing')
+            self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 100})
+            for name in os.listdir(self.root):
+                if name.startswith('misses'):
+                    self.assertLess(
+                        os.path.getsize(os.path.join(self.root, name)), 4
+                    )
+        finally:
+            scriptcache.COUNT_BASE, scriptcache.CARRY_WAIT = base, wait
+
+    def test_content_addressed_and_evicted(self):
+        same = {'title': 't', 'script': 'pass'}
+        self.cache.put(SITE, 'a', same)
+        self.cache.put(SITE, 'b', same)
+        objects_dir = os.path.join(self.root, 'objects')
+        self.assertEqual(len(os.listdir(objects_dir)), 1)
+
+        # 超出空间上限，淘汰最久没有使用的内容
+        for i in range(5):
+            self.cache.put(SITE, 'big%d' % i, {'script': 'x' * 3000 + str(i)})
+            time.sleep(0.01)
+        total = sum(
+            os.path.getsize(os.path.join(objects_dir, name))
+            for name in os.listdir(objects_dir)
+        )
+        self.assertLessEqual(total, 10 * 1024)
+        self.assertIsNone(self.cache.get(SITE, 'big0'))
+        self.assertIsNotNone(self.cache.get(SITE, 'big4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,442 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+try:
+    import fabric2
+except ImportError:
+    fabric2 = None
+
+try:
+    import edo_fabric
+except ImportError:
+    edo_fabric = None
+
+from libs.sshbroker import (
+    PROXY_ENV, SSHBroker, SSHProxy, brokered, connection_key, proxy_connect,
+    proxy_settings,
+)
+
+
+class SSHServer(object):
+    '''
+    本地的 SSH 测试服务器: 接受 wrong 以外的任意密码，exec 请求原样返回命令，
+    命令为 exit N 时从错误输出返回，退出码为 N
+    '''
+
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(10)
+        self.port = self.sock.getsockname()[1]
+        self.auths = 0
+        self.transports = []
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _addr = self.sock.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_ServerInterface(self))
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+if paramiko is not None:
+    class _ServerInterface(paramiko.ServerInterface):
+
+        def __init__(self, server):
+            self.server = server
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_auth_password(self, username, password):
+            if password == 'wrong':
+                return paramiko.AUTH_FAILED
+            self.server.auths += 1
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+        def check_channel_exec_request(self, channel, command):
+            def reply():
+                if command.startswith('exit '):
+                    channel.sendall_stderr(command)
+                    channel.send_exit_status(int(command[5:]))
+                else:
+                    channel.sendall(command)
+                    channel.send_exit_status(0)
+                # 由客户端关闭通道，避免在 exec 请求得到回复之前关闭
+                channel.shutdown_write()
+            threading.Thread(target=reply).start()
+            return True
+
+
+class FakeConnection(object):
+    '''与 fabric2.Connection 的 open / close / is_connected / transport 行为相同'''
+    gateway = None
+
+    def __init__(self, host, port, user, connect_kwargs):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.connect_kwargs = connect_kwargs
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.transport = None
+
+    @property
+    def is_connected(self):
+        return self.transport.active if self.transport else False
+
+    def open(self):
+        if self.is_connected:
+            return
+        self.client.connect(
+            hostname=self.host, port=self.port, username=self.user,
+            look_for_keys=False, allow_agent=False, **self.connect_kwargs
+        )
+        self.transport = self.client.get_transport()
+
+    def close(self):
+        if self.is_connected:
+            self.client.close()
+
+    def run(self, command):
+        self.open()
+        channel = self.transport.open_session()
+        channel.exec_command(command)
+        output = channel.makefile('rb').read()
+        channel.close()
+        return output
+
+
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class SSHBrokerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SSHServer()
+        self.broker = SSHBroker(idle_timeout=60)
+
+    def tearDown(self):
+        self.broker.close_all()
+        self.server.close()
+
+    def get_host(self, password='secret'):
+        return FakeConnection(
+            '127.0.0.1', self.server.port, 'bot', {'password': password}
+        )
+
+    def test_reuse(self):
+        get_host = brokered(self.get_host, self.broker)
+
+        conn = get_host()
+        self.assertEqual(conn.run('echo 1'), 'echo 1')
+        conn.close()
+
+        conn = get_host()
+        self.assertEqual(conn.run('echo 2'), 'echo 2')
+        # 同时使用: 在同一个连接上打开多个通道
+        other = get_host()
+        self.assertEqual(other.run('echo 3'), 'echo 3')
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 1})
+        conn.close()
+        other.close()
+
+        # 只认证了一次
+        self.assertEqual(self.server.auths, 1)
+
+        # 认证参数不同时不复用
+        get_host(password='other').run('echo 4')
+        self.assertEqual(self.server.auths, 2)
+
+    def test_use_after_close(self):
+        '''close() 归还连接后继续使用同一个 Connection，重新借用'''
+        get_host = brokered(self.get_host, self.broker)
+        conn = get_host()
+        conn.run('echo 1')
+        conn.close()
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 0})
+
+        self.assertEqual(conn.run('echo 2'), 'echo 2')
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 1})
+        conn.close()
+        conn.close()
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 0})
+        self.assertEqual(self.server.auths, 1)
+
+        # 连接被关闭后，用 Connection 自己的 SSHClient 重新连接
+        self.broker.close_all()
+        self.assertEqual(conn.run('echo 3'), 'echo 3')
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 1})
+        self.assertEqual(self.server.auths, 2)
+        conn.close()
+
+    def test_idle_timeout_and_health_check(self):
+        get_host = brokered(self.get_host, self.broker)
+        conn = get_host()
+        conn.run('echo 1')
+        # 使用中的连接不关闭
+        self.assertEqual(self.broker.reap(time.time() + 120), 0)
+        conn.close()
+        self.assertEqual(self.broker.reap(time.time() + 120), 1)
+        self.assertEqual(self.broker.stats()['connections'], 0)
+
+        conn = get_host()
+        conn.run('echo 2')
+        conn.close()
+        self.assertEqual(self.server.auths, 2)
+        # 服务器断开连接后，取用时重新连接
+        for transport in self.server.transports:
+            transport.close()
+        time.sleep(0.2)
+        conn = get_host()
+        self.assertEqual(conn.run('echo 3'), 'echo 3')
+        self.assertEqual(self.server.auths, 3)
+
+    def test_disabled(self):
+        broker = SSHBroker(idle_timeout=0)
+        conn = broker.attach(self.get_host())
+        conn.run('echo 1')
+        conn.close()
+        self.assertEqual(broker.stats()['connections'], 0)
+
+
+@unittest.skipIf(
+    paramiko is None or fabric2 is None, 'paramiko or fabric2 is not installed'
+)
+class FabricConnectionTestCase(unittest.TestCase):
+    '''使用真正的 fabric2.Connection'''
+
+    def setUp(self):
+        self.server = SSHServer()
+        self.broker = SSHBroker(idle_timeout=60)
+        self.connect_kwargs = {
+            'password': 'secret', 'look_for_keys': False, 'allow_agent': False,
+        }
+
+    def tearDown(self):
+        self.broker.close_all()
+        self.server.close()
+
+    def assert_reused(self, get_host):
+        for i in range(3):
+            conn = get_host()
+            result = conn.run('echo {}'.format(i), hide=True, in_stream=False)
+            self.assertEqual(result.stdout, 'echo {}'.format(i))
+            conn.close()
+        # close() 之后继续使用
+        self.assertEqual(
+            conn.run('echo 3', hide=True, in_stream=False).stdout, 'echo 3'
+        )
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 1})
+        conn.close()
+        self.assertEqual(self.server.auths, 1)
+
+    def test_connection(self):
+        self.assert_reused(brokered(
+            lambda: fabric2.Connection(
+                '127.0.0.1', user='bot', port=self.server.port,
+                connect_kwargs=self.connect_kwargs,
+            ),
+            self.broker,
+        ))
+
+    @unittest.skipIf(edo_fabric is None, 'edo_fabric is not installed')
+    def test_edo_fabric_get_host(self):
+        # 与 online_script 中注入脚本的 get_host 相同的包装
+        extra = {
+            '__worker_db': {},
+            '__logger': logging.getLogger(__name__),
+            '__package_versions': {},
+        }
+        self.assert_reused(brokered(
+            lambda: edo_fabric.get_host(
+                '127.0.0.1', port=self.server.port, user='bot',
+                password='secret', **extra
+            ),
+            self.broker,
+        ))
+
+
+def run_in_process(port, command, queue):
+    '''在任务子进程中: 从环境变量得到代理的设置，通过代理执行命令'''
+    try:
+        conn = SSHBroker(idle_timeout=60).attach(fabric2.Connection(
+            '127.0.0.1', user='bot', port=port,
+            connect_kwargs={
+                'password': 'secret', 'look_for_keys': False,
+                'allow_agent': False,
+            },
+        ))
+        result = conn.run(command, hide=True, in_stream=False)
+        conn.close()
+        queue.put(result.stdout)
+    except Exception as e:
+        queue.put(repr(e))
+
+
+@unittest.skipIf(
+    paramiko is None or fabric2 is None, 'paramiko or fabric2 is not installed'
+)
+class SSHProxyTestCase(unittest.TestCase):
+    '''任务子进程通过主进程的本地代理使用主进程中的连接'''
+
+    def setUp(self):
+        self.server = SSHServer()
+        # 主进程的 broker 和代理
+        self.broker = SSHBroker(idle_timeout=60)
+        self.proxy = SSHProxy(self.broker)
+        self.settings = self.proxy.start()
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.broker.close_all()
+        self.server.close()
+
+    def get_host(self, password='secret'):
+        return fabric2.Connection(
+            '127.0.0.1', user='bot', port=self.server.port,
+            connect_kwargs={
+                'password': password, 'look_for_keys': False,
+                'allow_agent': False,
+            },
+        )
+
+    def test_settings(self):
+        self.assertEqual(
+            os.environ[PROXY_ENV].count(self.settings['token']), 1
+        )
+        # 主进程中不使用代理
+        self.assertIsNone(proxy_settings())
+
+    def test_shared_by_tasks(self):
+        # 两个任务子进程各自的 broker
+        for i in range(2):
+            get_host = brokered(
+                self.get_host, SSHBroker(idle_timeout=60, proxy=self.settings)
+            )
+            conn = get_host()
+            self.assertEqual(
+                conn.run('echo {}'.format(i), hide=True, in_stream=False)
+                .stdout, 'echo {}'.format(i)
+            )
+            # 错误输出和退出码
+            result = conn.run('exit 3', hide=True, in_stream=False, warn=True)
+            self.assertEqual(
+                (result.exited, result.stdout, result.stderr),
+                (3, '', 'exit 3'),
+            )
+            conn.close()
+        # 连接保持在主进程中，只认证了一次
+        self.assertEqual(self.server.auths, 1)
+        self.assertEqual(self.broker.stats()['connections'], 1)
+
+    def test_release(self):
+        broker = SSHBroker(idle_timeout=60, proxy=self.settings)
+        conn = brokered(self.get_host, broker)()
+        conn.run('echo 1', hide=True, in_stream=False)
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 1})
+        # 子进程退出（到代理的连接断开）后，主进程的连接归还
+        broker.close_all()
+        for i in range(50):
+            if not self.broker.stats()['in_use']:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.broker.stats(), {'connections': 1, 'in_use': 0})
+
+    def test_errors(self):
+        broker = SSHBroker(idle_timeout=60, proxy=self.settings)
+        conn = brokered(lambda: self.get_host('wrong'), broker)()
+        with self.assertRaises(paramiko.AuthenticationException):
+            conn.run('echo 1', hide=True, in_stream=False)
+        # 令牌错误时代理直接断开
+        settings = dict(self.settings, token='wrong')
+        with self.assertRaises(EOFError):
+            proxy_connect(settings, '127.0.0.1', self.server.port, 'bot', {})
+        self.assertEqual(self.server.auths, 0)
+        # 代理连不上时直接连接
+        settings = dict(self.settings, address=('127.0.0.1', 1))
+        conn = brokered(
+            self.get_host, SSHBroker(idle_timeout=60, proxy=settings)
+        )()
+        self.assertEqual(
+            conn.run('echo 2', hide=True, in_stream=False).stdout, 'echo 2'
+        )
+        conn.close()
+        self.assertEqual(self.broker.stats()['connections'], 0)
+
+    @unittest.skipIf(sys.platform == 'win32', 'fork is not available')
+    def test_forked_tasks(self):
+        queue = multiprocessing.Queue()
+        for i in range(2):
+            process = multiprocessing.Process(
+                target=run_in_process,
+                args=(self.server.port, 'echo {}'.format(i), queue),
+            )
+            process.start()
+            process.join(30)
+            self.assertEqual(queue.get(timeout=1), 'echo {}'.format(i))
+        self.assertEqual(self.server.auths, 1)
+
+
+class ConnectionKeyTestCase(unittest.TestCase):
+
+    def test_key(self):
+        key = connection_key('host', 22, 'bot', {'password': 'secret'})
+        self.assertNotIn('secret', repr(key))
+        self.assertEqual(
+            key, connection_key('host', 22, 'bot', {'password': 'secret'})
+        )
+        self.assertNotEqual(
+            key, connection_key('host', 22, 'bot', {'password': 'other'})
+        )
+        self.assertIsNone(
+            connection_key('host', 22, 'bot', {'sock': object()})
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
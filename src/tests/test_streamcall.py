@@ -0,0 +1,133 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from libs.streamcall import LINE_LIMIT, stream_output
+
+
+def spawn(code):
+    return subprocess.Popen(
+        [sys.executable, '-u', '-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+
+
+class StreamOutputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_tail_and_output_file(self):
+        lines = []
+        output_file = os.path.join(self.root, 'output.log')
+        popen = spawn(
+            'import sys\n'
+            'for i in range(1000):\n'
+            '    sys.stdout.write("out %d\\n" % i)\n'
+            'sys.stderr.write("err\\n")\n'
+            'sys.exit(3)\n'
+        )
+        out, err, timed_out = stream_output(
+            popen, timeout=30, tail_lines=10, output_file=output_file,
+            on_line=lambda stream, line: lines.append((stream, line)),
+        )
+        self.assertFalse(timed_out)
+        self.assertEqual(popen.returncode, 3)
+        self.assertEqual(out.splitlines(), [
+            'out {}'.format(i) for i in range(990, 1000)
+        ])
+        self.assertEqual(err, 'err\n')
+        self.assertEqual(len(lines), 1001)
+        self.assertIn(('stderr', 'err\n'), lines)
+        with open(output_file, 'rb') as f:
+            self.assertEqual(len(f.read().splitlines()), 1001)
+
+    def test_lines_arrive_while_running(self):
+        arrived = []
+        popen = spawn(
+            'import time\n'
+            'print("started")\n'
+            'time.sleep(1)\n'
+            'print("done")\n'
+        )
+        start = time.time()
+        stream_output(
+            popen, timeout=30,
+            on_line=lambda stream, line: arrived.append(time.time() - start),
+        )
+        self.assertEqual(len(arrived), 2)
+        # 第一行在程序结束前就已经读到
+        self.assertLess(arrived[0], arrived[1] - 0.5)
+
+    def test_timeout(self):
+        popen = spawn(
+            'import time\n'
+            'print("waiting")\n'
+            'time.sleep(30)\n'
+        )
+        start = time.time()
+        out, err, timed_out = stream_output(popen, timeout=0.5)
+        self.assertTrue(timed_out)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(out, 'waiting\n')
+        self.assertIsNotNone(popen.returncode)
+
+    def test_closed_output_still_running(self):
+        '''程序关闭了输出但没有退出，仍然超时'''
+        popen = spawn(
+            'import os, sys, time\n'
+            'print("closing")\n'
+            'os.close(1)\n'
+            'os.close(2)\n'
+            'time.sleep(30)\n'
+        )
+        out, err, timed_out = stream_output(popen, timeout=0.5)
+        self.assertTrue(timed_out)
+        self.assertEqual(out, 'closing\n')
+        self.assertIsNotNone(popen.returncode)
+
+    def test_long_line(self):
+        lines = []
+        popen = spawn(
+            'import sys\n'
+            'sys.stdout.write("x" * (200 * 1024))\n'
+        )
+        out, err, timed_out = stream_output(
+            popen, timeout=30, tail_lines=2,
+            on_line=lambda stream, line: lines.append(line),
+        )
+        self.assertFalse(timed_out)
+        self.assertEqual(''.join(lines), 'x' * (200 * 1024))
+        # 没有换行的输出按 LINE_LIMIT 分段，最后两段是 64K 和 8K
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(max(len(line) for line in lines), LINE_LIMIT)
+        self.assertEqual(len(out), LINE_LIMIT + 8 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import unittest
+from datetime import datetime
+
+from flask import Flask, current_app
+
+import worker
+from libs.lockstats import LockStats
+
+
+def lock_and_fail(worker_id, lock_name):
+    '''加锁后出错'''
+    current_app.LOCKS[lock_name] = {
+        'worker_id': worker_id, 'description': '', 'since': datetime.now(),
+    }
+    raise ValueError(lock_name)
+
+
+class RunSyncWorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.LOCKS = {}
+        self.app.LOCK_STATS = LockStats()
+        worker.WORKER_REG['lock_and_fail'] = {'function': lock_and_fail}
+
+    def tearDown(self):
+        worker.WORKER_REG.pop('lock_and_fail', None)
+
+    def test_locks_released_on_error(self):
+        other = {'worker_id': '1', 'description': '', 'since': datetime.now()}
+        self.app.LOCKS['other'] = other
+        with self.app.app_context():
+            self.assertRaises(
+                ValueError, worker.run_sync_worker,
+                'sync-1', 'lock_and_fail', lock_name='file:1',
+            )
+        # 只释放这个执行器的锁，不影响其他任务的锁
+        self.assertEqual(self.app.LOCKS, {'other': other})
+        self.assertNotIn('sync-1', worker.SYNC_WORKER_DBS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+import unittest
+
+import jinja2
+
+from libs.templatecache import StringTemplateCache, make_file_environment
+
+TEMPLATE = u'''
+{% for item in items %}
+  <li class="{{ loop.cycle('odd', 'even') }}">{{ _(item.name) }}: {{ item.value|default('-') }}</li>
+{% endfor %}
+'''
+CONTEXT = {
+    '_': lambda s: s,
+    'items': [{'name': 'n%d' % i, 'value': i} for i in range(10)],
+}
+# 性能测试只输出耗时，不作判断，设置环境变量 BENCHMARK 时才运行
+BENCHMARK = os.environ.get('BENCHMARK')
+
+
+class TemplateCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_string_cache_lru(self):
+        cache = StringTemplateCache(maxsize=2)
+        first = cache.get(u'{{ a }}')
+        self.assertIs(cache.get('{{ a }}'), first)
+        cache.get(u'{{ b }}')
+        cache.get(u'{{ c }}')
+        self.assertIsNot(cache.get(u'{{ a }}'), first)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_file_bytecode_cache(self):
+        template_dir = os.path.join(self.tmpdir, 'templates')
+        bytecode_dir = os.path.join(self.tmpdir, 'bytecode')
+        os.mkdir(template_dir)
+        with open(os.path.join(template_dir, 'a.html'), 'w') as f:
+            f.write('hello {{ name }}')
+        env = make_file_environment(template_dir, bytecode_dir)
+        self.assertEqual(env.get_template('a.html').render(name='x'), 'hello x')
+        self.assertTrue(os.listdir(bytecode_dir))
+        # 新的 Environment 从磁盘加载字节码
+        env = make_file_environment(template_dir, bytecode_dir)
+        self.assertEqual(env.get_template('a.html').render(name='y'), 'hello y')
+
+    def test_repeated_render(self):
+        '''重复渲染同一个模板，只编译一次，结果与不缓存时相同'''
+        cache = StringTemplateCache()
+        expected = jinja2.Template(TEMPLATE).render(CONTEXT)
+        for _i in range(50):
+            self.assertEqual(cache.get(TEMPLATE).render(CONTEXT), expected)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (49, 1))
+
+    @unittest.skipUnless(BENCHMARK, 'set BENCHMARK=1 to run benchmarks')
+    def test_render_benchmark(self):
+        '''重复渲染的耗时: 每次编译模板与使用缓存的编译结果'''
+        cache = StringTemplateCache()
+        uncached = min(timeit.repeat(
+            lambda: jinja2.Template(TEMPLATE).render(CONTEXT),
+            number=50, repeat=3,
+        )) / 50
+        cached = min(timeit.repeat(
+            lambda: cache.get(TEMPLATE).render(CONTEXT), number=50, repeat=3,
+        )) / 50
+        print('\nrender: uncached {:.6f}s, cached {:.6f}s'.format(
+            uncached, cached
+        ))
@@ -0,0 +1,102 @@
+# coding: utf-8
+"""
+/*
+ * Copyright (c) 2019 EasyDo, Inc. <panjunyong@easydo.cn>
+ *
+ * This program is free software: you can use, redistribute, and/or modify
+ * it under the terms of the GNU Affero General Public License, version 3
+ * or later ("AGPL"), as published by the Free Software Foundation.
+ *
+ * This program is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ * FITNESS FOR A PARTICULAR PURPOSE.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import config
+from utils import _utils as utils
+
+
+def file_handler(logger):
+    for handler in logger.handlers:
+        target = utils._handler_target(handler)
+        if isinstance(target, logging.FileHandler):
+            return target
+
+
+class WorkerLoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self._log_data = config.LOG_DATA
+        self._max_idle = utils.MAX_IDLE_WORKER_LOGGERS
+        config.LOG_DATA = self.root
+        utils.MAX_IDLE_WORKER_LOGGERS = 2
+        self.ids = ['9001', '9002', '9003']
+
+    def tearDown(self):
+        for i in self.ids:
+            utils.close_worker_logger(i)
+        config.LOG_DATA = self._log_data
+        utils.MAX_IDLE_WORKER_LOGGERS = self._max_idle
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_reference_count(self):
+        logger = utils.get_worker_logger('9001')
+        handler = file_handler(logger)
+        self.assertIs(utils.get_worker_logger('9001'), logger)
+        self.assertEqual(utils.WORKER_LOGGER_REFS['9001'], 2)
+
+        utils.release_worker_logger('9001')
+        self.assertEqual(utils.WORKER_LOGGER_REFS['9001'], 1)
+        self.assertNotIn('9001', utils.IDLE_WORKER_LOGGERS)
+
+        utils.release_worker_logger('9001')
+        self.assertNotIn('9001', utils.WORKER_LOGGER_REFS)
+        self.assertIn('9001', utils.IDLE_WORKER_LOGGERS)
+        # 空闲的日志记录器保留处理器，再次使用时不重新创建
+        utils.get_worker_logger('9001')
+        self.assertNotIn('9001', utils.IDLE_WORKER_LOGGERS)
+        self.assertIs(file_handler(logger), handler)
+
+    def test_suspend_closes_file(self):
+        logger = utils.get_worker_logger('9001')
+        logger.info(u'第一行')
+        handler = file_handler(logger)
+        utils.suspend_worker_logger('9001')
+        self.assertIsNone(handler.stream)
+        # 日志文件可以移走，下次记录时重新打开
+        path = os.path.join(self.root, 'worker_9001.log')
+        os.rename(path, path + '.1')
+        logger.info(u'第二行')
+        utils.suspend_worker_logger('9001')
+        with open(path) as f:
+            self.assertIn('第二行', f.read())
+
+        # 释放到没有引用时同样关闭文件
+        logger.info(u'第三行')
+        utils.release_worker_logger('9001')
+        self.assertIsNone(handler.stream)
+
+    def test_idle_eviction(self):
+        loggers = [utils.get_worker_logger(i) for i in self.ids]
+        for i in self.ids:
+            utils.release_worker_logger(i)
+        # 最多保留 2 个空闲的，最久没有使用的被关闭
+        self.assertEqual(list(utils.IDLE_WORKER_LOGGERS), ['9002', '9003'])
+        self.assertEqual(loggers[0].handlers, [])
+        self.assertIsNotNone(file_handler(loggers[1]))
+        self.assertIsNotNone(file_handler(loggers[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,7 @@ import string
 import locale
 import calendar
 import hashlib
+import itertools
 import urlparse
 import gettext
 import traceback
@@ -33,12 +34,15 @@ import platform
 import logging
 import logging.config
 import logging.handlers
+import threading
+from collections import OrderedDict
 from dateutil import tz
 from functools import wraps
 from datetime import datetime, timedelta
 
 import config
 from config import CURRENT_DIR, APP_DATA, LOG_DATA, RUNTIME_DIR, INTERNAL_URL
+import edo_client
 from edo_client import (
     WoClient, OcClient, MessageClient, UploadClient, OrgClient,
 )
@@ -48,17 +52,42 @@ except ImportError:
     DEFAULT_HTTP_TIMEOUT = 15
 
 from flask import (
-    request, current_app,
-    make_response,
+    request, current_app, has_app_context,
+    make_response, Response,
     redirect, g as flask_g,
 )
 from werkzeug.datastructures import MultiDict
 import requests
-import jinja2
 import getpass
 import psutil
 
 PUBLIC_KEY_CACHE = None
+# edo_client 客户端的进程内复用，见 get_client_registry
+CLIENT_REGISTRY = None
+_client_registry_lock = threading.Lock()
+
+# 模板编译缓存，见 get_template_environment / get_string_templates
+TEMPLATE_ENVIRONMENT = None
+STRING_TEMPLATES = None
+_template_lock = threading.Lock()
+# 联机脚本、翻译文件的本地缓存，见 get_script_cache / get_i18n_cache
+SCRIPT_CACHE = None
+I18N_CACHE = None
+# 脚本编译结果的缓存，见 get_code_cache
+CODE_CACHE = None
+# 任务结果回调的发送队列，见 get_callback_spool
+CALLBACK_SPOOL = None
+# 较大的任务结果的存储，见 get_result_store
+RESULT_STORE = None
+# 联机脚本 get_host 的 SSH 连接复用，见 get_ssh_broker
+SSH_BROKER = None
+
+# 任务日志记录器的引用计数 {worker_id: count}
+WORKER_LOGGER_REFS = {}
+# 引用计数为 0 但保留了处理器的任务日志记录器，按最近使用的顺序排列
+IDLE_WORKER_LOGGERS = OrderedDict()
+MAX_IDLE_WORKER_LOGGERS = 32
+_worker_logger_lock = threading.Lock()
 
 log = logging.getLogger(__name__)
 
@@ -85,28 +114,96 @@ def load_logging_config(worker_id=None):
         pass
 
 
+def get_log_writer():
+    '''
+    获取本进程的日志写线程，没有启用异步日志时返回 None
+    '''
+    if not config.ASYNC_LOGGING:
+        return None
+    from libs.asynclog import get_writer
+    return get_writer(
+        maxsize=config.LOG_QUEUE_SIZE, policy=config.LOG_OVERFLOW_POLICY
+    )
+
+
+def get_log_stats():
+    '''异步日志的队列长度、写入数和（分级别的）丢弃数'''
+    writer = get_log_writer()
+    return writer.stats() if writer is not None else None
+
+
+def flush_logs():
+    '''
+    等待本进程已经记录的日志写入文件
+    任务子进程退出时不会执行 atexit，需要主动调用
+    '''
+    writer = get_log_writer()
+    if writer is not None:
+        writer.flush()
+
+
+def wrap_async_handler(handler):
+    '''启用了异步日志时，把处理器包装为 QueueHandler'''
+    writer = get_log_writer()
+    if writer is None:
+        return handler
+    from libs.asynclog import QueueHandler
+    return QueueHandler(handler, writer)
+
+
+def get_log_formatter():
+    '''文件日志的格式，由配置 log_format 决定'''
+    if config.LOG_FORMAT == 'json':
+        from libs.jsonlog import JSONFormatter
+        return JSONFormatter()
+    return logging.Formatter(
+        '%(asctime)s (L%(lineno)d) %(threadName)s %(levelname)s %(message)s'
+    )
+
+
+def add_context_filter(logger, **defaults):
+    '''
+    给 logger 加上日志上下文（任务 ID、关联 ID 等），重复调用只更新 defaults
+    '''
+    from libs.jsonlog import ContextFilter
+    for f in logger.filters:
+        if isinstance(f, ContextFilter):
+            f.defaults.update(defaults)
+            return
+    logger.addFilter(ContextFilter(**defaults))
+
+
+def _handler_target(handler):
+    '''QueueHandler 包装的实际处理器'''
+    return getattr(handler, 'target', handler)
+
+
 def get_logger(
     module_name, filename=None, to_console=True,
     init_level=logging.DEBUG, size=300,
-    fmt=None, datefmt=None
+    fmt=None, datefmt=None, context=None
 ):
-    '''快速创建一个 logger'''
+    '''
+    快速创建一个 logger
+    context: 这个 logger 固定的日志上下文，例如 {'worker_id': '1'}
+    '''
     logger = logging.getLogger(module_name)
     # Prevent log records from being handled by handlers of parent loggers
     logger.propagate = 0
     logger.setLevel(init_level)
+    add_context_filter(logger, **(context or {}))
 
     if not fmt:
         fmt = '%(asctime)s %(threadName)s(%(thread)s) %(levelname).1s (%(filename)s:L%(lineno)d) %(name)s: %(message)s'  # noqa: E501
     if not datefmt:
         datefmt = '%Y-%m-%d %H:%M:%S'
 
-    if to_console and not any(map(lambda h: isinstance(h, logging.StreamHandler), logger.handlers)):
+    if to_console and not any(map(lambda h: isinstance(_handler_target(h), logging.StreamHandler), logger.handlers)):
         consoleHandler = logging.StreamHandler()
         formatter = logging.Formatter(fmt, datefmt=datefmt)
         consoleHandler.setFormatter(formatter)
         consoleHandler.setLevel(init_level)
-        logger.addHandler(consoleHandler)
+        logger.addHandler(wrap_async_handler(consoleHandler))
 
     from config import LOG_DATA
 
@@ -116,25 +213,23 @@ def get_logger(
         fhandler_attached = False
         file_path = os.path.join(LOG_DATA, filename)
         for handler in logger.handlers[:]:
-            if isinstance(handler, logging.FileHandler):
-                if handler.baseFilename == file_path:
+            if isinstance(_handler_target(handler), logging.FileHandler):
+                if _handler_target(handler).baseFilename == file_path:
                     fhandler_attached = True
                     continue
                 else:
                     handler.close()
                     logger.removeHandler(handler)
         if not fhandler_attached:
-            fhandler = logging.handlers.RotatingFileHandler(
+            from libs.logarchive import ArchivingRotatingFileHandler
+            fhandler = ArchivingRotatingFileHandler(
                 os.path.join(LOG_DATA, filename),
                 maxBytes=size*1024,
-                backupCount=1,
                 delay=1  # Delay .open() operation on file
             )
-            fhandler.setFormatter(
-                logging.Formatter('%(asctime)s (L%(lineno)d) %(threadName)s %(levelname)s %(message)s')
-            )
+            fhandler.setFormatter(get_log_formatter())
             fhandler.setLevel(init_level)
-            logger.addHandler(fhandler)
+            logger.addHandler(wrap_async_handler(fhandler))
     return logger
 
 
@@ -321,8 +416,14 @@ def jsonp(func):
             'callback', request.args.get('callback', None)
         )
         if callback:
-            data = str(func(*args, **kwargs))
-            content = '{}({})'.format(str(callback), data)
+            data = func(*args, **kwargs)
+            if isinstance(data, Response) and data.is_streamed:
+                # 流式响应，逐块包装
+                content = itertools.chain(
+                    ['{}('.format(str(callback))], data.response, [')']
+                )
+            else:
+                content = '{}({})'.format(str(callback), str(data))
             mimetype = 'application/javascript'
             resp = current_app.response_class(content, mimetype=mimetype)
         else:
@@ -407,47 +508,72 @@ def save_file(filepath, response):
     return hash_obj.hexdigest()
 
 
-def get_wo_client(token=None, server=None, account=None, instance=None):
-    # 连接服务器
+def get_client_registry():
+    '''edo_client 客户端的进程内复用，见 libs.clientregistry'''
+    global CLIENT_REGISTRY
+    if CLIENT_REGISTRY is None:
+        from libs.clientregistry import ClientRegistry
+        with _client_registry_lock:
+            if CLIENT_REGISTRY is None:
+                CLIENT_REGISTRY = ClientRegistry(
+                    ttl=config.CLIENT_CACHE_TTL,
+                    token_info_ttl=config.TOKEN_INFO_TTL,
+                )
+    return CLIENT_REGISTRY
+
+
+def _make_client(client_class, token, server, account, instance):
     from config import APP_KEY, APP_SECRET
-    wo_client = WoClient(
+    client = client_class(
         server, APP_KEY, APP_SECRET,
-        account=account,
-        instance=instance,
-        timeout=DEFAULT_HTTP_TIMEOUT,
+        account=account, instance=instance, timeout=DEFAULT_HTTP_TIMEOUT,
     )
-    wo_client.auth_with_token(token)
-    return wo_client
+    if token:
+        client.auth_with_token(token)
+    return client
 
 
-def get_org_client(token=None, server=None, account=None, instance=None):
+def get_site_client(application, oc_server, account, instance, token=None):
+    '''
+    获取访问站点某个服务的客户端（edo_client.get_client），同一个进程中复用
+    '''
     from config import APP_KEY, APP_SECRET
-    org_client = OrgClient(
-        server, APP_KEY, APP_SECRET,
-        account=account, instance=instance, timeout=DEFAULT_HTTP_TIMEOUT,
+    return get_client_registry().get(
+        application, oc_server, account, instance, token,
+        lambda: edo_client.get_client(
+            application, oc_server, account, instance,
+            token=token, client_id=APP_KEY, client_secret=APP_SECRET
+        )
+    )
+
+
+def get_wo_client(token=None, server=None, account=None, instance=None):
+    # 连接服务器
+    return get_client_registry().get(
+        'workonline', server, account, instance, token,
+        lambda: _make_client(WoClient, token, server, account, instance)
+    )
+
+
+def get_org_client(token=None, server=None, account=None, instance=None):
+    return get_client_registry().get(
+        'org', server, account, instance, token,
+        lambda: _make_client(OrgClient, token, server, account, instance)
     )
-    org_client.auth_with_token(token)
-    return org_client
 
 
 def get_message_client(token=None, server=None, account=None, instance=None):
-    from config import APP_KEY, APP_SECRET
-    message_client = MessageClient(
-        server, APP_KEY, APP_SECRET,
-        account=account, instance=instance, timeout=DEFAULT_HTTP_TIMEOUT,
+    return get_client_registry().get(
+        'message', server, account, instance, token,
+        lambda: _make_client(MessageClient, token, server, account, instance)
     )
-    message_client.auth_with_token(token)
-    return message_client
 
 
 def get_upload_client(token=None, server=None, account=None, instance=None):
-    from config import APP_KEY, APP_SECRET
-    upload_client = UploadClient(
-        server, APP_KEY, APP_SECRET,
-        account=account, instance=instance, timeout=DEFAULT_HTTP_TIMEOUT,
+    return get_client_registry().get(
+        'upload', server, account, instance, token,
+        lambda: _make_client(UploadClient, token, server, account, instance)
     )
-    upload_client.auth_with_token(token)
-    return upload_client
 
 
 def get_worker_logger(id, size=300, level=logging.DEBUG):
@@ -455,14 +581,71 @@ def get_worker_logger(id, size=300, level=logging.DEBUG):
     获取一个 worker 的日志记录器
     将会限制日志行数，默认是 100Kb
     level 只影响文件处理器的日志级别
+    注意: 用完后调用 release_worker_logger 释放，处理器会缓存下来供下次使用
     '''
+    id = str(id)
+    with _worker_logger_lock:
+        WORKER_LOGGER_REFS[id] = WORKER_LOGGER_REFS.get(id, 0) + 1
+        IDLE_WORKER_LOGGERS.pop(id, None)
     module_name = 'worker_{}'.format(id)
     file_path = '{}.log'.format(module_name)
     return get_logger(
-        module_name, file_path, to_console=True, init_level=level, size=size
+        module_name, file_path, to_console=True, init_level=level, size=size,
+        context={'worker_id': id}
     )
 
 
+def release_worker_logger(id):
+    '''
+    释放一个 worker 的日志记录器
+    引用计数为 0 时释放日志文件，但保留处理器，再次使用时不需要重新创建；
+    空闲的日志记录器超过 MAX_IDLE_WORKER_LOGGERS 个时，关闭最久没有使用的
+    '''
+    id = str(id)
+    evicted = []
+    with _worker_logger_lock:
+        count = WORKER_LOGGER_REFS.get(id, 0) - 1
+        if count > 0:
+            WORKER_LOGGER_REFS[id] = count
+            return
+        WORKER_LOGGER_REFS.pop(id, None)
+        IDLE_WORKER_LOGGERS[id] = True
+        while len(IDLE_WORKER_LOGGERS) > MAX_IDLE_WORKER_LOGGERS:
+            evicted.append(IDLE_WORKER_LOGGERS.popitem(last=False)[0])
+    suspend_worker_logger(id)
+    for i in evicted:
+        close_logger(logging.getLogger('worker_{}'.format(i)))
+
+
+def _close_stream(handler):
+    '''关闭文件处理器打开的文件，下次写入时会重新打开'''
+    handler.acquire()
+    try:
+        if handler.stream:
+            handler.flush()
+            handler.stream.close()
+            handler.stream = None
+    finally:
+        handler.release()
+
+
+def suspend_worker_logger(id):
+    '''
+    释放 worker 日志文件的句柄，但保留处理器
+    用于日志文件需要被移动、删除等场合，下次记录日志时自动重新打开
+    '''
+    logger = logging.getLogger('worker_{}'.format(id))
+    for handler in logger.handlers[:]:
+        target = _handler_target(handler)
+        if not isinstance(target, logging.FileHandler):
+            continue
+        if target is handler:
+            _close_stream(target)
+        else:
+            # 异步日志，等已经入队的记录写完再关闭
+            handler.writer.call(lambda target=target: _close_stream(target))
+
+
 def close_logger(logger):
     '''
     Close all handlers of given logger.
@@ -476,7 +659,12 @@ def close_logger(logger):
 def close_worker_logger(id):
     '''
     Properly close all handlers of logger of given worker.
+    不论引用计数，直接关闭，用于删除任务时
     '''
+    id = str(id)
+    with _worker_logger_lock:
+        WORKER_LOGGER_REFS.pop(id, None)
+        IDLE_WORKER_LOGGERS.pop(id, None)
     close_logger(logging.getLogger('worker_{}'.format(id)))
 
 
@@ -615,20 +803,22 @@ def fobj_from_md(md):
 def clear_logs():
     '''
     清理过多的日志文件
+    压缩遗留的日志归档，按配置的数量和空间限制删除旧的归档
+    Return: 删除的归档数
     '''
-    pass
+    from libs.logarchive import clean_archives
+    return clean_archives(
+        LOG_DATA, config.LOG_ARCHIVE_SEGMENTS,
+        config.LOG_ARCHIVE_BYTES, config.LOG_ARCHIVE_TOTAL_BYTES
+    )
 
 
 
 def get_oc_client(oc_server=None, account=None, instance=None, token=None):
-    from config import APP_KEY, APP_SECRET
-    client = OcClient(
-        oc_server, APP_KEY, APP_SECRET,
-        account=account, instance=instance, timeout=DEFAULT_HTTP_TIMEOUT,
+    return get_client_registry().get(
+        'oc', oc_server, account, instance, token,
+        lambda: _make_client(OcClient, token, oc_server, account, instance)
     )
-    if token:
-        client.auth_with_token(token)
-    return client
 
 
 def verify_request_token(request):
@@ -648,6 +838,33 @@ def verify_request_token(request):
     return request_verified
 
 
+def run_blocking(func, *args, **kw):
+    '''
+    执行可能阻塞的操作（网络请求、等待进程等），返回 func 的结果
+    在 HTTP 服务器的事件循环中调用时交给线程池（current_app.BLOCKING_POOL）执行，
+    func 在线程池中可以使用 current_app，但不能使用 request
+    其他情况下直接调用
+    '''
+    pool = getattr(current_app, 'BLOCKING_POOL', None)\
+        if has_app_context() else None
+    if pool is None or not pool.in_loop():
+        return func(*args, **kw)
+    app = current_app._get_current_object()
+
+    def call():
+        with app.app_context():
+            return func(*args, **kw)
+    return pool.run(call)
+
+
+def blocking(func):
+    '''装饰器: 函数总是通过 run_blocking 调用'''
+    @wraps(func)
+    def wrapper(*args, **kw):
+        return run_blocking(func, *args, **kw)
+    return wrapper
+
+
 def addr_check(func):
     '''
     检查请求的来源地址，只允许以下情况的访问:
@@ -1185,7 +1402,7 @@ def call_local_script(name, args, kwargs):
     args = args or []
     kwargs = kwargs or {}
     source = make_function(name, source, args)
-    code = compile(source, '<script>', 'exec')
+    code = get_code_cache().compile(source, '<script>', 'exec')
     script_env = {}
     exec(code) in script_env
     return script_env[name](*args, **kwargs)
@@ -1211,16 +1428,117 @@ def make_function(func_name, script, variables=None):
     return u'def {}({}):\n{}'.format(func_name, args, u'\n'.join(lines))
 
 
+def get_template_environment():
+    '''
+    获取加载 templates 目录下模板文件的 Environment（进程内共用）
+    编译后的字节码缓存在 APP_DATA/template_cache 中
+    '''
+    global TEMPLATE_ENVIRONMENT
+    if TEMPLATE_ENVIRONMENT is None:
+        from libs.templatecache import make_file_environment
+        with _template_lock:
+            if TEMPLATE_ENVIRONMENT is None:
+                TEMPLATE_ENVIRONMENT = make_file_environment(
+                    os.path.join(CURRENT_DIR, 'templates'),
+                    os.path.join(APP_DATA, 'template_cache'),
+                )
+    return TEMPLATE_ENVIRONMENT
+
+
+def get_script_cache():
+    '''联机脚本的本地缓存，保存在 APP_DATA/script_cache 中，所有进程共用'''
+    global SCRIPT_CACHE
+    if SCRIPT_CACHE is None:
+        from libs.scriptcache import ScriptCache
+        SCRIPT_CACHE = ScriptCache(
+            os.path.join(APP_DATA, 'script_cache'),
+            ttl=config.SCRIPT_CACHE_TTL, max_bytes=config.SCRIPT_CACHE_BYTES,
+        )
+    return SCRIPT_CACHE
+
+
+def get_i18n_cache():
+    '''
+    联机脚本翻译文件（load_i18n）的本地缓存，保存在 APP_DATA/i18n_cache 中，所有进程共用
+    以 (站点, 软件包/语言/默认语言/文件名) 为键，软件包版本变化或过期时重新下载
+    '''
+    global I18N_CACHE
+    if I18N_CACHE is None:
+        from libs.scriptcache import ScriptCache
+        I18N_CACHE = ScriptCache(
+            os.path.join(APP_DATA, 'i18n_cache'),
+            ttl=config.I18N_CACHE_TTL, max_bytes=config.I18N_CACHE_BYTES,
+        )
+    return I18N_CACHE
+
+
+def get_callback_spool():
+    '''任务结果回调的发送队列，保存在 APP_DATA/callbacks 中，见 libs.callbacks'''
+    global CALLBACK_SPOOL
+    if CALLBACK_SPOOL is None:
+        from libs.callbacks import CallbackSpool
+        CALLBACK_SPOOL = CallbackSpool(os.path.join(APP_DATA, 'callbacks'))
+    return CALLBACK_SPOOL
+
+
+def get_result_store():
+    '''较大的任务结果的存储，保存在 APP_DATA/results 中，见 libs.resultstore'''
+    global RESULT_STORE
+    if RESULT_STORE is None:
+        from libs.resultstore import ResultStore
+        RESULT_STORE = ResultStore(
+            os.path.join(APP_DATA, 'results'),
+            inline_bytes=config.RESULT_INLINE_BYTES,
+        )
+    return RESULT_STORE
+
+
+def get_ssh_broker():
+    '''
+    联机脚本 get_host 的 SSH 连接复用（每个进程一份），见 libs.sshbroker
+    主进程启动了本地代理（SSHProxy）时，任务子进程中的实例通过代理使用主进程的连接
+    '''
+    global SSH_BROKER
+    if SSH_BROKER is None:
+        from libs.sshbroker import SSHBroker
+        SSH_BROKER = SSHBroker(
+            idle_timeout=config.SSH_IDLE_TIMEOUT,
+            keepalive=config.SSH_KEEPALIVE,
+        )
+    return SSH_BROKER
+
+
+def get_code_cache():
+    '''脚本编译结果的缓存，保存在 APP_DATA/code_cache 中，所有进程共用'''
+    global CODE_CACHE
+    if CODE_CACHE is None:
+        from libs.codecache import CodeCache
+        CODE_CACHE = CodeCache(
+            os.path.join(APP_DATA, 'code_cache'),
+            max_bytes=config.CODE_CACHE_BYTES,
+        )
+    return CODE_CACHE
+
+
+def get_string_templates():
+    '''字符串模板的编译缓存（进程内共用）'''
+    global STRING_TEMPLATES
+    if STRING_TEMPLATES is None:
+        from libs.templatecache import StringTemplateCache
+        with _template_lock:
+            if STRING_TEMPLATES is None:
+                STRING_TEMPLATES = StringTemplateCache()
+    return STRING_TEMPLATES
+
+
 def render_template(template_content, **context):
     context.update({'_': translate})
-    return jinja2.Template(template_content).render(context)
+    return get_string_templates().get(template_content).render(context)
 
 
 def render_template_file(template_path, **context):
     context.update({'_': translate})
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(os.path.join(CURRENT_DIR, 'templates'))
-    ).get_template(template_path).render(context)
+    return get_template_environment().get_template(template_path).render(context)
 
 
 def reverse_lookup_path_in_webfolder(path):
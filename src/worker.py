@@ -31,14 +31,16 @@ import ui_client
 from datetime import datetime
 from multiprocessing import Process, current_process
 import threading
+import gevent
 import psutil
 from flask import current_app, has_app_context
 
-from errors import SitebotException, Retry, LogicError
+from errors import SitebotException, Retry, LogicError, SyncCallTimeout
 from config import (
     WORKER_STORAGE_DIR, LOG_DATA, VERSION,
     BUILD_NUMBER, RETRY_INTERVAL, AUTO_START_INTERVAL,
-    GIT_INFO, WORKERS,
+    GIT_INFO, WORKERS, SYNC_SCRIPT_TIMEOUT, SYNC_SCRIPT_MAX_TIMEOUT,
+    SYNC_SCRIPT_AUDIT,
 )
 from ui_client import _request_api
 from utils import (
@@ -47,8 +49,12 @@ from utils import (
     get_logger, compare_dicts, translate as _,
     close_logger, filter_sensitive_fields,
     close_worker_logger, is_network_error,
-    load_logging_config,
+    load_logging_config, flush_logs,
+    release_worker_logger, suspend_worker_logger, clear_logs,
+    blocking, get_result_store,
 )
+from libs.logarchive import ARCHIVE_PATTERN, list_archives
+from libs.jsonlog import get_log_context, log_context, new_correlation_id
 
 # i18n fixes
 _('error')
@@ -59,6 +65,8 @@ _('paused')
 
 WORKER_REG = {}  # worker_name, {title, function}
 WORKER_SCAN_INTERVAL = 10
+# 清理日志归档的间隔（秒）
+LOG_CLEAR_INTERVAL = 10 * 60
 log = logging.getLogger(__name__)
 
 
@@ -72,6 +80,8 @@ def register_worker(func, renderer=None):
 
 
 PROCESSES = {}
+# 正在同步运行（不保留任务记录）的任务数据 {执行器编号: MemoryDict}
+SYNC_WORKER_DBS = {}
 DAEMON_THREAD = None
 DAEMON_THREAD_STOP_EVENT = None
 
@@ -128,6 +138,9 @@ def get_log_path(worker_id):
 
 
 def get_worker_db(worker_id):
+    memory_db = SYNC_WORKER_DBS.get(worker_id)
+    if memory_db is not None:
+        return memory_db
     db_path = get_db_path(worker_id)
     try:
         return workerdb.dbopen(db_path)
@@ -200,22 +213,27 @@ def remove_worker_db(worker_id):
         logger.warn(u'worker process {} killed'.format(worker_id))
     db_path = get_db_path(worker_id)
     log_path = get_log_path(worker_id)
+    # 关闭任务日志，日志文件马上要被删除
+    close_worker_logger(worker_id)
     # 删除数据库
     try:
         os.remove(db_path)
         logger.warn(u'worker log {} deleted'.format(worker_id))
     except:
         pass
+    # 删除单独保存的任务结果
+    get_result_store().remove(worker_id)
     # 删除日志文件
     try:
         os.remove(log_path)
     except:
         pass
-    # 删除日志文件备份
-    try:
-        os.remove('{}.1'.format(log_path))
-    except:
-        pass
+    # 删除日志文件备份和归档
+    for path in ['{}.1'.format(log_path)] + list_archives(log_path):
+        try:
+            os.remove(path)
+        except:
+            pass
 
     close_logger(logger)
 
@@ -319,9 +337,15 @@ def new_worker(worker_name, **kw):
     # 清理上一次的工作数据库和日志记录，避免日志混杂
     remove_worker_db(new_id)
 
+    # 关联 ID 沿用当前日志上下文（例如指令消息）中的，没有则生成一个
+    if not kw.get('correlation_id'):
+        kw['correlation_id'] = get_log_context().get('correlation_id')\
+            or new_correlation_id()
+
     logger = get_worker_logger(new_id)
     logger.debug(
-        u'----------新建任务，ID：%s，记录任务信息----------', new_id
+        u'----------新建任务，ID：%s，记录任务信息----------', new_id,
+        extra={'correlation_id': kw['correlation_id']}
     )
     worker_storage = get_worker_db(new_id)
     worker_storage['name'] = worker_name
@@ -332,7 +356,8 @@ def new_worker(worker_name, **kw):
         if value is not None:
             worker_storage[key] = value
     worker_storage.sync()
-    close_worker_logger(new_id)
+    release_worker_logger(new_id)
+    notify_worker_state(new_id, 'prepare')
     return str(new_id)
 
 
@@ -352,6 +377,61 @@ def get_alive_worker_count():
     return count
 
 
+def match_worker_query(db, name=None, state=None, site=None, since=None, until=None):
+    '''
+    检查 workerdb 是否符合查询条件
+    site: 站点名（instance）或站点地址（instance_url）
+    since / until: 任务开始时间的范围（Unix 时间戳）
+    '''
+    if name is not None and db.get('name') != name:
+        return False
+    if state is not None and db.get('state') != state:
+        return False
+    if site is not None\
+            and site not in (db.get('instance'), db.get('instance_url')):
+        return False
+    if since is not None or until is not None:
+        start_timestamp = utc_to_timestamp(db.get('start_time', ''))
+        if since is not None and start_timestamp < since:
+            return False
+        if until is not None and start_timestamp > until:
+            return False
+    return True
+
+
+def iter_workers(fields=None, cursor=None, **conditions):
+    '''
+    按条件逐个读取任务，按任务 ID 升序返回，每次只读取一个任务的数据
+    conditions: 见 match_worker_query
+    fields: 只返回 detail 中的这些字段
+    cursor: 只返回 ID 大于 cursor 的任务
+    cursor 不是整数时立即抛出 ValueError（而不是在迭代时），调用方可以在输出响应之前处理
+    '''
+    worker_ids = sorted(int(i) for i in list_worker_ids() if i.isdigit())
+    if cursor is not None:
+        cursor = int(cursor)
+        worker_ids = [i for i in worker_ids if i > cursor]
+    return _iter_workers(worker_ids, fields, conditions)
+
+
+def _iter_workers(worker_ids, fields, conditions):
+    for worker_id in worker_ids:
+        worker_id = str(worker_id)
+        worker_storage = get_worker_db(worker_id)
+        if not worker_storage or 'state' not in worker_storage:
+            continue
+        if not match_worker_query(worker_storage, **conditions):
+            continue
+        try:
+            yield get_worker(
+                worker_id, worker_storage=worker_storage, fields=fields
+            )
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            print u'iter_workers() exception:', e
+
+
 def list_workers():
     for worker_id in list_worker_ids():
         try:
@@ -369,12 +449,40 @@ def list_workers():
             continue
 
 
-def get_worker(id):
-    """ 得到某个worker的信息 """
-    worker_storage = get_worker_db(id)
+def get_store_version():
+    '''
+    任务数据的版本号
+    workerdb 每次保存都是先写临时文件再重命名，目录的修改时间都会变化，
+    因此目录修改时间不变，说明所有任务的数据都没有变化
+    '''
+    try:
+        return repr(os.stat(WORKER_STORAGE_DIR).st_mtime)
+    except OSError:
+        return None
+
+
+def get_worker(id, worker_storage=None, fields=None, load_result=False):
+    """
+    得到某个worker的信息，可以传入已经打开的 workerdb 避免重复读取
+    fields: 只返回 detail 中的这些字段，不指定则返回全部
+    load_result: 是否读取单独保存的任务结果（见 save_worker_result），
+        不读取时 detail 中只有 _result_ref；结果文件丢失或损坏时 _result 为 None
+    """
+    if worker_storage is None:
+        worker_storage = get_worker_db(id)
     name = worker_storage.get('name')
     detail = {}
-    [detail.update({k: v}) for k, v in worker_storage.items()]
+    if fields is None:
+        [detail.update({k: v}) for k, v in worker_storage.items()]
+    else:
+        # start_timestamp / end_timestamp 由 start_time / end_time 计算得到
+        for k in fields:
+            k = {
+                'start_timestamp': 'start_time',
+                'end_timestamp': 'end_time',
+            }.get(k, k)
+            if k in worker_storage:
+                detail[k] = worker_storage[k]
     if 'start_time' in detail:
         detail['start_timestamp'] = utc_to_timestamp(detail['start_time'])
         detail['start_time'] = utc_to_local(detail['start_time'])
@@ -383,6 +491,14 @@ def get_worker(id):
         detail['end_time'] = utc_to_local(detail['end_time'])
     if '_result' in detail:
         detail.update({'_result': json.loads(detail['_result'])})
+    elif load_result and '_result_ref' in worker_storage:
+        try:
+            detail['_result'] = json.loads(get_result_store().load(
+                id, worker_storage['_result_ref']
+            ))
+        except IOError:
+            log.exception(u'读取任务 #%s 的结果文件出错', id)
+            detail['_result'] = None
 
     if worker_storage['state'] in ('prepare', 'running'):
         process = PROCESSES.get(id, None)
@@ -391,9 +507,7 @@ def get_worker(id):
         process_id = None
     return {
         'name': name,
-        'title': get_worker_title(
-            name, id=id, title=worker_storage.get('title')
-        ),
+        'title': get_worker_title(name, title=worker_storage.get('title')),
         'worker_id': id,
         'state': worker_storage['state'],
         'process_id': process_id,
@@ -401,6 +515,21 @@ def get_worker(id):
     }
 
 
+def save_worker_result(id, worker_db, result):
+    '''
+    记录任务结果: 较小的结果保存在 _result 中，
+    较大的结果单独压缩保存，workerdb 中只保存引用 _result_ref（大小和 sha1）
+    '''
+    data = json.dumps(result)
+    ref = get_result_store().dump(id, data)
+    if ref is None:
+        worker_db['_result'] = data
+        worker_db.pop('_result_ref', None)
+    else:
+        worker_db['_result_ref'] = ref
+        worker_db.pop('_result', None)
+
+
 def get_worker_signature(worker_db):
     '''
     获得指定 worker 的唯一标识
@@ -490,16 +619,111 @@ def start_sync_worker(worker_name, **kw):
         return json.dumps(start_worker(worker_id, sync=True))
 
 
+def run_sync_worker(slot_id, worker_name, **kw):
+    '''
+    在执行器中同步运行任务，不创建任务记录（不分配任务 ID、不写 .db 文件）
+    slot_id: 执行器编号，运行期间用作任务 ID，日志写入 worker_<slot_id>.log
+    注意: 同步运行不重试，出错时直接抛出异常；需要在主进程的应用上下文中调用，
+    结束（包括出错）时释放任务加的锁，与 run_worker 相同
+    '''
+    kw['correlation_id'] = kw.get('correlation_id')\
+        or get_log_context().get('correlation_id') or new_correlation_id()
+    worker_db = workerdb.MemoryDict(slot_id, name=worker_name, state='running')
+    worker_db.update((k, v) for k, v in kw.items() if v is not None)
+    SYNC_WORKER_DBS[slot_id] = worker_db
+    try:
+        with log_context(**get_worker_log_context(slot_id, worker_db)):
+            func = WORKER_REG[worker_name]['function']
+            return func(slot_id, *prepare_worker_args(worker_name, slot_id))
+    finally:
+        SYNC_WORKER_DBS.pop(slot_id, None)
+        # 执行器编号会被之后的调用复用，不释放的话锁会被下一次调用继承
+        release_workers_locks([slot_id])
+
+
+def call_sync_worker(worker_name, timeout=None, **kw):
+    '''
+    在主进程的执行器池（current_app.SYNC_POOL）中同步运行任务，返回 JSON 格式的结果
+    与 start_sync_worker 相同，出错时结果为 null；超过 timeout 秒抛出 SyncCallTimeout
+    timeout: 也是调用者等待结果的时间，限制在 1 到 SYNC_SCRIPT_MAX_TIMEOUT 秒之间，
+        未指定（或无效）时为 SYNC_SCRIPT_TIMEOUT；超时后脚本在执行器中继续运行直到结束
+    结果只保存在内存中，开启 sync_script_audit 时在 sync_audit.log 中记录每次调用
+    '''
+    timeout = min(max(float(timeout), 1), SYNC_SCRIPT_MAX_TIMEOUT)\
+        if timeout > 0 else SYNC_SCRIPT_TIMEOUT
+    app = current_app._get_current_object()
+    audit = {
+        'worker_name': worker_name,
+        'script_name': kw.get('script_name'),
+        'instance': kw.get('instance'),
+        'correlation_id': kw.get('correlation_id')
+        or get_log_context().get('correlation_id') or new_correlation_id(),
+    }
+    kw['correlation_id'] = audit['correlation_id']
+
+    def run(slot_id):
+        audit['executor'] = slot_id
+        with app.app_context():
+            try:
+                return run_sync_worker(slot_id, worker_name, **kw)
+            except Exception:
+                # 任务的日志记录器已由任务自己释放，这里不再取用
+                log.exception(u'执行器 %s 同步运行任务出错', slot_id)
+                audit['error'] = extract_traceback()
+                return None
+
+    start = time.time()
+    try:
+        result = app.SYNC_POOL.call(timeout, run)
+    except gevent.Timeout:
+        audit['error'] = 'timeout'
+        raise SyncCallTimeout(kw.get('script_name'), timeout)
+    finally:
+        if SYNC_SCRIPT_AUDIT:
+            audit['duration'] = time.time() - start
+            audit_sync_call(audit)
+    return json.dumps(result)
+
+
+def audit_sync_call(record):
+    '''在 sync_audit.log 中记录一次同步调用（每行一个 JSON 对象）'''
+    logger = get_logger(
+        'sync_audit', filename='sync_audit.log', to_console=False,
+        fmt='%(message)s',
+    )
+    logger.info(json.dumps(record, sort_keys=True))
+
+
+def get_worker_log_context(id, worker_db=None):
+    '''任务的日志上下文，见 libs.jsonlog'''
+    if worker_db is None:
+        worker_db = get_worker_db(id)
+    return {
+        'worker_id': str(id),
+        'script_name': worker_db.get('script_name'),
+        'site': worker_db.get('instance'),
+        'mqtt_msg_id': worker_db.get('mqtt_msg_id'),
+        'correlation_id': worker_db.get('correlation_id'),
+    }
+
+
 def safe_run_worker(id, sync=False, pipe=None):
     '''
     任务子进程入口
     这个入口负责:
     - 运行 run_worker；
     - 负责执行 Retry 异常指定的重试策略；
+    - 设置任务的日志上下文，任务运行期间的所有日志都带上任务 ID 和关联 ID；
     注意:
     - run_worker 对于未经处理的网络错误，默认以每次 10 秒延迟重试最多 10 次；
     - 任务可以自行捕获网络错误，并通过抛出 Retry 异常来指定重试策略；
+    - 同步任务在当前线程中运行，退出后恢复原来的日志上下文；
     '''
+    with log_context(**get_worker_log_context(id)):
+        return _safe_run_worker(id, sync=sync, pipe=pipe)
+
+
+def _safe_run_worker(id, sync=False, pipe=None):
     # from workers import * 会 import 名为 sync 的模块，
     # 所以这里将 sync 的值保存到另一个变量里
     sync_flag = sync
@@ -515,6 +739,7 @@ def safe_run_worker(id, sync=False, pipe=None):
     worker_db['last_state'] = worker_db['state']
     worker_db['state'] = 'running'
     worker_db.sync()
+    notify_worker_state(id, 'running')
 
     retried = -1
     while 1:
@@ -532,8 +757,13 @@ def safe_run_worker(id, sync=False, pipe=None):
                     last_state = worker_db.get('last_state', None)
                     worker_db['state'] = 'error'
                     worker_db.sync()
+                    notify_worker_state(id, 'error')
                     break
 
+            # 重试不改变任务状态，只发布事件用于统计
+            notify_worker_state(
+                id, 'retry', reason=get_worker_db(id).get('_reason') or 'retry'
+            )
             # 重试时延迟指定秒数
             time.sleep(e.delay)
 
@@ -544,6 +774,7 @@ def safe_run_worker(id, sync=False, pipe=None):
             last_state = worker_db.get('last_state', None)
             worker_db['state'] = 'error'
             worker_db.sync()
+            notify_worker_state(id, 'error')
 
             # LogicError 不弹出错误窗口
             logger.error(u'任务 %s 出错, traceback:\n%s', id, extract_traceback())
@@ -555,14 +786,19 @@ def safe_run_worker(id, sync=False, pipe=None):
             worker_db = get_worker_db(id)
             worker_db['state'] = 'error'
             worker_db.sync()
+            notify_worker_state(id, 'error')
             break
         else:
             worker_db = get_worker_db(id)
             worker_db['state'] = 'finished'
             worker_db.sync()
+            notify_worker_state(id, 'finished')
+            release_worker_logger(id)
+            flush_logs()
             return result
 
-    close_logger(logger)
+    release_worker_logger(id)
+    flush_logs()
 
 def run_online_script(**worker_info):
     try:
@@ -631,15 +867,13 @@ def run_worker(id, sync=False, pipe=None):
         )
         # 获取到实参列表并运行
         real_args = prepare_worker_args(name, id)
-        # 关闭日志处理器，防止日志文件移动等操作无法完成
-        close_logger(logger)
+        # 释放日志文件，防止日志文件移动等操作无法完成
+        suspend_worker_logger(id)
         # 运行任务
         success = func(id, *real_args, pipe=pipe)
-        # 重新获取日志处理器
-        logger = get_worker_logger(id)
         worker_db = get_worker_db(id)
         # 记录运行结果
-        worker_db['_result'] = json.dumps(success)
+        save_worker_result(id, worker_db, success)
 
         worker_db['_reason'] = 'ok'
         if worker_db.get('executed', None) is None:
@@ -649,8 +883,6 @@ def run_worker(id, sync=False, pipe=None):
         send_worker_notify(id=id)
     except Exception as e:
         worker_db = get_worker_db(id)
-        # 重新获取日志处理器
-        logger = get_worker_logger(id)
         logger.exception(u'任务出错')
 
         worker_db.update({
@@ -680,8 +912,8 @@ def run_worker(id, sync=False, pipe=None):
     finally:
         logger.debug("Release locks for #%s", id)
         release_worker_locks(id, logger)
-        # 关闭日志
-        close_worker_logger(id)
+        # 释放日志
+        release_worker_logger(id)
         worker_db = get_worker_db(id)
         worker_db['end_time'] = datetime.utcnow().isoformat()
         worker_db.sync()
@@ -693,17 +925,19 @@ def release_worker_locks(wid, logger=None):
     当 worker 运行完毕或被杀死时应当调用这个函数
     注意: 这个函数发送 HTTP 请求到主进程服务器去释放这个锁，请不要在主进程中调用这个函数
     '''
-    logger = logger or get_worker_logger(wid)
+    if logger is None:
+        logger = get_worker_logger(wid)
+        try:
+            return release_worker_locks(wid, logger)
+        finally:
+            release_worker_logger(wid)
     if "MainProcess" == current_process().name and has_app_context():
         # 在主进程的一个请求上下文中，可以直接操作锁
         logger.debug("Release locks in main process")
-        for lock_name in current_app.LOCKS.keys():
-            lock = current_app.LOCKS[lock_name]
-            if str(lock['worker_id']) == str(wid):
-                current_app.LOCKS.pop(lock_name)
-                logger.debug(
-                    '<LOCK cleanup> cleaned {} for #{}'.format(lock_name, wid)
-                )
+        for lock_name in release_workers_locks([wid]):
+            logger.debug(
+                '<LOCK cleanup> cleaned {} for #{}'.format(lock_name, wid)
+            )
     else:
         # 不在主进程中或不在请求上下文中
         logger.debug("Release locks by HTTP request")
@@ -726,6 +960,49 @@ def release_worker_locks(wid, logger=None):
                 break
 
 
+def release_workers_locks(wids):
+    '''
+    在主进程的请求上下文中，一次遍历锁表，清理属于多个 worker 的所有锁
+    Return: 被清理的锁的名字列表
+    '''
+    wids = set(str(wid) for wid in wids)
+    released = []
+    # 可能在线程池中调用，事件循环中的加锁、解锁请求会同时修改锁表:
+    # 遍历锁表的副本，已经被释放（或被其他任务重新加锁）的锁跳过
+    for lock_name, lock in current_app.LOCKS.items():
+        if str(lock['worker_id']) not in wids\
+                or current_app.LOCKS.get(lock_name) is not lock:
+            continue
+        lock = current_app.LOCKS.pop(lock_name, None)
+        if lock is None:
+            continue
+        current_app.LOCK_STATS.record_release(lock_name, lock)
+        released.append(lock_name)
+    for wid in wids:
+        current_app.LOCK_STATS.forget_worker(wid)
+    return released
+
+
+def notify_worker_state(wid, state, **extra):
+    '''
+    发布任务状态变化事件
+    在主进程的请求上下文中直接发布，否则（任务子进程、后台线程）通知主进程发布
+    extra: 事件的附加信息，例如重试的原因 reason；
+      脚本名 script 默认取自日志上下文，用于按脚本统计运行时间
+    '''
+    extra.setdefault('script', get_log_context().get('script_name'))
+    extra = dict((k, v) for k, v in extra.items() if v is not None)
+    if "MainProcess" == current_process().name and has_app_context():
+        current_app.WORKER_EVENTS.publish(wid, state, **extra)
+    else:
+        try:
+            data = {'worker_id': wid, 'state': state}
+            data.update(extra)
+            _request_api('worker/notify', data, internal=True)
+        except Exception:
+            log.debug(u'任务 #%s 状态 %s 通知失败', wid, state, exc_info=True)
+
+
 def send_worker_notify(id=None):
     '''
     发送一个关于 worker 的通知（给自己）
@@ -733,7 +1010,7 @@ def send_worker_notify(id=None):
     if id is None or not get_worker(id):
         return
 
-    worker = get_worker(id)
+    worker = get_worker(id, load_result=True)
     work_error, silent = False, False
     # 这些状态的任务才发送消息
     matched_states = ('finished', 'error', )
@@ -913,6 +1190,7 @@ def _kill_single_process(process):
     return False
 
 
+@blocking
 def kill_process(process):
     '''
     Safely kill a process and all of its subprocesses
@@ -941,13 +1219,19 @@ def kill_process(process):
         return False
 
 
-def terminate_worker(id):
+def terminate_worker(id, release_locks=True):
+    '''
+    删除任务
+    release_locks: 为 False 时不清理任务的锁，由调用者统一清理（批量操作）
+    '''
     process = PROCESSES.get(id, None)
     if process is not None:
         kill_process(process)
         PROCESSES.pop(id, None)
     remove_worker_db(id)
-    release_worker_locks(id)
+    notify_worker_state(id, 'deleted')
+    if release_locks:
+        release_worker_locks(id)
     return {
         'is_alive': False,
         'worker_id': id,
@@ -955,23 +1239,29 @@ def terminate_worker(id):
     }
 
 
+def match_conditions(db, conditions):
+    '''
+    检查 workerdb 是否符合所有条件
+    workerdb 中的值是 list 时，只要条件的值在其中就算符合
+    '''
+    for key, value in conditions.items():
+        db_values = db.get(key, [])
+        if isinstance(db_values, list):
+            if value not in db_values:
+                return False
+        elif value != db_values:
+            return False
+    return True
+
+
 def filter_workers(**conditions):
     '''过滤出符合条件的任务ID
     例如：找出所有与路径A相符的同步任务：filter_workers(path=A, name='sync')
     '''
-    def filter_by_conditions(db):
-        for key, value in conditions.items():
-            db_values = db.get(key, [])
-            if isinstance(db_values, list) and value not in db_values:
-                return False
-            elif value != db_values:
-                return False
-        return True
-
-    matched_worker_dbs = list(filter(
-        filter_by_conditions,
-        [get_worker_db(id) for id in list_worker_ids()]
-    ))
+    matched_worker_dbs = [
+        db for db in (get_worker_db(id) for id in list_worker_ids())
+        if db is not None and match_conditions(db, conditions)
+    ]
     return [db.id for db in matched_worker_dbs]
 
 
@@ -988,15 +1278,21 @@ def turn_off_messaging(id):
         db['token'] = ''
         db['state'] = 'paused'
         db.sync()
-        close_logger(logger)
+        release_worker_logger(id)
 
 
-def pause_worker(id, turn_off_message=False):
+def pause_worker(id, turn_off_message=False, worker_db=None, release_locks=True):
+    '''
+    暂停任务
+    worker_db: 已经打开的 workerdb，避免重复读取
+    release_locks: 为 False 时不清理任务的锁，由调用者统一清理（批量操作）
+    '''
     p = PROCESSES.get(id, None)
     if p is not None:
         print u'terminating {}'.format(p)
         kill_process(p)
-    worker_db = get_worker_db(id)
+    if worker_db is None:
+        worker_db = get_worker_db(id)
     if worker_db.get('name') == 'messaging' and turn_off_message:
         turn_off_messaging(id)
         return {
@@ -1008,10 +1304,12 @@ def pause_worker(id, turn_off_message=False):
     worker_db['state'] = 'paused'
 
     worker_db.sync()
+    notify_worker_state(id, 'paused')
     logger = get_worker_logger(id)
     logger.debug(u'-------------------任务手动暂停-------------------')
-    close_logger(logger)
-    release_worker_locks(id)
+    release_worker_logger(id)
+    if release_locks:
+        release_worker_locks(id)
     return {
         'is_alive': p.is_alive() if p is not None else False,
         'worker_id': id,
@@ -1050,6 +1348,7 @@ def worker_guardian():
     # 是否是首次扫描（站点机器人启动后第一次扫描）
     first_loop = True
     self_destructed_workers = set()
+    last_clear_logs = 0
     while 1:
         for wid in list(self_destructed_workers):
             logger.info(u'将删除上一次的自毁任务 %s', wid)
@@ -1189,6 +1488,17 @@ def worker_guardian():
             remove_worker_db(wid)
             release_worker_locks(wid)
 
+        # 定时清理日志归档
+        if time.time() - last_clear_logs >= LOG_CLEAR_INTERVAL:
+            last_clear_logs = time.time()
+            try:
+                removed = clear_logs()
+            except Exception:
+                logger.warn(u'清理日志归档出错', exc_info=True)
+            else:
+                if removed:
+                    logger.info(u'删除了 %s 个旧的日志归档', removed)
+
 
 def load_workers():
     '''站点机器人启动时，加载上次的任务
@@ -1245,7 +1555,10 @@ def load_workers():
         if not os.path.isfile(os.path.join(LOG_DATA, log_file)):
             continue
 
-        # 从 worker_2.log 或 worker_3.log.1 文件名中取出任务的id
+        # 从 worker_2.log、worker_3.log.1 或归档 worker_4.log.<inode>.gz 文件名中取出任务的id
+        archive = ARCHIVE_PATTERN.match(log_file)
+        if archive is not None:
+            log_file = archive.group(1)
         if log_file.startswith('worker_') and (
             log_file.endswith('.log') or log_file.endswith('.log.1')
         ):
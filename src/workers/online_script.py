@@ -27,19 +27,22 @@ import time
 import traceback
 from functools import partial
 from invoke.exceptions import UnexpectedExit
-from requests import post
 import edo_client
 import ui_client
 from edo_fabric import get_host
 from edo_engine import RemoteScriptingEngine
 from libs.progress_log_handler import ProgressLogHandler
+from libs.jsonlog import get_log_context
+from libs.scriptcache import cached_loader, version_key
+from libs.streamcall import stream_output
+from libs.sshbroker import brokered
 from worker import register_worker, get_worker_db
 import utils
 from utils import (
     translate as _, get_message_client,  # get_site_public_key,
     get_logger, detect_locale
 )
-from config import ADDON_DIR, APP_KEY, APP_SECRET
+from config import ADDON_DIR, I18N_CACHE_FAILURE_TTL
 from errors import (
     LockAcquireTimeout, LockAcquireFailure, ScriptDownloadError,
     Retry, ScriptSecurityError,
@@ -73,27 +76,36 @@ def kill_with_children(pid):
     os.killpg(pid, signal.SIGKILL)
 
 
-def safe_call(cmd, shell=False, comment=None, timeout=10 * 60, **kw):
-    '''
-    安全地调用一个外部程序，超过指定时间自动杀死
-    Return: (return_code, stdout, stderr)
-    '''
+def _spawn(cmd, shell=False, **kw):
+    '''启动外部程序，stdout、stderr 都为 PIPE，程序及其子进程在单独的进程组中'''
     if not shell:
         cmd = shlex.split(cmd)
-        popen = Popen(
+        return Popen(
             cmd, shell=shell, stdout=PIPE, stderr=PIPE,
             preexec_fn=PREEXEC_FN, **kw
         )
     else:
         executable = '/bin/bash'
-        popen = Popen(
+        return Popen(
             cmd, shell=shell, stdout=PIPE, stderr=PIPE,
             executable=executable, preexec_fn=PREEXEC_FN, **kw
         )
+
+
+def _get_timeout(timeout):
     try:
-        timeout = int(timeout)
+        return int(timeout)
     except:
-        timeout = 10 * 60
+        return 10 * 60
+
+
+def safe_call(cmd, shell=False, comment=None, timeout=10 * 60, **kw):
+    '''
+    安全地调用一个外部程序，超过指定时间自动杀死
+    Return: (return_code, stdout, stderr)
+    '''
+    popen = _spawn(cmd, shell=shell, **kw)
+    timeout = _get_timeout(timeout)
 
     try:
         out, err = popen.communicate(timeout=timeout)
@@ -108,6 +120,39 @@ def safe_call(cmd, shell=False, comment=None, timeout=10 * 60, **kw):
     return code, out, err
 
 
+def safe_stream_call(
+    cmd, shell=False, timeout=10 * 60, logger=None, level=logging.INFO,
+    tail_lines=200, output_file=None, **kw
+):
+    '''
+    与 safe_call 相同，但运行过程中逐行把输出写入日志，适合输出很多或运行很久的程序
+    logger: 写入输出的日志，在联机脚本中默认为任务日志
+    tail_lines: 只返回 stdout、stderr 的最后这么多行
+    output_file: 把完整的输出（stdout、stderr 交错）追加写入这个文件
+    Return: (return_code, stdout, stderr)
+    '''
+    popen = _spawn(cmd, shell=shell, **kw)
+    timeout = _get_timeout(timeout)
+    logger = logger or logging.getLogger(__name__)
+
+    def on_line(stream, line):
+        logger.log(
+            level, u'[%s] %s', stream,
+            line.rstrip('\r\n').decode('utf-8', 'replace')
+        )
+
+    out, err, timed_out = stream_output(
+        popen, timeout=timeout, on_line=on_line, tail_lines=tail_lines,
+        output_file=output_file, kill=lambda p: kill_with_children(p.pid),
+    )
+    if timed_out:
+        code = 137  # as returned by `kill -9`
+        err += 'Process timed out after {} seconds'.format(timeout)
+    else:
+        code = popen.poll()
+    return code, out, err
+
+
 # Script runtime environment
 SCRIPT_ENV = {
     'ui_client': ui_client,
@@ -118,6 +163,9 @@ SCRIPT_ENV = {
     'TimeoutExpired': TimeoutExpired,
     'quote': quote,
     'safe_call': safe_call,
+    'safe_stream_call': safe_stream_call,
+    # 脚本自己创建的 Popen 也可以用它流式读取输出
+    'stream_output': stream_output,
     'LockAcquireFailure': LockAcquireFailure,
     'LockAcquireTimeout': LockAcquireTimeout,
     'Retry': Retry,
@@ -126,6 +174,12 @@ SCRIPT_ENV = {
 }
 
 
+def callback_headers():
+    '''回调请求带上关联 ID，方便回调方与任务日志对应'''
+    correlation_id = get_log_context().get('correlation_id')
+    return {'X-Correlation-ID': correlation_id} if correlation_id else {}
+
+
 @register_worker
 def online_script(
     worker_id,
@@ -146,9 +200,8 @@ def online_script(
     # - 调用 ui_client 接口将会卡死（目前实现的限制，之后可能会开放）
     # - 调用站点机器人 HTTP API 将会卡死（目前实现的限制，之后可能会开放）
 
-    wo_client = edo_client.get_client(
-        'workonline', oc_server, account, instance,
-        token=token, client_id=APP_KEY, client_secret=APP_SECRET
+    wo_client = utils.get_site_client(
+        'workonline', oc_server, account, instance, token
     )
 
     # 初始化一些对象
@@ -157,34 +210,10 @@ def online_script(
     args = json.loads(args) if args else []
     kw = json.loads(kw) if kw else {}
 
-    remote_log = None
+    remote_log = progress_log_handler = None
     if progress_script and progress_params:
-        progress_params = json.loads(progress_params)
-        progress_level = json.loads(progress_level)
-        progress_log_handler = ProgressLogHandler(
-            wo_client=wo_client,
-            progress_script=progress_script,
-            script_title=kw.get('script_title', ''),
-            progress_params=progress_params,
-            logger=logger,
-            )
-        # 如果只有一个级别则为这个级别，多个级别则取最低级别，默认为info级别
-        # 兼容流程中直接指定level: 'info', 开发调试时选择选项数组
-        level = ''
-        if isinstance(progress_level, (str, unicode)):
-            level = progress_level.upper()
-        elif progress_level:
-            # 遍历level，转成int，用sorted排序，取最低level。对于不存在的level都认为是info。
-            level = sorted(
-                map(lambda l: dict(DEBUG=logging.DEBUG, INFO=logging.INFO, ERROR=logging.ERROR).get(l.upper(), 'INFO'),
-                    progress_level))[0]
-        else:
-            level = 'INFO'
-        progress_log_handler.setLevel(level)
         remote_log = get_logger('RemoteHost:' + str(threading.currentThread().ident))
         remote_log.handlers = []
-        remote_log.addHandler(progress_log_handler)
-        logger.addHandler(progress_log_handler)
 
     worker_db = get_worker_db(worker_id)
 
@@ -192,6 +221,12 @@ def online_script(
     script_env = SCRIPT_ENV.copy()
     # 获取远端脚本执行引擎。
     rse = RemoteScriptingEngine(wo_client, script_env, False) # 站点机器人不需要对脚本签名校验
+    # 优先使用本地缓存的脚本，软件包版本变化或缓存过期时重新下载
+    site = u'{}/{}/{}'.format(oc_server, account, instance)
+    package_versions = version_key(kw.get('package_versions_'))
+    rse.load_script = cached_loader(
+        rse.load_script, utils.get_script_cache(), site, package_versions
+    )
     # 手动加载脚本以便在脚本执行前获取脚本信息。
     script_obj = rse.load_script(script_name)
 
@@ -207,9 +242,8 @@ def online_script(
         else:
             # 在线构造消息客户端，会慢一点
             try:
-                message_client = edo_client.get_client(
-                    'message', oc_server, account, instance,
-                    token=token, client_id=APP_KEY, client_secret=APP_SECRET
+                message_client = utils.get_site_client(
+                    'message', oc_server, account, instance, token
                 )
             except:
                 message_client = None
@@ -220,6 +254,7 @@ def online_script(
         '''
         下载指定的翻译文件，并加载其内容到 i18n_content 中
         如果下载失败，则使用 default_lang 指定的翻译文件
+        下载结果会缓存到本地，使用默认语言、都下载失败的结果只缓存 I18N_CACHE_FAILURE_TTL 秒
         <Args>
             package_name <String> 软件包的名字
             script_name_json <String> 要翻译的脚本对应的 json 文件
@@ -232,20 +267,34 @@ def online_script(
         default_path = 'i18n/{lang}/{name}'.format(
             lang=default_lang, name=script_name_json
         )
-
-        try:
-            json_content = wo_client.package.get_resource(
-                package_name=package_name,
-                res_path=json_path,
-            ).json()
-        except edo_client.error.ApiError:
+        i18n_cache = utils.get_i18n_cache()
+        cache_key = u'\n'.join([
+            package_name, system_lang, default_lang, script_name_json
+        ])
+        json_content = i18n_cache.get(site, cache_key, package_versions)
+        if json_content is None:
+            # 没有下载到系统语言的翻译时，可能只是站点临时出错，结果只短时间缓存
+            ttl = None
             try:
                 json_content = wo_client.package.get_resource(
                     package_name=package_name,
-                    res_path=default_path,
+                    res_path=json_path,
                 ).json()
             except edo_client.error.ApiError:
-                json_content = {}
+                ttl = I18N_CACHE_FAILURE_TTL
+                try:
+                    json_content = wo_client.package.get_resource(
+                        package_name=package_name,
+                        res_path=default_path,
+                    ).json()
+                except edo_client.error.ApiError:
+                    json_content = {}
+            try:
+                i18n_cache.put(
+                    site, cache_key, json_content, package_versions, ttl=ttl
+                )
+            except (IOError, OSError):
+                logger.debug(u'缓存翻译文件 %s 失败', json_path, exc_info=True)
 
         i18n_content.update(**json_content)
 
@@ -307,16 +356,45 @@ def online_script(
     	'RSE_NAME': 'bot',
         'logger': logger,
         'wo_client': wo_client,
-        'get_host': partial(get_host,
+        # 同一个主机的 SSH 连接在进程内复用
+        'get_host': brokered(partial(get_host,
                                    __worker_db=worker_db,
                                    __logger=remote_log,
                                    __package_versions=kw['package_versions_']),
+                             utils.get_ssh_broker()),
         'load_i18n': load_i18n,
         '_': custom_translate,
+        'safe_stream_call': partial(safe_stream_call, logger=logger),
     })
     rse.script_exec_env['get_remote_host'] = rse.script_exec_env['get_host']
 
     try:
+        # 在 try 中创建和添加进度回报的处理器，出错时也能在 finally 中移除
+        if progress_script and progress_params:
+            progress_params = json.loads(progress_params)
+            progress_level = json.loads(progress_level)
+            progress_log_handler = ProgressLogHandler(
+                wo_client=wo_client,
+                progress_script=progress_script,
+                script_title=kw.get('script_title', ''),
+                progress_params=progress_params,
+                logger=logger,
+                )
+            # 如果只有一个级别则为这个级别，多个级别则取最低级别，默认为info级别
+            # 兼容流程中直接指定level: 'info', 开发调试时选择选项数组
+            level = ''
+            if isinstance(progress_level, (str, unicode)):
+                level = progress_level.upper()
+            elif progress_level:
+                # 遍历level，转成int，用sorted排序，取最低level。对于不存在的level都认为是info。
+                level = sorted(
+                    map(lambda l: dict(DEBUG=logging.DEBUG, INFO=logging.INFO, ERROR=logging.ERROR).get(l.upper(), 'INFO'),
+                        progress_level))[0]
+            else:
+                level = 'INFO'
+            progress_log_handler.setLevel(level)
+            remote_log.addHandler(progress_log_handler)
+            logger.addHandler(progress_log_handler)
         result = rse.call(script_name, *args, **kw)
     except ScriptSecurityError:
         if __sync:
@@ -340,33 +418,33 @@ def online_script(
             raise
 
         # 如果有错误回调地址，POST traceback
+        # 回调由主进程在后台发送（失败后重试），见 libs.callbacks
         if error_callback_url or (error_script and error_params):
             try:
                 if error_script and error_params:
                     error_params = json.loads(error_params)
                     logger.debug(u'使用新版本错误回调脚本：%s', error_script)
-                    error_result = wo_client.xapi(
-                        error_script,
+                    params = dict(
                         script_title=kw.get('script_title', ''),
                         traceback=traceback.format_exc(),
                         **error_params
                     )
-                    logger.debug(error_result)
-                    if error_result.get('errcode') != 0:
-                        raise Exception(u'出错回调出错，出错原因：{}'.format(error_result.get('errmsg', '')))
+                    utils.get_callback_spool().put(
+                        'xapi', worker_id=worker_id, oc_server=oc_server,
+                        account=account, instance=instance, token=token,
+                        script=error_script, params=params,
+                    )
                 else:
                     logger.debug(u'POST 错误回调地址: %s', error_callback_url)
-                    resp = post(
-                        error_callback_url,
-                        data={
-                            'traceback': traceback.format_exc(),
-                        }
+                    utils.get_callback_spool().put(
+                        'post', worker_id=worker_id, url=error_callback_url,
+                        data={'traceback': traceback.format_exc()},
+                        headers=callback_headers(),
                     )
             except:
                 logger.exception(u'回调出错')
             else:
-                if not error_script and error_params:
-                    logger.info(u'错误回调响应状态码 %s，响应内容:\n%s', resp.status_code, resp.content)
+                logger.info(u'错误回调已加入发送队列')
         else:
             try:
                 traceback_info = traceback.format_exc()
@@ -395,35 +473,41 @@ def online_script(
             return result
 
         if callback_url or (return_script and return_params):
+            # 回调由主进程在后台发送（失败后重试），见 libs.callbacks
             try:
                 if return_script and return_params:
                     return_params = json.loads(return_params)
                     logger.debug(u'使用新版本回调脚本：%s', return_script)
-                    return_result = wo_client.xapi(
-                        return_script,
+                    params = dict(
                         script_title=kw.get('script_title', ''),
                         result=json.dumps(result),
                         **return_params
                     )
-                    logger.info(return_result)
-                    if return_result.get('errcode') != 0:
-                        raise Exception(u'成功回调出错，出错原因：{}'.format(return_result.get('errmsg', '')))
+                    utils.get_callback_spool().put(
+                        'xapi', worker_id=worker_id, oc_server=oc_server,
+                        account=account, instance=instance, token=token,
+                        script=return_script, params=params,
+                    )
                 else:
                     logger.debug(u'回调地址: %s', callback_url)
-                    resp = post(
-                        callback_url,
-                        data={
-                            'result': json.dumps(result),
-                        }
+                    utils.get_callback_spool().put(
+                        'post', worker_id=worker_id, url=callback_url,
+                        data={'result': json.dumps(result)},
+                        headers=callback_headers(),
                     )
             except:
                 logger.exception(u'回调出错')
             else:
-                if not return_script and return_params:
-                    logger.info(u'回调响应状态码 %s，响应内容:\n%s', resp.status_code, resp.content)
+                logger.info(u'回调已加入发送队列')
         return []
 
     finally:
+        if progress_log_handler is not None:
+            # 回报缓冲区中剩余的进度日志
+            logger.removeHandler(progress_log_handler)
+            remote_log.removeHandler(progress_log_handler)
+            progress_log_handler.close()
+        utils.release_worker_logger(worker_id)
         if not __sync:
             worker_db = get_worker_db(worker_id)
             worker_db.sync()